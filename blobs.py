@@ -0,0 +1,207 @@
+"""Хранилище файлов по содержимому (content-addressed)
+
+Файл хранится один раз под именем SHA-256 своего содержимого:
+uploads/.blobs/ab/ab12...; одинаковые файлы, отправленные разными
+людьми или под разными именами, занимают место один раз. Хэш считается
+во время записи (BlobWriter), повторно файл не читается. Тогда же считаются
+хэши частей по CHUNK_SIZE байт, которые нужны для скачивания с нескольких
+узлов (swarm.py): иначе первый запрос списка частей большого файла ждал бы
+чтения всего файла.
+
+Поверх хранилища ведется индекс имя -> хэш (SQLite). Имя, уже занятое
+другим содержимым, не перезаписывается: новому файлу выдается имя
+"отчет (2).pdf". Файлы, лежавшие в uploads/ до появления хранилища,
+по-прежнему находятся по имени.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+BLOB_FOLDER = ".blobs"
+CHUNK_SIZE = 8 * 1024 * 1024  # Части, хэши которых считаются при записи (transfer.DEFAULT_CHUNK_SIZE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_names_digest ON names(digest);
+"""
+
+
+def is_digest(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+class BlobWriter:
+    """Временный файл в хранилище, SHA-256 которого (и его частей) считается по мере записи"""
+
+    def __init__(self, store: "BlobStore"):
+        self.store = store
+        self.path = os.path.join(store.folder, "tmp-" + uuid.uuid4().hex)
+        self.size = 0
+        self.chunks: List[str] = []  # SHA-256 частей по store.chunk_size
+        self._digest = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+        self._file = open(self.path, "wb")
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self._digest.update(data)
+        chunk_size = self.store.chunk_size
+        view = memoryview(data)
+        while view:
+            left = chunk_size - self.size % chunk_size
+            self._chunk.update(view[:left])
+            self.size += min(left, len(view))
+            view = view[left:]
+            if self.size % chunk_size == 0:
+                self.chunks.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+
+    def commit(self) -> Tuple[str, bool]:
+        """Перенос в хранилище; возвращает (хэш, True если такого содержимого еще не было)"""
+        self._file.close()
+        if self.size % self.store.chunk_size:
+            self.chunks.append(self._chunk.hexdigest())
+        digest = self._digest.hexdigest()
+        added = self.store.add(self.path, digest)
+        self.store.save_chunk_hashes(digest, self.store.chunk_size, self.chunks)
+        return digest, added
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.abort()
+
+
+class BlobStore:
+    """Файлы по SHA-256 и индекс имен"""
+
+    def __init__(self, root: str, chunk_size: int = CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.folder = os.path.join(root, BLOB_FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Отдельное соединение для каждого потока"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.folder, "index.db"), timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return is_digest(digest) and os.path.exists(self.path(digest))
+
+    def size(self, digest: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self.path(digest)) if is_digest(digest) else None
+        except OSError:
+            return None
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def add(self, path: str, digest: str) -> bool:
+        """Перенос готового файла с известным хэшем; дубликат удаляется"""
+        target = self.path(digest)
+        if os.path.exists(target):
+            os.remove(path)
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+        return True
+
+    def add_file(self, source: str) -> Tuple[str, int]:
+        """Копирование внешнего файла в хранилище; возвращает (хэш, размер)"""
+        with self.writer() as writer, open(source, "rb") as f:
+            while data := f.read(1024 * 1024):
+                writer.write(data)
+            digest, _ = writer.commit()
+        return digest, writer.size
+
+    def _manifest(self, digest: str, chunk_size: int) -> str:
+        return f"{self.path(digest)}.{chunk_size}.chunks"
+
+    def save_chunk_hashes(self, digest: str, chunk_size: int, hashes: List[str]):
+        """Сохранить хэши частей рядом с файлом (если их еще нет)"""
+        manifest = self._manifest(digest, chunk_size)
+        if os.path.exists(manifest):
+            return
+        tmp = f"{manifest}.{uuid.uuid4().hex}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(hashes, f)
+        os.replace(tmp, manifest)
+
+    def chunk_hashes(self, digest: str, chunk_size: int) -> List[str]:
+        """SHA-256 частей файла по chunk_size байт
+
+        Для self.chunk_size они сохранены при записи; для другого размера
+        вычисляются один раз и тоже сохраняются рядом с файлом.
+        """
+        try:
+            with open(self._manifest(digest, chunk_size), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        hashes = []
+        with open(self.path(digest), "rb") as f:
+            while True:
+                chunk, left = hashlib.sha256(), chunk_size
+                while left and (data := f.read(min(left, 1024 * 1024))):
+                    chunk.update(data)
+                    left -= len(data)
+                if left == chunk_size:
+                    break
+                hashes.append(chunk.hexdigest())
+        self.save_chunk_hashes(digest, chunk_size, hashes)
+        return hashes
+
+    def name(self, filename: str, digest: str, size: int) -> str:
+        """Имя для содержимого в индексе: прежнее при совпадении, иначе свободное"""
+        filename = os.path.basename(filename)
+        stem, ext = os.path.splitext(filename)
+        conn = self._connect()
+        number = 1
+        while True:
+            candidate = filename if number == 1 else f"{stem} ({number}){ext}"
+            # Файл из uploads/, созданный до индекса, тоже занимает имя
+            if candidate not in (BLOB_FOLDER, ".sessions") and not os.path.isfile(os.path.join(self.root, candidate)):
+                with conn:
+                    conn.execute("INSERT OR IGNORE INTO names (name, digest, size, created) VALUES (?, ?, ?, ?)",
+                                 (candidate, digest, size, time.time()))
+                    row = conn.execute("SELECT digest FROM names WHERE name = ?", (candidate,)).fetchone()
+                if row[0] == digest:
+                    return candidate
+            number += 1
+
+    def resolve(self, filename: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Путь к файлу по имени и его хэш (None для файлов до индекса)"""
+        row = self._connect().execute("SELECT digest FROM names WHERE name = ?", (filename,)).fetchone()
+        if row is not None:
+            return self.path(row[0]), row[0]
+        legacy = os.path.join(self.root, os.path.basename(filename))
+        if os.path.isfile(legacy):
+            return legacy, None
+        return None
@@ -6,15 +6,70 @@ import json
 from rich.console import Console
 from rich.table import Table
 from rich.live import Live
+from rich.progress import (BarColumn, DownloadColumn, Progress, TextColumn, TimeRemainingColumn,
+                           TransferSpeedColumn)
 from rich import print as rprint
 import pyperclip
 from rich.prompt import Prompt
 import threading
-from msg_server import MessageBroadcaster
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from msg_server import broadcaster, history
+from wire import DEFAULT_ROOM
+from sync import sync_with_peers
+from presence import OFFLINE, ONLINE
+from transfer import MultipartFile, file_sha256, read_range, split_ranges
+from blobs import is_digest
+from swarm import SwarmDownload, find_peers
 import re
 
 console = Console()
 
+UPLOAD_WORKERS = 4  # Сколько частей файла отправлять параллельно
+CHUNK_RETRIES = 3  # Сколько раз повторять часть с неверной контрольной суммой или ошибкой сети
+DOWNLOAD_WORKERS = 8  # Сколько диапазонов скачивать параллельно
+MIN_SEGMENT = 4 * 1024 * 1024  # Меньшие файлы не делятся на части
+MAX_SEGMENT = 64 * 1024 * 1024  # При обрыве повторяется не больше одной такой части
+DOWNLOAD_BLOCK = 1024 * 1024  # Размер блока при потоковой записи
+
+
+class TransferProgress:
+    """Индикатор передачи файла: объем, скорость и оставшееся время
+
+    advance можно вызывать из нескольких потоков.
+    """
+
+    def __init__(self, description: str, total: int, completed: int = 0):
+        self.progress = Progress(TextColumn("{task.description}"), BarColumn(), DownloadColumn(),
+                                 TransferSpeedColumn(), TimeRemainingColumn(), console=console)
+        self.task = self.progress.add_task(description, total=total, completed=completed)
+        self.transferred = 0
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._elapsed = 0.0
+
+    def __enter__(self):
+        self.progress.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._elapsed = time.monotonic() - self._started
+        self.progress.stop()
+
+    def advance(self, size: int):
+        with self._lock:
+            self.transferred += size
+        self.progress.advance(self.task, size)
+
+    def summary(self) -> str:
+        """Итог: сколько передано, за какое время и с какой скоростью"""
+        megabytes = self.transferred / (1024 * 1024)
+        elapsed = max(self._elapsed, 1e-6)
+        return f"{megabytes:.1f} МБ за {elapsed:.1f} с, {megabytes / elapsed:.1f} МБ/с"
+
 
 class CommandHandler:
     def __init__(self, host, port):
@@ -24,16 +79,33 @@ class CommandHandler:
         self.ws_base_url = f"ws://{host}:{port}"
         self.chat_task = None
         self.username = None
-        try:
-            self.message_broadcaster = MessageBroadcaster()  # Не нужно указывать порт
-        except Exception as e:
-            rprint(
-                f"[red]Не удалось инициализировать широковещатель сообщений: {e}[/red]")
-            raise
+        # Общий широковещатель сервера: второй сокет на том же порту делил бы датаграммы с сервером
+        self.message_broadcaster = broadcaster
+
+    def subscribe_messages(self, callback: Callable) -> Callable[[], None]:
+        """Подписка на входящие сообщения общего широковещателя; возвращает функцию отписки
+
+        callback(message, addr) вызывается в цикле событий сервера.
+        """
+        loop = self.message_broadcaster.loop
+        if loop is None:
+            raise RuntimeError("Сервер сообщений еще не запущен")
+
+        async def consume(subscription):
+            async for message, addr in subscription:
+                callback(message, addr)
+
+        async def subscribe():
+            subscription = self.message_broadcaster.subscribe()
+            asyncio.ensure_future(consume(subscription))
+            return subscription
+
+        subscription = asyncio.run_coroutine_threadsafe(subscribe(), loop).result(timeout=5)
+        return lambda: loop.call_soon_threadsafe(subscription.close)
 
     async def ws_handle_chat(self):
         """Обработка сообщений чата"""
-        uri = f"{self.ws_base_url}/message/ws"
+        uri = f"{self.ws_base_url}/message/ws?batch=true"
         async with websockets.connect(uri) as ws:
             rprint("[green]✓[/green] Подключен к чат-комнате")
             # Задача для получения сообщений
@@ -43,8 +115,10 @@ class CommandHandler:
                     try:
                         msg = await ws.recv()
                         data = json.loads(msg)
-                        rprint(
-                            f"\n[bold blue]{data['username']}[/bold blue]: {data['message']}")
+                        # Отстающему клиенту сервер присылает накопленные сообщения массивом
+                        for item in data if isinstance(data, list) else [data]:
+                            rprint(
+                                f"\n[bold blue]{item['username']}[/bold blue]: {item['message']}")
                         print(">>> ", end='', flush=True)
                     except Exception as e:
                         rprint(f"[red]Ошибка получения сообщения: {e}[/red]")
@@ -61,20 +135,20 @@ class CommandHandler:
                         if message.lower() in ['/quit', '/exit']:
                             break
                         # Включение имени пользователя при отправке сообщения
-                        await ws.send_json({
+                        await ws.send(json.dumps({
                             "username": self.username,
                             "message": message
-                        })
+                        }))
                     except Exception as e:
                         rprint(f"[red]Ошибка отправки сообщения: {e}[/red]")
                         break
 
             try:
                 # Отправка уведомления о входе в чат-комнату
-                await ws.send_json({
+                await ws.send(json.dumps({
                     "username": "system",
                     "message": f"{self.username} вошел в чат-комнату"
-                })
+                }))
 
                 # Параллельный запуск отправки и получения сообщений
                 await asyncio.gather(
@@ -86,17 +160,20 @@ class CommandHandler:
             finally:
                 # Отправка уведомления о выходе из чат-комнаты
                 try:
-                    await ws.send_json({
+                    await ws.send(json.dumps({
                         "username": "system",
                         "message": f"{self.username} покинул чат-комнату"
-                    })
+                    }))
                 except:
                     pass
 
-    def boardcast_start_chat(self):
-        """Запуск клиента чата"""
+    def boardcast_start_chat(self, room: str = None):
+        """Запуск клиента чата
+        room: название комнаты (своя multicast-группа), по умолчанию общая
+        """
         if not self.username:
             self.username = Prompt.ask("Введите ваше имя пользователя")
+        room = room or DEFAULT_ROOM
 
         def handle_message(message: dict, addr):
             username = message.get('username', 'Неизвестно')
@@ -105,9 +182,26 @@ class CommandHandler:
                 rprint(f"\n[bold blue]{username}[/bold blue]: {msg}")
                 print(">>> ", end='', flush=True)
 
+        # Догружаем историю, пропущенную, пока узел был выключен
         try:
-            # Запуск широковещателя сообщений
-            self.message_broadcaster.start(handle_message)
+            devices = requests.get(f"{self.base_url}/discovery/devices", timeout=5).json()
+            synced = sync_with_peers(history, devices)
+            if synced:
+                rprint(f"[green]✓[/green] Получено сообщений из истории других узлов: {len(synced)}")
+        except Exception as e:
+            rprint(f"[yellow]Синхронизация истории не выполнена: {e}[/yellow]")
+
+        # Последние сообщения комнаты из сохраненной истории
+        for message in history.query(room=room, limit=20):
+            if message.get('username') != 'system':
+                rprint(f"[dim]{message.get('username', 'Неизвестно')}: {message.get('message', '')}[/dim]")
+
+        unsubscribe = None
+        try:
+            # Вход в комнату и подписка на сообщения общего широковещателя
+            self.message_broadcaster.set_room(room)
+            self.message_broadcaster.set_presence(ONLINE, self.username)
+            unsubscribe = self.subscribe_messages(handle_message)
 
             # Отправка уведомления о входе
             self.message_broadcaster.broadcast({
@@ -116,7 +210,7 @@ class CommandHandler:
             })
 
             rprint(
-                "[green]✓[/green] Чат запущен! Введите сообщения (Ctrl+C для выхода)")
+                f"[green]✓[/green] Чат запущен в комнате [bold]{room}[/bold]! Введите сообщения (Ctrl+C для выхода)")
 
             # Основной цикл чата
             while True:
@@ -143,7 +237,10 @@ class CommandHandler:
                     "username": "system",
                     "message": f"{self.username} покинул чат"
                 })
-                self.message_broadcaster.stop()
+                # Широковещатель продолжает работать на сервер; соседи узнают о выходе по heartbeat
+                self.message_broadcaster.set_presence(OFFLINE)
+                if unsubscribe:
+                    unsubscribe()
             except:
                 pass
             rprint("[yellow]Чат завершен[/yellow]")
@@ -155,16 +252,20 @@ class CommandHandler:
             if response.status_code == 200:
                 devices = response.json()
                 if devices:
+                    presence = self.get_presence()
                     table = Table(title="Онлайн устройства")
                     table.add_column("Имя устройства")
                     table.add_column("IP адрес")
                     table.add_column("Порт")
+                    table.add_column("Статус")
 
                     for device in devices:
                         table.add_row(
                             device['name'],
                             device['ip'],
-                            str(device['port'])
+                            str(device['port']),
+                            ", ".join(f"{peer['username']} ({peer['state']})"
+                                      for peer in presence if peer['ip'] == device['ip'])
                         )
                     console.print(table)
                 else:
@@ -176,6 +277,10 @@ class CommandHandler:
         except Exception as e:
             rprint(f"[red]Ошибка получения списка устройств: {e}[/red]")
 
+    def get_presence(self) -> list:
+        """Присутствие участников по heartbeat из широковещателя чата (он же отвечает на /message/presence)"""
+        return self.message_broadcaster.peers.peers()
+
     def get_target_device(self, param: str = None) -> tuple:
         """Получение IP и порта целевого устройства
         param: может быть номером устройства (-n) или форматом IP:порт
@@ -262,23 +367,93 @@ class CommandHandler:
                 return
 
             ip, port = target
+            url = f"http://{ip}:{port}/file/upload"
+
+            if self.upload_resumable(file_path, url):
+                return
 
-            with open(file_path, "rb") as file:
-                files = {"file": file}
-                url = f"http://{ip}:{port}/file/upload"
-                response = requests.post(url, files=files)
+            # Сервер без загрузки по частям: multipart читается с диска по блокам
+            size = os.path.getsize(file_path)
+            with TransferProgress(os.path.basename(file_path), size) as progress:
+                body = MultipartFile(file_path, on_progress=progress.advance)
+                response = requests.post(url, data=body, headers={"Content-Type": body.content_type})
 
-                if response.status_code == 200:
-                    rprint(f"[green]✓[/green] Файл успешно загружен!")
-                else:
-                    rprint(
-                        f"[red]Загрузка файла не удалась: {response.status_code}[/red]")
+            if response.status_code == 200:
+                rprint(f"[green]✓[/green] Файл успешно загружен! ({progress.summary()})")
+            else:
+                rprint(
+                    f"[red]Загрузка файла не удалась: {response.status_code}[/red]")
 
         except FileNotFoundError:
             rprint(f"[red]Файл не найден: {file_path}[/red]")
         except Exception as e:
             rprint(f"[red]Ошибка загрузки файла: {e}[/red]")
 
+    def upload_resumable(self, file_path: str, url: str) -> bool:
+        """Загрузка по частям с докачкой; False, если сервер не поддерживает сессии
+
+        Ключ сессии зависит от пути, размера и времени изменения файла, поэтому
+        повторный запуск той же команды продолжает прерванную загрузку. Вместе
+        с сессией передается SHA-256 файла: если такой файл на сервере уже
+        есть, данные не отправляются.
+        """
+        stat = os.stat(file_path)
+        key = hashlib.sha256(
+            f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:32]
+        response = requests.post(f"{url}/sessions", json={
+            "filename": os.path.basename(file_path), "size": stat.st_size, "key": key,
+            "sha256": file_sha256(file_path)}, timeout=10)
+        if response.status_code in (404, 405):
+            return False
+        response.raise_for_status()
+        session = response.json()
+        if session.get("exists"):
+            rprint(f"[green]✓[/green] Файл уже есть на сервере: {session['filename']}")
+            return True
+        session_url = f"{url}/sessions/{session['session']}"
+
+        chunks = split_ranges([tuple(r) for r in session["missing"]], session["chunk_size"])
+        if session["received"]:
+            rprint(f"[yellow]Продолжение загрузки: осталось частей {len(chunks)}[/yellow]")
+
+        def send(chunk):
+            # Часть не держится в памяти: сумма считается первым проходом,
+            # затем тело отправляется генератором (второе чтение идет из кэша ОС)
+            start, end = chunk
+            digest = hashlib.sha256()
+            for data in read_range(file_path, start, end):
+                digest.update(data)
+            for attempt in range(CHUNK_RETRIES):
+                sent = 0
+
+                def body():
+                    nonlocal sent
+                    for data in read_range(file_path, start, end):
+                        yield data
+                        sent += len(data)
+                        progress.advance(len(data))
+
+                try:
+                    result = requests.put(session_url, params={"offset": start}, data=body(),
+                                          headers={"X-Chunk-SHA256": digest.hexdigest()}, timeout=60)
+                    if result.status_code == 200:
+                        return
+                except requests.RequestException:
+                    if attempt == CHUNK_RETRIES - 1:
+                        raise
+                progress.advance(-sent)  # Часть будет отправлена заново
+            result.raise_for_status()
+
+        remaining = sum(end - start for start, end in chunks)
+        with TransferProgress(session["filename"], stat.st_size, stat.st_size - remaining) as progress:
+            with ThreadPoolExecutor(UPLOAD_WORKERS) as pool:
+                list(pool.map(send, chunks))
+
+        response = requests.post(f"{session_url}/commit", timeout=60)
+        response.raise_for_status()
+        rprint(f"[green]✓[/green] Файл успешно загружен как {response.json()['filename']}! ({progress.summary()})")
+        return True
+
     def download_file(self, file_name: str, source: str):
         """Скачивание файла
         file_name: имя файла для скачивания
@@ -287,20 +462,125 @@ class CommandHandler:
         try:
             ip, port = source.split(':')
             url = f"http://{ip}:{port}/file/download/{file_name}"
-            response = requests.get(url)
-
-            if response.status_code == 200:
-                # Сохранение файла
-                with open(file_name, "wb") as f:
-                    f.write(response.content)
-                rprint(f"[green]✓[/green] Файл {file_name} успешно скачан!")
-            else:
-                rprint(
-                    f"[red]Скачивание файла не удалось: {response.status_code}[/red]")
+            if self.download_swarm(url, file_name, f"http://{ip}:{port}"):
+                return
+            size = self.download_segmented(url, file_name)
+            if size is None:
+                return
+            rprint(f"[green]✓[/green] Файл {file_name} успешно скачан!")
 
         except Exception as e:
             rprint(f"[red]Ошибка скачивания файла: {e}[/red]")
 
+    def download_swarm(self, url: str, file_path: str, source_url: str) -> bool:
+        """Скачивание с нескольких узлов сразу; False, если файл есть только у одного
+
+        Хэш содержимого берется из ETag источника, узлы с тем же файлом
+        находятся среди обнаруженных устройств. Ошибка при поиске узлов тоже
+        возвращает False: файл скачивается только с источника.
+        """
+        try:
+            with requests.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=10) as probe:
+                digest = probe.headers.get("ETag", "").strip('"')
+            if not is_digest(digest):
+                return False  # Файл на источнике не из хранилища по содержимому
+            if os.path.isfile(file_path) and file_sha256(file_path) == digest:
+                rprint(f"[green]✓[/green] Файл {file_path} уже скачан и не изменился")
+                return True
+
+            devices = requests.get(f"{self.base_url}/discovery/devices", timeout=5).json()
+            peers, manifest = find_peers(
+                digest, [source_url] + [f"http://{device['ip']}:{device['port']}" for device in devices])
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            rprint(f"[yellow]Не удалось найти другие узлы ({e}), скачивание с источника[/yellow]")
+            return False
+        if len(peers) < 2:
+            return False
+
+        rprint(f"[cyan]Файл есть у узлов: {len(peers)}, скачивание со всех сразу[/cyan]")
+        with TransferProgress(file_path, manifest["size"]) as progress:
+            SwarmDownload(digest, manifest, peers, file_path, on_progress=progress.advance).run()
+        rprint(f"[green]✓[/green] Файл {file_path} успешно скачан! ({progress.summary()})")
+        for peer in sorted(peers, key=lambda peer: peer.received, reverse=True):
+            rprint(f"  {peer.base_url}: {peer.received / (1024 * 1024):.1f} МБ")
+        return True
+
+    def download_segmented(self, url: str, file_path: str):
+        """Скачивание несколькими диапазонами параллельно; возвращает размер или None
+
+        Файл заранее создается полного размера, каждая часть пишется по своему
+        смещению потоком, поэтому память не зависит от размера файла. Данные
+        пишутся в file_path.part и переносятся на место только целиком.
+        Если file_path уже есть и совпадает с файлом на сервере (ETag — хэш
+        содержимого), скачивание пропускается.
+        """
+        # Первый байт: узнаем размер, версию файла и поддержку диапазонов
+        headers = {"Range": "bytes=0-0"}
+        if os.path.isfile(file_path):
+            headers["If-None-Match"] = f'"{file_sha256(file_path)}"'
+        probe = requests.get(url, headers=headers, stream=True, timeout=10)
+        part_path = file_path + ".part"
+        with probe:
+            if probe.status_code == 304:
+                rprint(f"[green]✓[/green] Файл {file_path} уже скачан и не изменился")
+                return None
+            if probe.status_code == 416:  # Пустой файл
+                size = int(probe.headers.get("Content-Range", "*/0").rsplit("/", 1)[1])
+                ranges = []
+            elif probe.status_code == 206:
+                size = int(probe.headers["Content-Range"].rsplit("/", 1)[1])
+                ranges = [(0, size)]
+            elif probe.status_code == 200:
+                # Сервер без Range: один поток
+                with open(part_path, "wb") as f:
+                    for data in probe.iter_content(DOWNLOAD_BLOCK):
+                        f.write(data)
+                os.replace(part_path, file_path)
+                return os.path.getsize(file_path)
+            else:
+                rprint(f"[red]Скачивание файла не удалось: {probe.status_code}[/red]")
+                return None
+            validator = probe.headers.get("ETag") or probe.headers.get("Last-Modified")
+
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        segment = max(MIN_SEGMENT, min(-(-size // DOWNLOAD_WORKERS), MAX_SEGMENT))
+
+        def fetch(chunk):
+            start, end = chunk
+            headers = {"Range": f"bytes={start}-{end - 1}"}
+            if validator:
+                headers["If-Range"] = validator
+            for attempt in range(CHUNK_RETRIES):
+                try:
+                    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                        if response.status_code != 206:
+                            # 200 в ответ на If-Range: файл на сервере изменился
+                            raise RuntimeError(f"сервер вернул {response.status_code} вместо части файла")
+                        if not response.headers.get("Content-Range", "").startswith(f"bytes {start}-"):
+                            content_range = response.headers.get("Content-Range")
+                            raise RuntimeError(f"сервер вернул не ту часть файла: {content_range}")
+                        with open(part_path, "r+b") as f:
+                            f.seek(start)
+                            position = start
+                            for data in response.iter_content(DOWNLOAD_BLOCK):
+                                # Лишние байты (сервер вернул больше диапазона) за границу части не пишутся
+                                f.write(data[:max(0, end - position)])
+                                position += len(data)
+                                if position >= end:
+                                    break
+                        if position >= end:
+                            return
+                except requests.RequestException:
+                    pass
+                if attempt == CHUNK_RETRIES - 1:
+                    raise RuntimeError(f"не удалось получить байты {start}-{end - 1}")
+
+        with ThreadPoolExecutor(DOWNLOAD_WORKERS) as pool:
+            list(pool.map(fetch, split_ranges(ranges, segment)))
+        os.replace(part_path, file_path)
+        return size
+
     def show_help(self):
         """Показать справочную информацию"""
         help_table = Table(title="Справка по командам")
@@ -309,7 +589,7 @@ class CommandHandler:
         help_table.add_column("Использование")
 
         commands = [
-            ("chat", "Войти в режим группового чата", "/chat"),
+            ("chat", "Войти в режим группового чата", "/chat [комната]"),
             ("devices", "Показать онлайн устройства", "/devices"),
             ("upload", "Загрузить файл", "/upload <путь_к_файлу>"),
             ("download", "Скачать файл", "/download <имя_файла>"),
@@ -0,0 +1,373 @@
+"""Состояние приемной стороны широковещательного чата
+
+Компоненты не работают с сокетами и не зависят от FastAPI, поэтому их можно
+использовать как из потока приема, так и из цикла событий asyncio.
+"""
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+
+class DedupCache:
+    """Кэш идентификаторов недавно доставленных сообщений (LRU + окно по времени)
+
+    Все операции выполняются за O(1): OrderedDict хранит ключи в порядке
+    последнего обращения, поэтому устаревшие и лишние записи всегда в начале.
+    """
+
+    def __init__(self, capacity: int = 4096, window: float = 60.0):
+        self.capacity = capacity
+        self.window = window
+        self._seen: "OrderedDict[Hashable, float]" = OrderedDict()
+        self.duplicates = 0
+
+    def check(self, key: Hashable, now: Optional[float] = None) -> bool:
+        """True, если сообщение уже было доставлено (повтор учитывается в счетчике)"""
+        now = time.monotonic() if now is None else now
+        seen = self._seen.get(key)
+        if seen is None:
+            return False
+        if now - seen > self.window:
+            del self._seen[key]
+            return False
+        self.duplicates += 1
+        return True
+
+    def add(self, key: Hashable, now: Optional[float] = None):
+        """Запомнить доставленное сообщение"""
+        now = time.monotonic() if now is None else now
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while self._seen:
+            oldest_key, oldest = next(iter(self._seen.items()))
+            if len(self._seen) <= self.capacity and now - oldest <= self.window:
+                break
+            del self._seen[oldest_key]
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class _Partial:
+    """Незавершенное фрагментированное сообщение"""
+
+    __slots__ = ('created', 'count', 'total', 'chunks', 'received', 'size')
+
+    def __init__(self, count: int, total: int, now: float):
+        self.created = now
+        self.count = count
+        self.total = total
+        self.chunks: Dict[int, bytes] = {}
+        self.received = 0
+        self.size = 0
+
+
+class Reassembler:
+    """Сборка фрагментированных сообщений с таймаутом и ограничением памяти"""
+
+    FRAGMENT_OVERHEAD = 64  # Учет накладных расходов на хранение одного фрагмента
+
+    def __init__(self, timeout: float = 5.0, max_bytes: int = 8 * 1024 * 1024,
+                 max_message_size: int = 1024 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_message_size = max_message_size
+        self.buffered_bytes = 0
+        self._partials: "OrderedDict[Hashable, _Partial]" = OrderedDict()
+        self.stats: Dict[str, int] = {"completed": 0, "expired": 0, "evicted": 0, "rejected": 0}
+
+    def add(self, key: Hashable, index: int, count: int, total: int, chunk: bytes,
+            now: Optional[float] = None) -> Optional[bytes]:
+        """Добавить фрагмент; возвращает собранную нагрузку, когда пришли все фрагменты"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+
+        if total > self.max_message_size:
+            self.stats["rejected"] += 1
+            return None
+
+        partial = self._partials.get(key)
+        if partial is None:
+            partial = _Partial(count, total, now)
+            self._partials[key] = partial
+        elif partial.count != count or partial.total != total:
+            # Фрагменты не согласуются между собой — сообщение испорчено
+            self._drop(key)
+            self.stats["rejected"] += 1
+            return None
+
+        if index in partial.chunks:
+            return None  # Повтор уже полученного фрагмента
+        partial.chunks[index] = chunk
+        partial.received += 1
+        size = len(chunk) + self.FRAGMENT_OVERHEAD
+        partial.size += size
+        self.buffered_bytes += size
+
+        if partial.received == partial.count:
+            self._drop(key)
+            payload = b''.join(partial.chunks[i] for i in range(partial.count))
+            if len(payload) != partial.total:
+                self.stats["rejected"] += 1
+                return None
+            self.stats["completed"] += 1
+            return payload
+
+        # Вытеснение самых старых незавершенных сообщений при превышении лимита памяти
+        while self.buffered_bytes > self.max_bytes and self._partials:
+            oldest = next(iter(self._partials))
+            self._drop(oldest)
+            self.stats["evicted"] += 1
+        return None
+
+    def __len__(self):
+        return len(self._partials)
+
+    def _expire(self, now: float):
+        """Удаление сообщений, фрагменты которых не пришли за отведенное время"""
+        while self._partials:
+            key, partial = next(iter(self._partials.items()))
+            if now - partial.created <= self.timeout:
+                break
+            self._drop(key)
+            self.stats["expired"] += 1
+
+    def _drop(self, key: Hashable):
+        partial = self._partials.pop(key)
+        self.buffered_bytes -= partial.size
+
+
+class _SenderState:
+    """Состояние нумерации одного отправителя"""
+
+    __slots__ = ('highest', 'missing')
+
+    def __init__(self, highest: int):
+        self.highest = highest
+        # seq -> [время следующего NACK, число отправленных NACK]
+        self.missing: "OrderedDict[int, list]" = OrderedDict()
+
+
+class GapTracker:
+    """Обнаружение пропусков в нумерации сообщений и планирование NACK
+
+    Первый NACK отправляется с небольшой задержкой, чтобы не запрашивать
+    сообщения, которые просто пришли не по порядку или еще собираются из
+    фрагментов. После max_attempts безуспешных запросов номер считается потерянным.
+    """
+
+    def __init__(self, nack_delay: float = 0.05, nack_interval: float = 0.25, max_attempts: int = 5,
+                 max_gap: int = 1024, max_senders: int = 1024):
+        self.nack_delay = nack_delay
+        self.nack_interval = nack_interval
+        self.max_attempts = max_attempts
+        self.max_gap = max_gap
+        self.max_senders = max_senders
+        self._senders: "OrderedDict[Hashable, _SenderState]" = OrderedDict()
+        self.stats: Dict[str, int] = {"lost": 0, "repaired": 0, "nacked": 0, "duplicates": 0}
+
+    def announce(self, sender: Hashable, seq: int, now: Optional[float] = None):
+        """Отправитель уже отправил все номера до seq включительно; недостающие становятся пропусками"""
+        now = time.monotonic() if now is None else now
+        state = self._senders.get(sender)
+        if state is None:
+            # Новый отправитель: историю до момента подключения не восстанавливаем
+            self._add_sender(sender, seq)
+            return
+        self._senders.move_to_end(sender)
+        if seq > state.highest:
+            self._mark_missing(state, state.highest + 1, seq + 1, now)
+            state.highest = seq
+
+    def receive(self, sender: Hashable, seq: int, now: Optional[float] = None) -> bool:
+        """Учесть полученное сообщение; False для повторов"""
+        now = time.monotonic() if now is None else now
+        state = self._senders.get(sender)
+        if state is None:
+            self._add_sender(sender, seq)
+            return True
+        self._senders.move_to_end(sender)
+
+        if seq > state.highest:
+            self._mark_missing(state, state.highest + 1, seq, now)
+            state.highest = seq
+            return True
+        entry = state.missing.pop(seq, None)
+        if entry is not None:
+            if entry[1]:
+                self.stats["repaired"] += 1
+            return True
+        self.stats["duplicates"] += 1
+        return False
+
+    def suppress(self, sender: Hashable, seqs, now: Optional[float] = None):
+        """Другой узел уже запросил эти номера — откладываем собственный NACK"""
+        now = time.monotonic() if now is None else now
+        state = self._senders.get(sender)
+        if state is None:
+            return
+        for seq in seqs:
+            entry = state.missing.get(seq)
+            if entry is not None:
+                entry[0] = max(entry[0], now + self.nack_interval)
+
+    def due_nacks(self, now: Optional[float] = None) -> Dict[Hashable, List[int]]:
+        """Номера, для которых пора отправить NACK, сгруппированные по отправителям"""
+        now = time.monotonic() if now is None else now
+        due: Dict[Hashable, List[int]] = {}
+        for sender, state in self._senders.items():
+            for seq, entry in list(state.missing.items()):
+                if entry[0] > now:
+                    continue
+                if entry[1] >= self.max_attempts:
+                    del state.missing[seq]
+                    self.stats["lost"] += 1
+                    continue
+                entry[0] = now + self.nack_interval
+                entry[1] += 1
+                self.stats["nacked"] += 1
+                due.setdefault(sender, []).append(seq)
+        return due
+
+    def missing_count(self) -> int:
+        return sum(len(state.missing) for state in self._senders.values())
+
+    def _add_sender(self, sender: Hashable, highest: int):
+        self._senders[sender] = _SenderState(highest)
+        while len(self._senders) > self.max_senders:
+            _, state = self._senders.popitem(last=False)
+            self.stats["lost"] += len(state.missing)
+
+    def _mark_missing(self, state: _SenderState, start: int, stop: int, now: float):
+        """Пометить номера [start, stop) как пропущенные"""
+        if stop - start > self.max_gap:
+            # Слишком большой разрыв (например, долгое отсутствие) — старые номера не восстанавливаем
+            self.stats["lost"] += stop - start - self.max_gap
+            start = stop - self.max_gap
+        for seq in range(start, stop):
+            if seq not in state.missing:
+                state.missing[seq] = [now + self.nack_delay, 0]
+        while len(state.missing) > self.max_gap:
+            state.missing.popitem(last=False)
+            self.stats["lost"] += 1
+
+
+class SendWindow:
+    """Ограниченное окно недавно отправленных сообщений для повторной передачи"""
+
+    def __init__(self, size: int = 512, min_interval: float = 0.05):
+        self.size = size
+        self.min_interval = min_interval
+        # seq -> [датаграммы, время последней отправки]
+        self._sent: "OrderedDict[int, list]" = OrderedDict()
+
+    def add(self, seq: int, datagrams: List[bytes], now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._sent[seq] = [datagrams, now]
+        while len(self._sent) > self.size:
+            self._sent.popitem(last=False)
+
+    def retransmit(self, seq: int, now: Optional[float] = None) -> Optional[List[bytes]]:
+        """Датаграммы для повтора; None, если сообщение вышло из окна или только что повторялось"""
+        now = time.monotonic() if now is None else now
+        entry = self._sent.get(seq)
+        if entry is None or now - entry[1] < self.min_interval:
+            return None
+        entry[1] = now
+        return entry[0]
+
+    def __len__(self):
+        return len(self._sent)
+
+
+class RateLimiter:
+    """Ограничение частоты датаграмм от каждого отправителя (token bucket)
+
+    Проверка выполняется до разбора датаграммы, поэтому шумный узел тратит
+    только стоимость одного обращения к словарю на каждую лишнюю датаграмму.
+    """
+
+    def __init__(self, rate: float = 200.0, burst: float = 1000.0, max_senders: int = 4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_senders = max_senders
+        # отправитель -> [токены, время последнего пополнения, отброшено]
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+        self.dropped = 0
+
+    def allow(self, sender: Hashable, now: Optional[float] = None) -> bool:
+        """Можно ли принять очередную датаграмму отправителя"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            bucket = self._buckets[sender] = [self.burst, now, 0]
+            while len(self._buckets) > self.max_senders:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(sender)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        bucket[2] += 1
+        self.dropped += 1
+        return False
+
+    def throttled(self) -> Dict[Hashable, int]:
+        """Отправители, датаграммы которых отбрасывались, и число отброшенных"""
+        return {sender: bucket[2] for sender, bucket in list(self._buckets.items()) if bucket[2]}
+
+
+class ReorderBuffer:
+    """Буфер, выпускающий сообщения в порядке логических часов Лэмпорта
+
+    Каждое сообщение задерживается не дольше hold секунд: за это время
+    успевают прийти сообщения с меньшим clock (например, вопрос, на который
+    уже пришел ответ). Сообщение, опоздавшее сильнее, выпускается сразу.
+    """
+
+    def __init__(self, hold: float = 0.15, max_size: int = 1024):
+        self.hold = hold
+        self.max_size = max_size
+        self._heap: list = []
+        self._counter = itertools.count()
+        self._released = (-1, -1)
+        self._max_clock = -1
+        self.stats: Dict[str, int] = {"reordered": 0, "late": 0}
+
+    def push(self, clock: int, item, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        key = (clock, next(self._counter))
+        if clock < self._max_clock:
+            self.stats["reordered"] += 1  # Пришло раньше сообщения, которое должно идти после него
+        self._max_clock = max(self._max_clock, clock)
+        heapq.heappush(self._heap, (key, now + self.hold, item))
+
+    def pop_ready(self, now: Optional[float] = None) -> list:
+        """Сообщения, которые можно выпустить, в причинном порядке"""
+        now = time.monotonic() if now is None else now
+        ready = []
+        while self._heap:
+            key, deadline, item = self._heap[0]
+            late = key < self._released
+            if deadline > now and not late and len(self._heap) <= self.max_size:
+                break
+            heapq.heappop(self._heap)
+            if late:
+                self.stats["late"] += 1
+            else:
+                self._released = key
+            ready.append(item)
+        return ready
+
+    def next_deadline(self) -> Optional[float]:
+        """Когда истечет задержка ближайшего сообщения"""
+        return self._heap[0][1] if self._heap else None
+
+    def __len__(self):
+        return len(self._heap)
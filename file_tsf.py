@@ -1,30 +1,208 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import FileResponse
+from fastapi import Body, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import Response
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from email.utils import formatdate
 import os
+from typing import Optional
+from urllib.parse import quote
+from blobs import BlobStore
+from transfer import (DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, ChecksumError, FileCache, UploadSession,
+                      not_modified, parse_range, read_range)
 
 app = FastAPI()
 UPLOAD_FOLDER = "uploads"
+SESSION_FOLDER = os.path.join(UPLOAD_FOLDER, ".sessions")  # Незавершенные загрузки по частям
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(SESSION_FOLDER, exist_ok=True)
+blobs = BlobStore(UPLOAD_FOLDER)  # Файлы по SHA-256 и индекс имен
+cache = FileCache()  # Маленькие часто скачиваемые файлы (аватары, миниатюры)
+
+
+def _stored(filename: str, digest: str, size: int, added: bool) -> dict:
+    """Запись имени в индекс и ответ клиенту; exists — такое содержимое уже было"""
+    return {"filename": blobs.name(filename, digest, size), "size": size, "sha256": digest, "exists": not added}
 
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-
-    # Запись по частям (избежать переполнения памяти)
-    with open(file_path, "wb") as buffer:
+    # Запись по частям (избежать переполнения памяти), хэши файла и его частей считаются по ходу
+    with blobs.writer() as writer:
         while chunk := await file.read(1024 * 1024):  # 1MB части
-            buffer.write(chunk)
+            await run_in_threadpool(writer.write, chunk)
+        digest, added = await run_in_threadpool(writer.commit)
+
+    return _stored(file.filename, digest, writer.size, added)
+
+
+def _session(session_id: str) -> UploadSession:
+    session = UploadSession.load(SESSION_FOLDER, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Сессия загрузки не найдена")
+    return session
+
+
+@app.post("/upload/sessions")
+async def create_upload_session(filename: str = Body(...), size: int = Body(...),
+                                chunk_size: Optional[int] = Body(None), key: Optional[str] = Body(None),
+                                sha256: Optional[str] = Body(None)):
+    """Начать загрузку по частям; с тем же key продолжается незавершенная загрузка
+
+    Если sha256 уже есть в хранилище, загрузка завершается сразу (exists). По
+    умолчанию части совпадают с частями хранилища, и их проверенные хэши
+    сохраняются для скачивания с нескольких узлов без чтения файла.
+    """
+    if sha256 is not None and blobs.size(sha256.lower()) == size:
+        return _stored(filename, sha256.lower(), size, added=False)
+    try:
+        session = UploadSession.create(SESSION_FOLDER, filename, size, chunk_size or blobs.chunk_size, key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return session.status()
+
+
+@app.get("/upload/sessions/{session_id}")
+async def get_upload_session(session_id: str):
+    """Полученные и недостающие диапазоны"""
+    return _session(session_id).status()
+
+
+@app.put("/upload/sessions/{session_id}")
+async def put_upload_chunk(session_id: str, offset: int, request: Request):
+    """Часть файла по смещению; заголовок X-Chunk-SHA256 — контрольная сумма части"""
+    session = _session(session_id)
+    try:
+        length = await session.write(offset, request.stream(), request.headers.get("x-chunk-sha256"))
+    except ChecksumError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"offset": offset, "length": length}
+
+
+@app.post("/upload/sessions/{session_id}/commit")
+async def commit_upload_session(session_id: str):
+    """Завершить загрузку: файл появляется в хранилище только после получения всех частей"""
+    session = _session(session_id)
+    try:
+        digest, added = await run_in_threadpool(session.commit, blobs)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return _stored(session.meta["filename"], digest, session.meta["size"], added)
+
+
+@app.delete("/upload/sessions/{session_id}")
+async def discard_upload_session(session_id: str):
+    """Отменить загрузку"""
+    _session(session_id).discard()
+    return {"session": session_id}
 
-    return {"filename": file.filename, "size": os.path.getsize(file_path)}
+
+class ZeroCopyFileResponse(Response):
+    """Диапазон файла без копирования через пространство пользователя
+
+    Если ASGI-сервер поддерживает расширение http.response.zerocopysend,
+    ядро само отправляет файл в сокет (sendfile); иначе файл читается
+    блоками в пуле потоков.
+    """
+
+    def __init__(self, path: str, start: int, end: int, status_code: int = 200, headers: Optional[dict] = None):
+        self.path, self.start, self.end = path, start, end
+        super().__init__(status_code=status_code, media_type="application/octet-stream",
+                         headers={**(headers or {}), "Content-Length": str(end - start)})
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f,
+                            "offset": self.start, "count": self.end - self.start})
+            return
+        async for data in iterate_in_threadpool(read_range(self.path, self.start, self.end)):
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def attachment(filename: str) -> str:
+    """Content-Disposition для имени файла, в том числе не латинского"""
+    quoted = quote(filename)
+    if quoted == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename*=utf-8''{quoted}"
 
 
 @app.get("/download/{filename}")
-async def download_file(filename: str):
-    return FileResponse(
-        path=os.path.join(UPLOAD_FOLDER, filename),
-        filename=filename
-    )
+async def download_file(filename: str, request: Request):
+    """Скачивание файла целиком или диапазона (Range, If-Range)
+
+    Клиент с актуальной копией (If-None-Match, If-Modified-Since) получает 304
+    без тела. Маленькие файлы отдаются из памяти, большие — без копирования.
+    """
+    found = await run_in_threadpool(blobs.resolve, filename)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return await _send_file(found[0], found[1], filename, request)
+
+
+@app.get("/blobs/{digest}")
+async def download_blob(digest: str, request: Request):
+    """Скачивание по хэшу содержимого (части файла с нескольких узлов)"""
+    if not await run_in_threadpool(blobs.has, digest):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return await _send_file(blobs.path(digest), digest, digest, request)
+
+
+@app.get("/blobs/{digest}/chunks")
+async def blob_chunks(digest: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Хэши частей файла: по ним проверяется каждая часть, полученная от другого узла"""
+    if not await run_in_threadpool(blobs.has, digest):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail="Недопустимый размер части")
+    chunks = await run_in_threadpool(blobs.chunk_hashes, digest, chunk_size)
+    size = await run_in_threadpool(blobs.size, digest)
+    return {"sha256": digest, "size": size, "chunk_size": chunk_size, "chunks": chunks}
+
+
+async def _send_file(path: str, digest: Optional[str], filename: str, request: Request) -> Response:
+    # Обращения к диску — в пуле потоков, чтобы не блокировать цикл событий
+    try:
+        stat = await run_in_threadpool(os.stat, path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    size = stat.st_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        # Хэш содержимого — сильный ETag; для файлов до индекса — время изменения и размер
+        "ETag": f'"{digest}"' if digest else f'"{stat.st_mtime_ns:x}-{size:x}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+    }
+
+    if not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since"),
+                    headers["ETag"], stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    start, end, status_code = 0, size, 200
+    # If-Range: диапазон отдается, только если файл не изменился, иначе весь файл
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range in (headers["ETag"], headers["Last-Modified"]):
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except ValueError:
+            raise HTTPException(status_code=416, detail="Диапазон вне файла",
+                                headers={"Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    if status_code == 200:
+        headers["Content-Disposition"] = attachment(filename)
+
+    data = await run_in_threadpool(cache.get, path, stat)
+    if data is not None:
+        return Response(data[start:end], status_code=status_code, headers=headers,
+                        media_type="application/octet-stream")
+    return ZeroCopyFileResponse(path, start, end, status_code, headers)
+
 
 if __name__ == "__main__":
     import uvicorn
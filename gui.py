@@ -8,12 +8,17 @@ from datetime import datetime
 import queue
 import shutil
 import mimetypes
+import tempfile
 from pathlib import Path
 
 
 # Импорт существующих модулей
 from discovery import DiscoveryService, initialize_discovery
-from msg_server import MessageBroadcaster
+from msg_server import MessageBroadcaster, history
+from file_tsf import blobs
+from wire import DEFAULT_ROOM
+from sync import sync_with_peers
+from presence import AWAY, ONLINE, TYPING
 import requests
 import socket
 
@@ -27,11 +32,14 @@ class LANChatGUI:
 
         # Инициализация переменных
         self.username = tk.StringVar(value="Пользователь")
+        self.room = tk.StringVar(value=DEFAULT_ROOM)
         self.message_var = tk.StringVar()
         self.chat_messages = []
         self.devices = []
         self.is_chat_active = False
         self.message_queue = queue.Queue()
+        self.typing_var = tk.StringVar()
+        self._presence_changes = -1
 
         # Инициализация сервисов
         self.discovery_service = None
@@ -55,6 +63,10 @@ class LANChatGUI:
         # Запуск сервисов
         self.start_services()
 
+        # Свернутое окно — статус "отошел"
+        self.root.bind('<Unmap>', lambda e: self.set_presence(AWAY) if e.widget is self.root else None)
+        self.root.bind('<Map>', lambda e: self.set_presence(ONLINE) if e.widget is self.root else None)
+
         # Запуск обновления GUI
         self.update_gui()
 
@@ -158,6 +170,10 @@ class LANChatGUI:
                                                        font=('Arial', 10), bg='white')
         self.messages_text.pack(fill='both', expand=True)
 
+        # Кто сейчас печатает
+        tk.Label(chat_frame, textvariable=self.typing_var, anchor='w',
+                 font=('Arial', 9, 'italic'), fg='#7f8c8d').pack(fill='x', padx=10)
+
         # Панель ввода сообщения
         input_frame = tk.Frame(chat_frame, bg='#ecf0f1', height=60)
         input_frame.pack(fill='x', padx=5, pady=5)
@@ -179,6 +195,7 @@ class LANChatGUI:
 
         # Привязка Enter для отправки
         self.message_entry.bind('<Return>', lambda e: self.send_message())
+        self.message_entry.bind('<Key>', self.on_typing)
 
     def create_control_panel(self, parent):
         """Создание панели управления"""
@@ -192,6 +209,9 @@ class LANChatGUI:
         # Вкладка устройств
         self.create_devices_tab(notebook)
 
+        # Вкладка поиска по истории
+        self.create_search_tab(notebook)
+
         # Вкладка настроек
         self.create_settings_tab(notebook)
 
@@ -206,13 +226,15 @@ class LANChatGUI:
 
         # Список устройств
         self.devices_tree = ttk.Treeview(
-            devices_frame, columns=('IP', 'Port'), show='tree headings')
+            devices_frame, columns=('IP', 'Port', 'Status'), show='tree headings')
         self.devices_tree.heading('#0', text='Имя устройства')
         self.devices_tree.heading('IP', text='IP адрес')
         self.devices_tree.heading('Port', text='Порт')
+        self.devices_tree.heading('Status', text='Статус')
         self.devices_tree.column('#0', width=150)
         self.devices_tree.column('IP', width=120)
         self.devices_tree.column('Port', width=80)
+        self.devices_tree.column('Status', width=150)
         self.devices_tree.pack(fill='both', expand=True, padx=10, pady=5)
 
         # Кнопки управления
@@ -224,6 +246,49 @@ class LANChatGUI:
         ttk.Button(btn_frame, text="Подключиться", style='Success.TButton',
                    command=self.connect_to_device).pack(side='right', padx=5)
 
+    def create_search_tab(self, notebook):
+        """Создание вкладки поиска по истории"""
+        search_frame = ttk.Frame(notebook)
+        notebook.add(search_frame, text="Поиск")
+
+        # Строка запроса
+        query_frame = tk.Frame(search_frame)
+        query_frame.pack(fill='x', padx=10, pady=10)
+
+        self.search_var = tk.StringVar()
+        search_entry = tk.Entry(query_frame, textvariable=self.search_var,
+                                font=('Arial', 11), relief='solid', bd=1)
+        search_entry.pack(side='left', fill='x', expand=True, padx=(0, 5))
+        search_entry.bind('<Return>', lambda e: self.search_history())
+
+        ttk.Button(query_frame, text="Найти", style='Action.TButton',
+                   command=self.search_history).pack(side='right')
+
+        # Результаты поиска
+        self.search_results = scrolledtext.ScrolledText(search_frame, wrap='word',
+                                                        font=('Arial', 10), bg='white')
+        self.search_results.pack(fill='both', expand=True, padx=10, pady=5)
+
+    def search_history(self):
+        """Поиск сообщений в истории"""
+        query = self.search_var.get().strip()
+        self.search_results.delete('1.0', 'end')
+        if not query:
+            return
+        try:
+            results = history.search(query)
+        except Exception as e:
+            self.search_results.insert('end', f"Ошибка поиска: {e}\n")
+            return
+        if not results:
+            self.search_results.insert('end', "Ничего не найдено\n")
+            return
+        for message in results:
+            timestamp = datetime.fromtimestamp(message['ts']).strftime("%d.%m %H:%M")
+            self.search_results.insert(
+                'end', f"[{timestamp}] #{message['room']} {message.get('username', 'Неизвестно')}: "
+                       f"{message.get('message', '')}\n")
+
     def create_settings_tab(self, notebook):
         """Создание вкладки настроек"""
         settings_frame = ttk.Frame(notebook)
@@ -240,6 +305,12 @@ class LANChatGUI:
             user_frame, textvariable=self.username, width=25)
         username_entry.pack(padx=10, pady=5)
 
+        tk.Label(user_frame, text="Комната:",
+                 bg='#ecf0f1').pack(anchor='w', padx=10, pady=5)
+        room_entry = tk.Entry(
+            user_frame, textvariable=self.room, width=25)
+        room_entry.pack(padx=10, pady=5)
+
         # Информация о системе
         info_frame = tk.LabelFrame(settings_frame, text="Информация о системе",
                                    font=('Arial', 11, 'bold'), bg='#ecf0f1')
@@ -281,7 +352,7 @@ class LANChatGUI:
                     self.discovery_service.start_discovery()
 
                     # Инициализация широковещателя сообщений
-                    self.message_broadcaster = MessageBroadcaster()
+                    self.message_broadcaster = MessageBroadcaster(history=history)
 
                     self.status_var.set("Сервисы запущены")
                     print("Все сервисы успешно запущены")
@@ -340,6 +411,8 @@ class LANChatGUI:
                 "Предупреждение", "Пожалуйста, введите имя пользователя")
             return
 
+        room = self.room.get().strip() or DEFAULT_ROOM
+
         self.is_chat_active = True
         self.chat_btn.config(text="Отключиться")
         self.status_var.set("Чат активен | Сообщений: 0")
@@ -347,6 +420,9 @@ class LANChatGUI:
         # Обновляем индикатор состояния
         self.update_status_indicator()
 
+        # Показываем последние сообщения комнаты из сохраненной истории
+        self.load_history(room)
+
         # Запуск получения сообщений
         def receive_messages():
             def handle_message(message, addr):
@@ -354,6 +430,9 @@ class LANChatGUI:
                     self.message_queue.put(message)
 
             try:
+                # Вход в multicast-группу комнаты: сообщения других комнат не будят узел
+                self.message_broadcaster.set_room(room)
+                self.message_broadcaster.set_presence(ONLINE, self.username.get())
                 self.message_broadcaster.start(handle_message)
 
                 # Отправка уведомления о входе
@@ -363,6 +442,12 @@ class LANChatGUI:
                 })
 
                 print("Поток получения сообщений запущен")
+
+                # Догружаем сообщения комнаты, отправленные, пока узел был выключен
+                if self.discovery_service:
+                    for message in sync_with_peers(history, self.discovery_service.devices):
+                        if message.get('room') == room:
+                            self.message_queue.put(message)
             except Exception as e:
                 print(f"Ошибка запуска потока получения сообщений: {e}")
                 self.status_var.set(f"Ошибка запуска чата: {e}")
@@ -373,7 +458,7 @@ class LANChatGUI:
         # Добавляем системное сообщение в очередь для корректной обработки
         self.message_queue.put({
             "username": "system",
-            "message": f"Вы присоединились к чату как {self.username.get()}"
+            "message": f"Вы присоединились к комнате {room} как {self.username.get()}"
         })
 
     def stop_chat(self):
@@ -412,6 +497,7 @@ class LANChatGUI:
 
         # Отправка сообщения
         if self.message_broadcaster:
+            self.message_broadcaster.set_presence(ONLINE)
             self.message_broadcaster.broadcast({
                 "username": self.username.get(),
                 "message": message
@@ -421,10 +507,23 @@ class LANChatGUI:
         self.add_message(self.username.get(), message)
         self.message_var.set("")
 
-    def add_message(self, username, message):
+    def load_history(self, room, limit=50):
+        """Загрузка последних сообщений комнаты из истории"""
+        try:
+            messages = history.query(room=room, limit=limit)
+        except Exception as e:
+            print(f"Ошибка загрузки истории: {e}")
+            return
+        for message in messages:
+            username = message.get('username', 'Неизвестно')
+            if username == 'system' or 'file_info' in message:
+                continue
+            self.add_message(username, message.get('message', ''), datetime.fromtimestamp(message['ts']))
+
+    def add_message(self, username, message, sent_at=None):
         """Добавление сообщения в чат"""
         try:
-            timestamp = datetime.now().strftime("%H:%M")
+            timestamp = (sent_at or datetime.now()).strftime("%H:%M")
             formatted_message = f"[{timestamp}] {username}: {message}\n"
 
             # Проверка, что виджет доступен
@@ -492,10 +591,38 @@ class LANChatGUI:
         devices = self.discovery_service.devices
         for device in devices:
             self.devices_tree.insert('', 'end', text=device['name'],
-                                     values=(device['ip'], device['port']))
+                                     values=(device['ip'], device['port'], self.device_status(device['ip'])))
 
         self.status_var.set(f"Найдено устройств: {len(devices)}")
 
+    def device_status(self, ip):
+        """Присутствие пользователей устройства по heartbeat"""
+        if not self.message_broadcaster:
+            return ""
+        names = {"online": "в сети", "away": "отошел", "typing": "печатает"}
+        return ", ".join(f"{peer['username']} ({names[peer['state']]})"
+                         for peer in self.message_broadcaster.peers.peers() if peer['ip'] == ip)
+
+    def update_presence(self):
+        """Обновление строки "печатает" и статусов устройств при изменении присутствия"""
+        if not self.message_broadcaster:
+            return
+        peers = self.message_broadcaster.peers.peers()
+        typing = [peer['username'] for peer in peers if peer['state'] == 'typing']
+        self.typing_var.set(f"{', '.join(typing)} печатает..." if typing else "")
+        if self.message_broadcaster.peers.changes != self._presence_changes:
+            self._presence_changes = self.message_broadcaster.peers.changes
+            self.refresh_devices()
+
+    def set_presence(self, state):
+        """Смена собственного статуса, пока чат активен"""
+        if self.is_chat_active and self.message_broadcaster:
+            self.message_broadcaster.set_presence(state)
+
+    def on_typing(self, event):
+        if event.keysym != 'Return':
+            self.set_presence(TYPING)
+
     def connect_to_device(self):
         """Подключение к выбранному устройству"""
         selection = self.devices_tree.selection()
@@ -706,7 +833,8 @@ class LANChatGUI:
                 devices = self.discovery_service.devices
                 for device in devices:
                     self.devices_tree.insert('', 'end', text=device['name'],
-                                             values=(device['ip'], device['port']))
+                                             values=(device['ip'], device['port'],
+                                                     self.device_status(device['ip'])))
 
                 self.status_var.set(f"Устройства обновлены: {len(devices)}")
                 print(
@@ -905,6 +1033,7 @@ class LANChatGUI:
 
         if self._update_counter >= 10:
             self.update_status_indicator()
+            self.update_presence()
             self._update_counter = 0
 
         # Обновление каждые 100мс
@@ -1018,7 +1147,7 @@ class LANChatGUI:
                 issues_found.append("Broadcaster недоступен при активном чате")
                 print("Восстанавливаем broadcaster...")
                 try:
-                    self.message_broadcaster = MessageBroadcaster()
+                    self.message_broadcaster = MessageBroadcaster(history=history)
                     print("Broadcaster восстановлен")
                 except Exception as e:
                     print(f"Не удалось восстановить broadcaster: {e}")
@@ -1232,21 +1361,19 @@ class LANChatGUI:
     def add_file_message(self, file_path):
         """Добавление сообщения о файле в чат"""
         try:
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
             file_type = mimetypes.guess_type(file_path)[0] or "Неизвестный тип"
 
-            # Копируем файл в папку uploads
-            dest_path = self.uploads_folder / file_name
-            # Не копируем, если файл уже в папке uploads
-            if file_path != str(dest_path):
-                shutil.copy2(file_path, dest_path)
+            # Копируем файл в хранилище uploads; одинаковое содержимое хранится один раз,
+            # а занятое другим файлом имя не перезаписывается
+            digest, file_size = blobs.add_file(file_path)
+            file_name = blobs.name(os.path.basename(file_path), digest, file_size)
+            dest_path = blobs.path(digest)
 
             # Создаем уникальный ID для файла
             file_id = f"file_{len(self.file_messages)}_{int(datetime.now().timestamp())}"
             self.file_messages[file_id] = {
                 'name': file_name,
-                'path': str(dest_path),
+                'path': dest_path,
                 'size': file_size,
                 'type': file_type,
                 'timestamp': datetime.now()
@@ -1284,7 +1411,8 @@ class LANChatGUI:
                     "file_info": {
                         'name': file_name,
                         'size': file_size,
-                        'type': file_type
+                        'type': file_type,
+                        'sha256': digest
                     }
                 })
 
@@ -1313,9 +1441,11 @@ class LANChatGUI:
 
                 # Добавляем тег для файла
                 file_id = f"incoming_file_{len(self.file_messages)}_{int(datetime.now().timestamp())}"
+                # Файлы хранятся по хэшу содержимого: путь находится через индекс имен
+                found = blobs.resolve(file_name)
                 self.file_messages[file_id] = {
                     'name': file_name,
-                    'path': str(self.uploads_folder / file_name),
+                    'path': found[0] if found else None,
                     'size': file_size,
                     'type': file_type,
                     'timestamp': datetime.now()
@@ -1345,17 +1475,17 @@ class LANChatGUI:
     def download_file_from_chat(self, file_name):
         """Скачивание файла из чата"""
         try:
-            # Ищем файл в папке uploads
-            file_path = self.uploads_folder / file_name
-            if file_path.exists():
+            # Ищем файл в хранилище uploads по имени
+            found = blobs.resolve(file_name)
+            if found is not None:
                 # Открываем диалог сохранения
                 save_path = filedialog.asksaveasfilename(
                     title="Сохранить файл как",
                     initialfile=file_name,
-                    defaultextension=file_path.suffix
+                    defaultextension=Path(file_name).suffix
                 )
                 if save_path:
-                    shutil.copy2(file_path, save_path)
+                    shutil.copyfile(found[0], save_path)
                     messagebox.showinfo("Успех", f"Файл {file_name} сохранен")
             else:
                 messagebox.showerror("Ошибка", f"Файл {file_name} не найден")
@@ -1446,8 +1576,8 @@ class LANChatGUI:
 
             ttk.Button(btn_frame, text="Скачать выбранный", style='Success.TButton',
                        command=lambda: self.download_selected_file(files_tree)).pack(side='left', padx=5)
-            ttk.Button(btn_frame, text="Открыть папку", style='Action.TButton',
-                       command=self.open_uploads_folder).pack(side='left', padx=5)
+            ttk.Button(btn_frame, text="Открыть выбранный", style='Action.TButton',
+                       command=lambda: self.open_selected_file(files_tree)).pack(side='left', padx=5)
             ttk.Button(btn_frame, text="Закрыть", style='Warning.TButton',
                        command=files_window.destroy).pack(side='right', padx=5)
 
@@ -1478,22 +1608,44 @@ class LANChatGUI:
             print(error_msg)
             messagebox.showerror("Ошибка", error_msg)
 
-    def open_uploads_folder(self):
-        """Открытие папки с загруженными файлами"""
+    def open_selected_file(self, files_tree):
+        """Открытие выбранного файла в программе по умолчанию
+
+        В uploads/ файлы лежат под хэшем содержимого, без имени и расширения,
+        поэтому открывается копия с исходным именем во временном каталоге.
+        """
         try:
+            selection = files_tree.selection()
+            if not selection:
+                messagebox.showwarning(
+                    "Предупреждение", "Выберите файл")
+                return
+
+            file_name = str(files_tree.item(selection[0])['values'][0])
+            found = blobs.resolve(file_name)
+            if found is None:
+                messagebox.showerror("Ошибка", f"Файл {file_name} не найден")
+                return
+
+            export_path = Path(tempfile.gettempdir()) / "LANChat" / (found[1] or "files") / file_name
+            # Содержимое под хэшем не меняется: готовую копию можно открыть повторно
+            if found[1] is None or not export_path.exists():
+                export_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(found[0], export_path)
+
             import subprocess
             import platform
 
             if platform.system() == "Windows":
-                subprocess.run(['explorer', str(self.uploads_folder)])
+                os.startfile(str(export_path))
             elif platform.system() == "Darwin":  # macOS
-                subprocess.run(['open', str(self.uploads_folder)])
+                subprocess.run(['open', str(export_path)])
             else:  # Linux
-                subprocess.run(['xdg-open', str(self.uploads_folder)])
+                subprocess.run(['xdg-open', str(export_path)])
 
         except Exception as e:
-            print(f"Ошибка открытия папки: {e}")
-            messagebox.showerror("Ошибка", f"Не удалось открыть папку: {e}")
+            print(f"Ошибка открытия файла: {e}")
+            messagebox.showerror("Ошибка", f"Не удалось открыть файл: {e}")
 
     def force_refresh_all(self):
         """Принудительное обновление всех элементов интерфейса"""
@@ -1552,6 +1704,9 @@ def main():
         print(f"Ошибка запуска GUI: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        # Последняя пачка истории записывается до выхода
+        history.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,376 @@
+"""Постоянное хранилище истории чата
+
+История хранится в SQLite в режиме WAL: запись идет только добавлением,
+читатели не блокируют писателя. Сообщения попадают в хранилище через
+ограниченную очередь и записываются пачками в отдельном потоке, поэтому
+append() никогда не блокирует цикл приема.
+
+Для синхронизации с другими узлами ведется дерево сумм: сообщение попадает
+в лист по первым двум байтам SHA-256 своего id, а лист и его родитель
+(первый байт) хранят количество сообщений и XOR их хешей. Суммы
+обновляются при каждой вставке, поэтому сравнение историй стоит
+пропорционально числу расходящихся листьев, а не размеру истории.
+
+Полнотекстовый поиск идет по инвертированному индексу (слово -> номера
+сообщений), который пополняется в той же транзакции, что и история.
+"""
+import hashlib
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+HISTORY_PATH = "history.db"
+
+# Служебные поля сообщения, которые хранятся в отдельных столбцах
+META_FIELDS = ("id", "room", "clock", "ts", "seq")
+
+# Слова из букв и цифр любого алфавита (кириллица, латиница); ссылки распадаются на части
+TOKEN_RE = re.compile(r"\w+")
+MIN_TOKEN = 2
+MAX_TOKEN = 64
+
+# Узлы дерева сумм: 0..255 — префикс из одного байта, LEAF_BASE + 0..65535 — листья
+LEAF_BASE = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    msg_id TEXT UNIQUE,
+    room TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    ts REAL NOT NULL,
+    clock INTEGER NOT NULL DEFAULT 0,
+    body TEXT NOT NULL,
+    bucket INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_messages_room_ts ON messages(room, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_ts ON messages(sender, ts);
+CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts);
+CREATE TABLE IF NOT EXISTS digests (
+    node INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL,
+    hash INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    PRIMARY KEY (term, seq)
+) WITHOUT ROWID;
+"""
+
+
+def tokenize(text: str) -> List[str]:
+    """Нормализованные слова текста без повторов"""
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        if MIN_TOKEN <= len(token) <= MAX_TOKEN and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def searchable_text(message: dict) -> str:
+    """Текст сообщения для поиска: сообщение и имя файла"""
+    text = str(message.get("message", ""))
+    file_info = message.get("file_info")
+    if isinstance(file_info, dict):
+        text += " " + str(file_info.get("name", ""))
+    return text
+
+
+def message_bucket(msg_id: str) -> Tuple[int, int]:
+    """Лист дерева сумм и 64-битный хеш сообщения"""
+    digest = hashlib.sha256(msg_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:2], "big"), int.from_bytes(digest[8:16], "big", signed=True)
+
+
+class HistoryStore:
+    """Хранилище истории с пакетной записью в фоновом потоке
+
+    Файл базы открывается при первом обращении, поэтому создание хранилища
+    (в том числе при импорте модуля) не трогает диск, а path можно сменить
+    до первого обращения.
+    """
+
+    def __init__(self, path: str = HISTORY_PATH, batch_size: int = 256, flush_interval: float = 0.2,
+                 queue_size: int = 100000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: "queue.Queue" = queue.Queue(queue_size)
+        self._local = threading.local()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self._running = True
+        self._listeners: List[Callable[[], None]] = []  # Вызываются после записи новых сообщений
+        self._opened = False
+        self._open_lock = threading.Lock()
+
+    def _open(self, conn: sqlite3.Connection):
+        """Создание схемы и миграция при первом соединении"""
+        with self._open_lock:
+            if self._opened:
+                return
+            conn.execute("PRAGMA journal_mode=WAL")
+            indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'postings'").fetchone()
+            conn.executescript(SCHEMA)
+            self._migrate(conn, reindex=not indexed)
+            conn.commit()
+            self._opened = True
+
+    def _migrate(self, conn: sqlite3.Connection, reindex: bool):
+        """Добавление дерева сумм и поискового индекса в историю, созданную до их появления"""
+        if reindex:
+            for seq, body in conn.execute("SELECT seq, body FROM messages").fetchall():
+                self._index(conn, seq, searchable_text(json.loads(body)))
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+        if "bucket" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN bucket INTEGER")
+            rows = conn.execute("SELECT seq, msg_id FROM messages WHERE msg_id IS NOT NULL").fetchall()
+            for seq, msg_id in rows:
+                bucket, value = message_bucket(msg_id)
+                conn.execute("UPDATE messages SET bucket = ? WHERE seq = ?", (bucket, seq))
+                self._update_digest(conn, bucket, value)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_bucket ON messages(bucket)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Отдельное соединение для каждого потока"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            if not self._opened:
+                self._open(conn)
+        return conn
+
+    def append(self, message: dict):
+        """Поставить сообщение в очередь на запись (не блокирует)"""
+        if not self._running:
+            return
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._queue.put_nowait(self._row(message))
+        except queue.Full:
+            self.dropped += 1
+
+    def insert(self, messages: Iterable[dict]) -> int:
+        """Синхронная запись (сообщения, полученные при синхронизации); возвращает число новых"""
+        return self._write([self._row(message) for message in messages])
+
+    @staticmethod
+    def _row(message: dict) -> Tuple[tuple, str]:
+        """Значения столбцов и текст для поискового индекса"""
+        record = {key: value for key, value in message.items() if key not in META_FIELDS}
+        return (
+            message.get("id"),
+            message.get("room") or "general",
+            str(message.get("username", "")),
+            message.get("ts") or time.time(),
+            message.get("clock") or 0,
+            json.dumps(record, ensure_ascii=False),
+        ), searchable_text(message)
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        """Пакетная запись: одна транзакция на batch_size сообщений или flush_interval секунд"""
+        while self._running or not self._queue.empty():
+            try:
+                rows = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write(rows)
+
+    def _write(self, rows: list) -> int:
+        """Запись пачки одной транзакцией с обновлением дерева сумм"""
+        conn = self._connect()
+        inserted = 0
+        try:
+            with conn:
+                for row, text in rows:
+                    msg_id = row[0]
+                    bucket, value = message_bucket(msg_id) if msg_id else (None, 0)
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO messages (msg_id, room, sender, ts, clock, body, bucket) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", (*row, bucket))
+                    if cursor.rowcount:
+                        inserted += 1
+                        self._index(conn, cursor.lastrowid, text)
+                        if bucket is not None:
+                            self._update_digest(conn, bucket, value)
+        except sqlite3.Error as e:
+            print(f"Ошибка записи истории: {e}")
+            return 0
+        if inserted:
+            for listener in list(self._listeners):
+                listener()
+        return inserted
+
+    def add_listener(self, listener: Callable[[], None]):
+        """Подписка на запись новых сообщений (вызывается из потока записи)"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    @staticmethod
+    def _index(conn: sqlite3.Connection, seq: int, text: str):
+        tokens = tokenize(text)
+        conn.executemany("INSERT OR IGNORE INTO postings (term, seq) VALUES (?, ?)",
+                         [(token, seq) for token in tokens])
+        conn.executemany("INSERT INTO terms (term, df) VALUES (?, 1) "
+                         "ON CONFLICT(term) DO UPDATE SET df = df + 1", [(token,) for token in tokens])
+
+    @staticmethod
+    def _update_digest(conn: sqlite3.Connection, bucket: int, value: int):
+        # В SQLite нет оператора XOR: (a | b) - (a & b) == a ^ b
+        for node in (bucket >> 8, LEAF_BASE + bucket):
+            conn.execute(
+                "INSERT INTO digests (node, count, hash) VALUES (?, 1, ?) "
+                "ON CONFLICT(node) DO UPDATE SET count = count + 1, "
+                "hash = (hash | excluded.hash) - (hash & excluded.hash)", (node, value))
+
+    def flush(self, timeout: float = 5.0):
+        """Дождаться записи всех сообщений из очереди"""
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Последняя пачка могла быть извлечена из очереди, но еще не записана
+        time.sleep(min(self.flush_interval, max(0.0, deadline - time.monotonic())))
+
+    def close(self):
+        """Записать оставшиеся сообщения и остановить поток записи"""
+        self._running = False
+        if self._writer is not None:
+            self._writer.join(timeout=5)
+
+    def query(self, room: Optional[str] = None, sender: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              limit: int = 100) -> List[dict]:
+        """Последние сообщения по комнате, отправителю и интервалу времени (в хронологическом порядке)"""
+        clauses, params = self._filters(room, sender, since, until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connect().execute(
+            f"SELECT seq, msg_id, room, ts, clock, body FROM messages {where} "
+            f"ORDER BY ts DESC, seq DESC LIMIT ?", (*params, limit)).fetchall()
+        return [self._to_message(row) for row in reversed(rows)]
+
+    def after(self, seq: int, room: Optional[str] = None, sender: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              limit: int = 100) -> List[dict]:
+        """Сообщения, записанные после локального номера seq, в порядке записи
+
+        Номера только растут и не переиспользуются, поэтому постраничное чтение
+        по ним не пропускает и не повторяет сообщения.
+        """
+        clauses, params = self._filters(room, sender, since, until)
+        clauses.insert(0, "seq > ?")
+        params.insert(0, seq)
+        rows = self._connect().execute(
+            f"SELECT seq, msg_id, room, ts, clock, body FROM messages WHERE {' AND '.join(clauses)} "
+            f"ORDER BY seq LIMIT ?", (*params, limit)).fetchall()
+        return [self._to_message(row) for row in rows]
+
+    def last_seq(self) -> int:
+        """Номер последнего записанного сообщения (0 для пустой истории)"""
+        return self._connect().execute("SELECT COALESCE(MAX(seq), 0) FROM messages").fetchone()[0]
+
+    @staticmethod
+    def _filters(room: Optional[str], sender: Optional[str], since: Optional[float],
+                 until: Optional[float]) -> Tuple[List[str], list]:
+        clauses, params = [], []
+        if room is not None:
+            clauses.append("room = ?")
+            params.append(room)
+        if sender is not None:
+            clauses.append("sender = ?")
+            params.append(sender)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(until)
+        return clauses, params
+
+    def search(self, text: str, room: Optional[str] = None, limit: int = 50) -> List[dict]:
+        """Сообщения, содержащие все слова запроса (сначала новые)
+
+        Перебор идет по самому редкому слову от новых сообщений к старым, остальные
+        слова проверяются точечным поиском по индексу, поэтому запрос останавливается,
+        как только набрано limit результатов.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        conn = self._connect()
+        placeholders = ", ".join("?" * len(tokens))
+        counts = dict(conn.execute(f"SELECT term, df FROM terms WHERE term IN ({placeholders})", tokens))
+        if len(counts) < len(tokens):
+            return []  # Одного из слов нет ни в одном сообщении
+        driver, *others = sorted(tokens, key=counts.get)
+        clauses = ["EXISTS (SELECT 1 FROM postings p WHERE p.term = ? AND p.seq = p0.seq)" for _ in others]
+        params = [driver, *others]
+        if room is not None:
+            clauses.append("m.room = ?")
+            params.append(room)
+        where = "".join(f" AND {clause}" for clause in clauses)
+        rows = conn.execute(
+            f"SELECT m.seq, m.msg_id, m.room, m.ts, m.clock, m.body FROM postings p0 "
+            f"JOIN messages m ON m.seq = p0.seq WHERE p0.term = ?{where} "
+            f"ORDER BY p0.seq DESC LIMIT ?", (*params, limit)).fetchall()
+        return [self._to_message(row) for row in rows]
+
+    def digest(self, prefix: Optional[int] = None) -> Dict[int, Tuple[int, int]]:
+        """Суммы дерева: префиксы верхнего уровня или листья внутри префикса -> (количество, хеш)"""
+        if prefix is None:
+            low, high, base = 0, LEAF_BASE - 1, 0
+        else:
+            low, high, base = LEAF_BASE + (prefix << 8), LEAF_BASE + (prefix << 8) + 255, LEAF_BASE
+        rows = self._connect().execute(
+            "SELECT node, count, hash FROM digests WHERE node BETWEEN ? AND ?", (low, high)).fetchall()
+        return {node - base: (count, value) for node, count, value in rows}
+
+    def bucket_ids(self, bucket: int) -> List[str]:
+        """Идентификаторы сообщений одного листа"""
+        rows = self._connect().execute("SELECT msg_id FROM messages WHERE bucket = ?", (bucket,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_many(self, ids: List[str]) -> List[dict]:
+        """Сообщения по идентификаторам"""
+        messages = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self._connect().execute(
+                f"SELECT seq, msg_id, room, ts, clock, body FROM messages "
+                f"WHERE msg_id IN ({', '.join('?' * len(chunk))})", chunk).fetchall()
+            messages.extend(self._to_message(row) for row in rows)
+        return messages
+
+    @staticmethod
+    def _to_message(row) -> dict:
+        seq, msg_id, room, ts, clock, body = row
+        message = json.loads(body)
+        message.update({"id": msg_id, "room": room, "ts": ts, "clock": clock, "seq": seq})
+        return message
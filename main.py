@@ -2,7 +2,7 @@ import threading
 import argparse
 import sys
 from discovery import DiscoveryService, router as discovery_router, initialize_discovery
-from msg_server import app as message_app
+from msg_server import app as message_app, history, lifespan as message_lifespan
 from file_tsf import app as file_app
 from fastapi import FastAPI
 import uvicorn
@@ -10,7 +10,8 @@ import socket
 import re
 
 # Объединение нескольких экземпляров FastAPI
-main_app = FastAPI()
+# Смонтированные приложения не получают событий запуска, поэтому их lifespan подключается здесь
+main_app = FastAPI(lifespan=message_lifespan)
 main_app.mount("/message", message_app)
 main_app.mount("/file", file_app)
 main_app.include_router(discovery_router, prefix="/discovery")
@@ -87,8 +88,8 @@ def run_gui():
         print(f"❌ Ошибка запуска GUI: {e}")
 
 
-def run_cli():
-    """Запуск командной строки"""
+def run_cli(ws_deflate: bool = True):
+    """Запуск командной строки; ws_deflate — согласовывать ли permessage-deflate для WebSocket"""
     print("""
 ╔════════════════════════════════════════════════╗
 ║             LANChat - Инструмент для чата в LAN ║
@@ -145,7 +146,10 @@ def run_cli():
             main_app,
             host="0.0.0.0",
             port=controller.service_port,
-            log_level="info"
+            log_level="info",
+            # Стандартное сжатие для браузеров; без него остаются только кадры хаба (?deflate=true),
+            # сжатые один раз на сообщение
+            ws_per_message_deflate=ws_deflate
         )
     )
     server_thread.daemon = True
@@ -183,8 +187,9 @@ def run_cli():
                     break
                 elif cmd == "help":
                     cmd_handler.show_help()
-                elif cmd == "chat":  # Новая команда чата
-                    cmd_handler.boardcast_start_chat()
+                elif cmd == "chat" or cmd.startswith("chat "):  # Новая команда чата
+                    room = cmd[len("chat"):].strip() or None
+                    cmd_handler.boardcast_start_chat(room)
                 elif cmd == "devices":
                     cmd_handler.show_online_devices()
                 elif cmd.startswith("upload "):
@@ -209,6 +214,8 @@ def run_cli():
         print("\nВыход...")
     finally:
         controller.cleanup()
+        # Сервер работает в фоновом потоке и не получает события завершения
+        history.close()
 
 
 if __name__ == "__main__":
@@ -219,11 +226,19 @@ if __name__ == "__main__":
                         help="Указать порт сервиса (необязательно)")
     parser.add_argument("--cli", action="store_true",
                         help="Запустить консольный интерфейс (CLI)")
+    parser.add_argument("--no-ws-deflate", dest="ws_deflate", action="store_false",
+                        help="Не согласовывать permessage-deflate для WebSocket (если клиенты используют ?deflate=true)")
+    parser.add_argument("--history", metavar="PATH",
+                        help="Файл истории чата (по умолчанию history.db в текущем каталоге)")
     args = parser.parse_args()
 
+    if args.history:
+        # Хранилище открывает файл при первом обращении, поэтому путь еще можно сменить
+        history.path = args.history
+
     if args.cli:
         # Запуск CLI
-        run_cli()
+        run_cli(args.ws_deflate)
     else:
         # По умолчанию запускаем GUI
         run_gui()
@@ -1,13 +1,42 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import Body, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-import socket
+from fastapi.responses import StreamingResponse
+import asyncio
+import base64
+import binascii
 import json
+import os
+import queue
+import socket
+import struct
+import sys
 import threading
-from typing import Callable, Optional
+import time
+import uuid
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from rich import print as rprint
 import uvicorn
+import wire
+from delivery import DedupCache, GapTracker, RateLimiter, Reassembler, ReorderBuffer, SendWindow
+from history import HistoryStore
+from presence import OFFLINE, Heartbeat, Presence, PresenceTracker
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Прием широковещательных сообщений в цикле событий uvicorn на время работы приложения"""
+    await broadcaster.start_async()
+    hub.start()
+    yield
+    # Отправка накопленного пакета и heartbeat OFFLINE, затем запись последней пачки истории
+    broadcaster.stop()
+    history.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Разрешить CORS (для будущей интеграции с фронтендом)
 app.add_middleware(
@@ -17,74 +46,1012 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class Subscription:
+    """Асинхронная подписка на входящие сообщения (async for message, addr in subscription)"""
+
+    def __init__(self, broadcaster: "MessageBroadcaster", loop: asyncio.AbstractEventLoop, maxsize: int):
+        self._broadcaster = broadcaster
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0  # Сообщения, не поместившиеся в очередь медленного подписчика
+
+    def put(self, item):
+        """Передать сообщение подписчику (безопасно из любого потока)"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._put_nowait, item)
+
+    def _put_nowait(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def close(self):
+        """Отписаться и завершить итерацию"""
+        self._broadcaster._subscribers.discard(self)
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+class BroadcastProtocol(asyncio.DatagramProtocol):
+    """Прием широковещательных датаграмм в цикле событий asyncio"""
+
+    def __init__(self, broadcaster: "MessageBroadcaster"):
+        self.broadcaster = broadcaster
+
+    def datagram_received(self, data: bytes, addr):
+        self.broadcaster._enqueue_async(data, addr)
+
+    def error_received(self, exc: Exception):
+        rprint(f"[red]Ошибка приема сообщения: {exc}[/red]")
+
+
+def kernel_drops(sock: socket.socket) -> Optional[int]:
+    """Число датаграмм, отброшенных ядром из-за переполнения буфера сокета (только Linux)"""
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open("/proc/net/udp") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[-1])
+    except (OSError, ValueError, IndexError, StopIteration):
+        pass
+    return None
+
+
 class MessageBroadcaster:
     BROADCAST_PORT = 25896  # Фиксированный порт для приема широковещательной передачи
+    LEGACY_PEER_TTL = 120  # Сколько секунд помнить узел, отправлявший только JSON
+    RECV_BUFFER_SIZE = 65535  # Максимальный размер датаграммы UDP
+    TICK_INTERVAL = 0.1  # Период отправки NACK и объявлений последнего номера
+    SYNC_DELAY = 0.5  # Через сколько секунд после серии сообщений объявлять последний номер
 
-    def __init__(self):
+    MULTICAST_TTL = 1  # Multicast не выходит за пределы локального сегмента
+    DISPATCH_BATCH = 64  # Сколько датаграмм разбирать за один проход цикла событий
+
+    def __init__(self, room: str = wire.DEFAULT_ROOM, wire_format: str = "auto",
+                 mtu: int = wire.MAX_DATAGRAM, multicast: bool = True, interface: str = "0.0.0.0",
+                 coalesce_delay: float = 0.0, coalesce_bytes: Optional[int] = None,
+                 compression: bool = True, rcvbuf: int = 4 * 1024 * 1024, queue_size: int = 4096,
+                 rate_limit: float = 200.0, rate_burst: float = 1000.0, reorder_hold: float = 0.15,
+                 history: Optional[HistoryStore] = None):
         self.running = False
         self.receive_callback: Optional[Callable] = None
+
+        # Параметры бинарного формата: "auto" переключается на JSON, пока в сети есть старые узлы
+        self.wire_format = wire_format
+        self.sender_id = wire.new_sender_id()
+        self._seqs: Dict[int, int] = {}  # Номера сообщений ведутся отдельно для каждой комнаты
+        self._legacy_peers: Dict[str, float] = {}
+
+        # Сжатие со словарем включается, только пока все замеченные узлы умеют распаковывать
+        self.compression = compression
+        self._plain_peers: Dict[bytes, float] = {}
+
+        # Комнаты: room_id -> имя; сообщения без "room" отправляются в self.room
+        self.room = room
+        self.rooms: Dict[int, str] = {}
+        self._room_names: Dict[int, str] = {}  # Все комнаты, куда узел входил или отправлял
+        self.multicast = multicast
+        self.interface = interface
+
+        # Фрагментация сообщений больше одной датаграммы
+        self.mtu = mtu
+        self.reassembler = Reassembler(max_message_size=wire.MAX_MESSAGE)
+
+        # Надежная доставка: обнаружение пропусков, NACK и окно повторной передачи
+        self.gaps = GapTracker()
+        self.send_window = SendWindow()
+        self.retransmitted = 0
+        self._sync_due: Dict[int, float] = {}
+        self._last_tick = 0.0
+        self._send_lock = threading.Lock()
+
+        # Объединение мелких сообщений в одну датаграмму (выключено при coalesce_delay=0)
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes or mtu
+        self._pending: Dict[int, List[bytes]] = {}
+        self._flush_due: Dict[int, float] = {}  # Потоковый режим: когда отправить пакет комнаты
+        self.batches_sent = 0
+
+        # Причинный порядок: часы Лэмпорта и буфер с ограниченной задержкой
+        self.clock = 0
+        self.reorder = ReorderBuffer(reorder_hold)
+        self._release_handle: Optional[asyncio.TimerHandle] = None
+
+        # Постоянная история: отправленные и доставленные сообщения пишутся пачками в фоне
+        self.history = history
+
+        # Присутствие: собственное состояние (heartbeat после set_presence) и состояние соседей
+        self.presence = Presence()
+        self.peers = PresenceTracker()
+
+        # Подавление повторов (несколько интерфейсов, повторная передача, ретрансляция)
+        self.dedup = DedupCache()
+
+        # Прием отделен от разбора: сырые датаграммы ждут в ограниченной очереди
+        self.queue_size = queue_size
+        self.queue_drops = 0
+        self._inbox: "queue.Queue" = queue.Queue(queue_size)  # Потоковый режим
+        self._backlog: deque = deque()  # Асинхронный режим
+        self._drain_scheduled = False
+
+        # Защита от флуда: лимит датаграмм с каждого IP проверяется до постановки в очередь
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst)
+
+        # Асинхронный режим: транспорт asyncio и подписчики
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Set[Subscription] = set()
         
         # Создание UDP сокета для приема широковещательной передачи
         self.receive_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.receive_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.receive_sock.bind(('', self.BROADCAST_PORT))
+        try:
+            self.receive_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        except OSError as e:
+            rprint(f"[yellow]Не удалось установить SO_RCVBUF: {e}[/yellow]")
         
         # Создание UDP сокета для отправки широковещательной передачи
         self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        if self.multicast:
+            self._setup_multicast()
+        self.join(room)
         
         rprint(f"[green]✓[/green] Сервис широковещательной передачи сообщений запущен на порту {self.BROADCAST_PORT}")
 
+    def _setup_multicast(self):
+        """Настройка сокетов для multicast; при ошибке остается широковещательная передача"""
+        try:
+            self.send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.MULTICAST_TTL)
+            self.send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.interface != "0.0.0.0":
+                self.send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                          socket.inet_aton(self.interface))
+            if sys.platform.startswith("linux"):
+                # Не получать группы, в которые вошли другие сокеты этого узла (IP_MULTICAST_ALL)
+                self.receive_sock.setsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MULTICAST_ALL", 49), 0)
+        except OSError as e:
+            rprint(f"[yellow]Multicast недоступен, используется широковещательная передача: {e}[/yellow]")
+            self.multicast = False
+
+    def _membership(self, room: str) -> bytes:
+        return struct.pack("4s4s", socket.inet_aton(wire.room_group(room)), socket.inet_aton(self.interface))
+
+    def join(self, room: str):
+        """Войти в комнату: подписаться на ее multicast-группу"""
+        rid = wire.room_id(room)
+        if rid in self.rooms:
+            return
+        if self.multicast:
+            try:
+                self.receive_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self._membership(room))
+            except OSError as e:
+                rprint(f"[yellow]Не удалось войти в группу комнаты {room}: {e}[/yellow]")
+        self.rooms[rid] = room
+        self._room_names[rid] = room
+
+    def leave(self, room: str):
+        """Выйти из комнаты"""
+        rid = wire.room_id(room)
+        if self.rooms.pop(rid, None) is None:
+            return
+        if self.multicast:
+            try:
+                self.receive_sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, self._membership(room))
+            except OSError:
+                pass
+
+    def set_room(self, room: str):
+        """Сменить комнату по умолчанию (выйти из прежней и войти в новую)"""
+        if room == self.room:
+            self.join(room)
+            return
+        self.leave(self.room)
+        self.join(room)
+        self.room = room
+
     def start(self, callback: Callable):
-        """Запуск сервиса широковещательной передачи"""
+        """Запуск сервиса широковещательной передачи в отдельном потоке (для GUI и CLI)"""
         self.running = True
         self.receive_callback = callback
+        # Таймаут позволяет потоку приема завершиться после stop()
+        self.receive_sock.settimeout(1.0)
         
-        # Запуск потока приема
+        # Поток приема только вычитывает сокет; разбор и обработчик работают в потоке доставки
         self.receive_thread = threading.Thread(target=self._receive_loop)
         self.receive_thread.daemon = True
         self.receive_thread.start()
-        
+        self.dispatch_thread = threading.Thread(target=self._dispatch_loop)
+        self.dispatch_thread.daemon = True
+        self.dispatch_thread.start()
+
+    async def start_async(self):
+        """Запуск приема в текущем цикле событий (без отдельного потока)"""
+        if self.transport is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self.receive_sock.setblocking(False)
+        self.transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: BroadcastProtocol(self), sock=self.receive_sock)
+        self.running = True
+        self._loop.call_later(self.TICK_INTERVAL, self._tick_async)
+
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """Цикл событий, в котором идет прием (после start_async)"""
+        return self._loop
+
+    def subscribe(self, maxsize: int = 256) -> Subscription:
+        """Подписка на входящие сообщения; вызывать из цикла событий"""
+        subscription = Subscription(self, self._loop or asyncio.get_running_loop(), maxsize)
+        self._subscribers.add(subscription)
+        return subscription
+
     def stop(self):
         """Остановка сервиса широковещательной передачи"""
+        for rid in list(self._pending):
+            self._flush(rid)
+        if self.running and self.presence.username is not None:
+            # Соседи убирают узел сразу, не дожидаясь истечения TTL
+            self.presence.set(OFFLINE)
+            self._send_presence(time.monotonic())
         self.running = False
+        for subscription in list(self._subscribers):
+            subscription.close()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
         self.receive_sock.close()
         self.send_sock.close()
         
-    def broadcast(self, message: dict):
-        """Широковещательная передача сообщения"""
+    def set_presence(self, state: int, username: Optional[str] = None):
+        """Смена собственного состояния (presence.ONLINE, AWAY, TYPING); рассылается при следующем такте"""
+        self.presence.set(state, username)
+
+    def _send_presence(self, now: float):
+        heartbeat = self.presence.due(now, len(self.peers))
+        if heartbeat is None or not self.use_binary():
+            return
+        rid = wire.room_id(self.room)
+        self._send([wire.encode_presence(rid, self.sender_id, heartbeat.state, heartbeat.version,
+                                         heartbeat.interval, heartbeat.username)], rid)
+
+    def broadcast(self, message: dict) -> bool:
+        """Широковещательная передача сообщения (ключ "room" выбирает комнату)
+
+        Возвращает False, если сообщение не отправлено (например, больше wire.MAX_MESSAGE).
+        """
         try:
-            data = json.dumps(message).encode('utf-8')
-            self.send_sock.sendto(data, ('<broadcast>', self.BROADCAST_PORT))
+            message = {key: value for key, value in message.items() if key not in wire.META_KEYS}
+            room = message.pop("room", None) or self.room
+            rid = wire.room_id(room)
+            with self._send_lock:
+                # Отправлять можно и в комнату, в которую узел не входил: группа известна по имени
+                self._room_names[rid] = room
+                datagrams, msg_id = self._encode(message, rid, room)
+                clock = self.clock
+                # Пакет отправляет цикл событий или поток доставки, поэтому до запуска не объединяем
+                if self.coalesce_delay > 0 and self.running and wire.is_binary(datagrams[0]):
+                    datagrams = self._coalesce(rid, datagrams)
+            self._send(datagrams, rid)
+            if self.history is not None:
+                self.history.append({**message, "id": msg_id, "room": room, "clock": clock})
+            return True
         except Exception as e:
             rprint(f"[red]Не удалось передать сообщение: {e}[/red]")
-            
+            return False
+
+    def stats(self) -> dict:
+        """Счетчики потерь, восстановления и повторной передачи"""
+        return {
+            **self.gaps.stats,
+            "missing": self.gaps.missing_count(),
+            "retransmitted": self.retransmitted,
+            "deduplicated": self.dedup.duplicates,
+            "send_window": len(self.send_window),
+            "batches_sent": self.batches_sent,
+            "queue_depth": self._inbox.qsize() + len(self._backlog),
+            "queue_drops": self.queue_drops,
+            "rate_limited": self.rate_limiter.dropped,
+            "throttled_senders": self.rate_limiter.throttled(),
+            "kernel_drops": kernel_drops(self.receive_sock),
+            "rcvbuf": self.receive_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            "reassembly": dict(self.reassembler.stats, pending=len(self.reassembler)),
+            "reorder": dict(self.reorder.stats, held=len(self.reorder)),
+        }
+
+    def _coalesce(self, rid: int, datagrams: List[bytes]) -> List[bytes]:
+        """Отложить небольшое сообщение в пакет комнаты; возвращает то, что нужно отправить сразу"""
+        ready = []
+        pending = self._pending.get(rid)
+        if len(datagrams) == 1 and wire.batch_size(datagrams) <= self.coalesce_bytes:
+            if pending and wire.batch_size(pending + datagrams) > self.coalesce_bytes:
+                ready.append(self._take_pending(rid))
+            if rid not in self._pending:
+                self._pending[rid] = []
+                self._schedule_flush(rid)
+            self._pending[rid].extend(datagrams)
+            return ready
+        # Фрагменты и крупные сообщения не объединяются; сначала отправляем накопленное, сохраняя порядок
+        if pending:
+            ready.append(self._take_pending(rid))
+        return ready + datagrams
+
+    def _take_pending(self, rid: int) -> bytes:
+        pending = self._pending.pop(rid)
+        if len(pending) == 1:
+            return pending[0]
+        self.batches_sent += 1
+        return wire.pack_batch(rid, self.sender_id, pending)
+
+    def _schedule_flush(self, rid: int):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.call_later, self.coalesce_delay, self._flush, rid)
+        else:
+            # Потоковый режим: пакеты по сроку отправляет поток доставки, а не таймер на каждое окно
+            self._flush_due[rid] = time.monotonic() + self.coalesce_delay
+            try:
+                self._inbox.put_nowait(None)  # Разбудить поток доставки, чтобы он учел новый срок
+            except queue.Full:
+                pass
+
+    def _flush_expired(self):
+        """Отправка пакетов, у которых истекло окно объединения (потоковый режим)"""
+        now = time.monotonic()
+        for rid, due in list(self._flush_due.items()):
+            if now >= due:
+                self._flush(rid)
+
+    def _flush(self, rid: int):
+        """Отправка накопленного пакета комнаты"""
+        with self._send_lock:
+            self._flush_due.pop(rid, None)
+            if not self._pending.get(rid):
+                return
+            datagram = self._take_pending(rid)
+        try:
+            self._send([datagram], rid)
+        except Exception as e:
+            rprint(f"[red]Не удалось передать сообщение: {e}[/red]")
+
+    def _send(self, datagrams: List[bytes], rid: int):
+        for datagram in datagrams:
+            self.send_sock.sendto(datagram, self._destination(rid, datagram))
+
+    def _destination(self, rid: int, datagram: bytes):
+        """Multicast-группа комнаты; JSON для старых узлов уходит широковещательно"""
+        room = self._room_names.get(rid)
+        if self.multicast and room is not None and wire.is_binary(datagram):
+            return (wire.room_group(room), self.BROADCAST_PORT)
+        return ('<broadcast>', self.BROADCAST_PORT)
+
+    def use_binary(self) -> bool:
+        """Можно ли отправлять бинарный формат (нет недавно замеченных старых узлов)"""
+        if self.wire_format != "auto":
+            return self.wire_format == "binary"
+        now = time.monotonic()
+        for ip, seen in list(self._legacy_peers.items()):
+            if now - seen > self.LEGACY_PEER_TTL:
+                del self._legacy_peers[ip]
+        return not self._legacy_peers
+
+    def use_compression(self) -> bool:
+        """Можно ли сжимать нагрузку (нет недавно замеченных узлов без FLAG_CAP_ZDICT)"""
+        if not self.compression:
+            return False
+        now = time.monotonic()
+        for sender, seen in list(self._plain_peers.items()):
+            if now - seen > self.LEGACY_PEER_TTL:
+                del self._plain_peers[sender]
+        return not self._plain_peers
+
+    def _encode(self, message: dict, rid: int, room: str) -> Tuple[List[bytes], str]:
+        """Кодирование сообщения в датаграммы согласованного формата; возвращает и id сообщения"""
+        if not self.use_binary():
+            msg_id = uuid.uuid4().hex
+            message = {**message, "id": msg_id}
+            return [wire.encode_json(message if room == wire.DEFAULT_ROOM else {**message, "room": room})], msg_id
+        seq = (self._seqs.get(rid, 0) + 1) & 0xFFFFFFFF
+        clock = (self.clock + 1) & 0xFFFFFFFF
+        # Слишком большое сообщение отклоняется до выдачи номера, иначе получатели ждали бы пропуск
+        data = wire.encode(message, rid, self.sender_id, seq, compressed=self.use_compression(), clock=clock)
+        self._seqs[rid], self.clock = seq, clock
+        datagrams = wire.fragment(data, self.mtu)
+        self.send_window.add((rid, seq), datagrams)
+        self._sync_due[rid] = time.monotonic() + self.SYNC_DELAY
+        header, _ = wire.decode_header(data)
+        return datagrams, wire.message_id(header).hex()
+
+    def _decode(self, data: bytes, addr) -> Optional[dict]:
+        """Декодирование датаграммы; None для собственного эха и чужих комнат"""
+        if wire.is_binary(data):
+            header, payload = wire.decode_header(data)
+            if header.sender == self.sender_id or header.room not in self.rooms:
+                return None
+            if not header.flags & wire.FLAG_CAP_ZDICT:
+                self._plain_peers[header.sender] = time.monotonic()
+            if header.version < wire.VERSION:
+                # Узел версии 1 не разберет наш заголовок, но понимает JSON
+                self._legacy_peers[addr[0]] = time.monotonic()
+            stream = (header.sender, header.room)
+            if header.type == wire.TYPE_NACK:
+                self._handle_nack(header.room, *wire.decode_nack(payload))
+                return None
+            if header.type == wire.TYPE_SYNC:
+                self.gaps.announce(stream, header.seq)
+                return None
+            if header.type == wire.TYPE_PRESENCE:
+                state, interval, username = wire.decode_presence(payload)
+                self.peers.update(header.sender, Heartbeat(state, header.seq, interval, username), addr[0])
+                return None
+            msg_id = wire.message_id(header)
+            if self.dedup.check(msg_id):
+                return None
+            if header.flags & wire.FLAG_FRAGMENT:
+                # Все номера до текущего уже отправлены, даже если это сообщение еще не собрано
+                self.gaps.announce(stream, header.seq - 1)
+                index, count, total, chunk = wire.decode_fragment(payload)
+                payload = self.reassembler.add(msg_id, index, count, total, chunk)
+                if payload is None:
+                    return None
+            if not self.gaps.receive(stream, header.seq):
+                return None
+            self.dedup.add(msg_id)
+            message = wire.decode_payload(header, payload)
+            message["room"] = self.rooms[header.room]
+            # У узлов версии 1 нет часов: как и для JSON, сохраняем порядок прихода
+            message["clock"] = header.clock if header.version == wire.VERSION else self.clock
+            message["id"] = msg_id.hex()
+            with self._send_lock:
+                self.clock = max(self.clock, header.clock)
+            return message
+
+        message, capable = wire.decode_json(data)
+        if not capable:
+            self._legacy_peers[addr[0]] = time.monotonic()
+        # У старых узлов нет комнат: их сообщения относятся к комнате по умолчанию
+        message.setdefault("room", wire.DEFAULT_ROOM)
+        if wire.room_id(message["room"]) not in self.rooms:
+            return None
+        # Повторы JSON-сообщений (несколько интерфейсов, ретрансляция) отсекаются по их id
+        msg_id = message.get("id")
+        if isinstance(msg_id, str):
+            if self.dedup.check(msg_id):
+                return None
+            self.dedup.add(msg_id)
+        # Без часов отправителя сохраняем порядок прихода
+        message["clock"] = self.clock
+        return message
+
+    def _handle_nack(self, rid: int, target: bytes, seqs: List[int]):
+        """Повторная передача по запросу или подавление собственного NACK"""
+        if target != self.sender_id:
+            # Кто-то уже запросил эти сообщения; повтор придет в группу комнаты и нам
+            self.gaps.suppress((target, rid), seqs)
+            return
+        with self._send_lock:
+            repairs = [self.send_window.retransmit((rid, seq)) for seq in seqs]
+        for datagrams in repairs:
+            if datagrams:
+                self._send(datagrams, rid)
+                self.retransmitted += 1
+
+    def _tick(self):
+        """Отправка запланированных NACK, объявления последнего номера и heartbeat"""
+        now = self._last_tick = time.monotonic()
+        try:
+            self._send_presence(now)
+            for (sender, rid), seqs in self.gaps.due_nacks(now).items():
+                self._send([wire.encode_nack(rid, self.sender_id, sender, seqs)], rid)
+            for rid, due in list(self._sync_due.items()):
+                if now >= due:
+                    self._sync_due.pop(rid, None)
+                    self._send([wire.encode_sync(rid, self.sender_id, self._seqs[rid])], rid)
+        except Exception as e:
+            if self.running:
+                rprint(f"[red]Ошибка отправки служебного сообщения: {e}[/red]")
+
+    def _tick_async(self):
+        if self.transport is None:
+            return
+        self._tick()
+        self._loop.call_later(self.TICK_INTERVAL, self._tick_async)
+
+    def _handle_datagram(self, data: bytes, addr):
+        """Декодирование датаграммы (или пакета) и доставка обработчику и подписчикам"""
+        try:
+            if wire.is_batch(data):
+                header, payload = wire.decode_header(data)
+                if header.sender == self.sender_id or header.room not in self.rooms:
+                    return
+                for datagram in wire.unpack_batch(payload):
+                    if not wire.is_batch(datagram):
+                        self._handle_datagram(datagram, addr)
+                return
+            message = self._decode(data, addr)
+        except Exception as e:
+            rprint(f"[red]Ошибка приема сообщения: {e}[/red]")
+            return
+        if message is None:
+            return
+        self.reorder.push(message["clock"], (message, addr))
+        self._release()
+
+    def _release(self):
+        """Доставка сообщений, вышедших из буфера упорядочивания"""
+        for message, addr in self.reorder.pop_ready():
+            if self.history is not None:
+                self.history.append(message)
+            if self.receive_callback:
+                self.receive_callback(message, addr)
+            for subscription in list(self._subscribers):
+                subscription.put((message, addr))
+        deadline = self.reorder.next_deadline()
+        if self._loop is not None and deadline is not None and self._release_handle is None:
+            self._release_handle = self._loop.call_later(
+                max(0.0, deadline - time.monotonic()), self._release_async)
+
+    def _release_async(self):
+        self._release_handle = None
+        self._release()
+
+    def _enqueue_async(self, data: bytes, addr):
+        """Постановка датаграммы в очередь разбора в цикле событий"""
+        if not self.rate_limiter.allow(addr[0]):
+            return
+        if len(self._backlog) >= self.queue_size:
+            self.queue_drops += 1
+            return
+        self._backlog.append((data, addr))
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self._loop.call_soon(self._drain_async)
+
+    def _drain_async(self):
+        """Разбор накопленных датаграмм порциями, не занимая цикл событий надолго"""
+        for _ in range(min(len(self._backlog), self.DISPATCH_BATCH)):
+            data, addr = self._backlog.popleft()
+            self._handle_datagram(data, addr)
+        if self._backlog:
+            self._loop.call_soon(self._drain_async)
+        else:
+            self._drain_scheduled = False
+
     def _receive_loop(self):
-        """Цикл приема сообщений"""
+        """Цикл приема: только вычитывание сокета в очередь"""
         while self.running:
             try:
-                data, addr = self.receive_sock.recvfrom(4096)
-                message = json.loads(data.decode('utf-8'))
-                if self.receive_callback:
-                    self.receive_callback(message, addr)
+                item = self.receive_sock.recvfrom(self.RECV_BUFFER_SIZE)
+            except socket.timeout:
+                continue
             except Exception as e:
                 if self.running:
                     rprint(f"[red]Ошибка приема сообщения: {e}[/red]")
+                continue
+            if not self.rate_limiter.allow(item[1][0]):
+                continue
+            try:
+                self._inbox.put_nowait(item)
+            except queue.Full:
+                self.queue_drops += 1
+
+    def _dispatch_loop(self):
+        """Цикл разбора и доставки сообщений из очереди"""
+        while self.running:
+            now = time.monotonic()
+            timeout = self.TICK_INTERVAL
+            for deadline in [self.reorder.next_deadline(), *list(self._flush_due.values())]:
+                if deadline is not None:
+                    timeout = min(timeout, max(0.0, deadline - now))
+            try:
+                item = self._inbox.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is None:
+                self._release()
+            else:
+                self._handle_datagram(*item)
+            self._flush_expired()
+            # Периодическая отправка NACK и объявлений последнего номера
+            if time.monotonic() - self._last_tick >= self.TICK_INTERVAL:
+                self._tick()
+
+
+class Frame:
+    """Сообщение, сериализованное один раз для всех клиентов"""
+
+    __slots__ = ("text", "_deflated")
+
+    DEFLATE_LEVEL = 6
+
+    def __init__(self, message: dict):
+        self.text = json.dumps(message, ensure_ascii=False)
+        self._deflated: Optional[bytes] = None
+
+    @property
+    def deflated(self) -> Optional[bytes]:
+        """Сжатый zlib текст (вычисляется один раз); None, если сжатие не уменьшает размер"""
+        if self._deflated is None:
+            self._deflated = deflate(self.text) or b""
+        return self._deflated or None
+
+
+def deflate(text: str) -> Optional[bytes]:
+    """Сжатие текста кадра; None, если сжатие не уменьшает размер"""
+    data = text.encode("utf-8")
+    packed = zlib.compress(data, Frame.DEFLATE_LEVEL)
+    return packed if len(packed) < len(data) else None
+
+
+class WebSocketClient:
+    """Подключенный WebSocket-клиент со своей ограниченной очередью отправки
+
+    batch: отстающему клиенту накопленные сообщения уходят одним кадром (JSON-массив)
+    deflate: кадры, которые сжимаются, отправляются двоичными (zlib), остальные текстом
+    """
+
+    def __init__(self, websocket: WebSocket, maxsize: int, batch: bool = False, deflate: bool = False,
+                 policy: str = "drop-oldest", max_lag: Optional[float] = None):
+        self.websocket = websocket
+        address = getattr(websocket, "client", None)
+        self.peer = f"{address[0]}:{address[1]}" if address else ""
+        self.maxsize = maxsize
+        self.batch = batch
+        self.deflate = deflate
+        self.policy = policy
+        self.max_lag = max_lag
+        self.queue: deque = deque()  # (время постановки, Frame)
+        self._ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        # Метрики отставания
+        self.sent = 0
+        self.dropped = 0  # Сообщения, отброшенные политикой медленного клиента
+        self.writes = 0
+        self.latency_total = 0.0  # Сумма задержек от постановки в очередь до отправки
+        self.latency_max = 0.0
+
+    def put(self, frame: Frame, now: float) -> bool:
+        """Поставить кадр в очередь по политике клиента; False — клиента нужно отключить"""
+        full = len(self.queue) >= self.maxsize
+        if self.policy == "disconnect":
+            lagging = self.max_lag is not None and self.queue and now - self.queue[0][0] > self.max_lag
+            if full or lagging:
+                return False
+        elif full:
+            self.dropped += 1
+            if self.policy == "drop-newest":
+                return True
+            self.queue.popleft()
+        self.queue.append((now, frame))
+        self._ready.set()
+        return True
+
+    async def take(self, limit: int) -> List[Tuple[float, Frame]]:
+        """Дождаться и забрать до limit кадров из очереди"""
+        while not self.queue:
+            self._ready.clear()
+            await self._ready.wait()
+        return [self.queue.popleft() for _ in range(min(limit, len(self.queue)))]
+
+    def record(self, count: int, latency: float):
+        self.sent += count
+        self.writes += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "latency_avg": self.latency_total / self.writes if self.writes else 0.0,
+            "latency_max": self.latency_max,
+            "peer": self.peer,
+        }
+
+
+class WebSocketHub:
+    """Рассылка сообщений WebSocket-клиентам и мост с широковещательной передачей UDP
+
+    У каждого клиента своя очередь и своя задача отправки, поэтому медленный
+    клиент не задерживает остальных. Сообщение сериализуется (и при
+    необходимости сжимается) один раз, в очереди клиентов попадает общий Frame.
+
+    Политика медленного клиента задается для точки подключения:
+    drop-oldest / drop-newest отбрасывают сообщения сверх queue_size,
+    disconnect отключает клиента, если в очереди больше queue_size сообщений
+    или самое старое ждет дольше max_lag секунд. Память на клиента всегда
+    ограничена queue_size кадрами.
+    """
+
+    MAX_BATCH = 64  # Сколько накопленных сообщений отправлять одним кадром
+    POLICIES = ("drop-oldest", "drop-newest", "disconnect")
+
+    def __init__(self, broadcaster: MessageBroadcaster, queue_size: int = 256, policy: str = "drop-oldest",
+                 max_lag: Optional[float] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Неизвестная политика медленного клиента: {policy}")
+        self.broadcaster = broadcaster
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_lag = max_lag
+        self.clients: Set[WebSocketClient] = set()
+        self.evicted = 0  # Клиенты, отключенные политикой disconnect
+        self._bridge: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск пересылки сообщений из UDP клиентам (в цикле событий broadcaster)"""
+        if self._bridge is None:
+            self._bridge = asyncio.ensure_future(self._bridge_loop())
+
+    async def _bridge_loop(self):
+        async for message, addr in self.broadcaster.subscribe(self.queue_size):
+            self.publish(message)
+
+    async def connect(self, websocket: WebSocket, batch: bool = False, deflate: bool = False) -> WebSocketClient:
+        """Принять соединение и запустить задачу отправки клиенту"""
+        await websocket.accept()
+        client = WebSocketClient(websocket, self.queue_size, batch, deflate, self.policy, self.max_lag)
+        client.task = asyncio.ensure_future(self._send_loop(client))
+        self.clients.add(client)
+        return client
+
+    def disconnect(self, client: WebSocketClient):
+        """Отключить клиента и остановить его задачу отправки"""
+        self.clients.discard(client)
+        client.queue.clear()
+        if client.task is not None:
+            client.task.cancel()
+
+    def _evict(self, client: WebSocketClient):
+        """Отключение отставшего клиента с кодом 1008 (нарушение политики)"""
+        self.evicted += 1
+        self.disconnect(client)
+        asyncio.ensure_future(self._close(client.websocket))
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int = 1008):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _send_loop(self, client: WebSocketClient):
+        try:
+            while True:
+                items = await client.take(self.MAX_BATCH if client.batch else 1)
+                await self._write(client, [frame for _, frame in items])
+                client.record(len(items), time.monotonic() - items[0][0])
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Ошибка отправки WebSocket клиенту: {e}")
+            # Сначала закрыть сокет: disconnect отменяет текущую задачу
+            await self._close(client.websocket, code=1011)
+            self.disconnect(client)
+
+    @staticmethod
+    async def _write(client: WebSocketClient, frames: List[Frame]):
+        if len(frames) == 1:
+            text = frames[0].text
+            packed = frames[0].deflated if client.deflate else None
+        else:
+            # Пакет собирается из уже сериализованных сообщений без повторного json.dumps
+            text = "[" + ",".join(frame.text for frame in frames) + "]"
+            packed = deflate(text) if client.deflate else None
+        if packed is not None:
+            await client.websocket.send_bytes(packed)
+        else:
+            await client.websocket.send_text(text)
+
+    def publish(self, message: dict, exclude: Optional[WebSocketClient] = None):
+        """Поставить сообщение в очереди всех клиентов (не ждет отправки)"""
+        if not self.clients:
+            return
+        frame = Frame(message)
+        now = time.monotonic()
+        for client in list(self.clients):
+            if client is not exclude and not client.put(frame, now):
+                self._evict(client)
+
+    def send(self, message: dict, client: Optional[WebSocketClient] = None):
+        """Сообщение от WebSocket-клиента: в сеть по UDP и остальным клиентам"""
+        if self.broadcaster.broadcast(message):
+            self.publish(message, exclude=client)
+
+    def stats(self) -> dict:
+        clients = [client.stats() for client in self.clients]
+        return {
+            "clients": len(clients),
+            "queued": sum(client["depth"] for client in clients),
+            "dropped": sum(client["dropped"] for client in clients),
+            "evicted": self.evicted,
+            "policy": self.policy,
+            "per_client": clients,
+        }
+
+
+history = HistoryStore()
+broadcaster = MessageBroadcaster(history=history)
+# Чат-клиенты важнее полноты: отставшему клиенту отбрасываются самые старые сообщения
+hub = WebSocketHub(broadcaster, queue_size=256, policy="drop-oldest")
+
+
+@app.get("/stats")
+async def get_stats():
+    """Статистика доставки широковещательных сообщений"""
+    return dict(broadcaster.stats(), websocket=hub.stats())
+
+_CURSOR = struct.Struct('!Q')
+MAX_SEQ = 2 ** 63 - 1  # Наибольшее целое SQLite; курсор сверх него не может указывать на запись
+SSE_KEEPALIVE = 15.0  # Период комментария-пинга в потоке SSE, секунд
+SSE_PAGE = 500  # Сколько сохраненных сообщений читать за один запрос при догоне
+
+
+def encode_cursor(seq: int) -> str:
+    """Непрозрачный курсор из локального номера сообщения в истории"""
+    return base64.urlsafe_b64encode(_CURSOR.pack(seq)).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        seq = _CURSOR.unpack(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))[0]
+    except (binascii.Error, struct.error, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    if seq > MAX_SEQ:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    return seq
+
+
+def _with_cursor(message: dict) -> dict:
+    message = dict(message)
+    message["cursor"] = encode_cursor(message.pop("seq"))
+    return message
+
+
+@app.get("/history")
+def get_history(cursor: Optional[str] = None, limit: int = 100, room: Optional[str] = None,
+                sender: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None):
+    """Постраничное чтение истории от курсора (без курсора — с начала)
+
+    Ответ содержит курсор для следующей страницы; пустая страница означает,
+    что клиент догнал историю и может продолжить с того же курсора.
+    """
+    seq = decode_cursor(cursor)
+    messages = history.after(seq, room=room, sender=sender, since=since, until=until,
+                             limit=min(max(limit, 1), 1000))
+    if messages:
+        seq = messages[-1]["seq"]
+    return {"messages": [_with_cursor(message) for message in messages], "cursor": encode_cursor(seq)}
+
+
+@app.get("/history/stream")
+async def stream_history(request: Request, cursor: Optional[str] = None, room: Optional[str] = None):
+    """Server-Sent Events: сохраненные сообщения после курсора, затем новые
+
+    Поток читает только из истории и ждет уведомления о записи, поэтому между
+    догоном и живым потоком нет разрыва. Без курсора поток начинается с текущего
+    конца истории; при переподключении учитывается заголовок Last-Event-ID.
+    """
+    cursor = request.headers.get("last-event-id") or cursor
+    loop = asyncio.get_running_loop()
+    seq = decode_cursor(cursor) if cursor else await loop.run_in_executor(None, history.last_seq)
+
+    async def events():
+        nonlocal seq
+        written = asyncio.Event()
+
+        def listener():
+            loop.call_soon_threadsafe(written.set)
+
+        history.add_listener(listener)
+        try:
+            while True:
+                written.clear()
+                messages = await loop.run_in_executor(
+                    None, lambda: history.after(seq, room=room, limit=SSE_PAGE))
+                for message in messages:
+                    seq = message["seq"]
+                    data = json.dumps(_with_cursor(message), ensure_ascii=False)
+                    yield f"id: {encode_cursor(seq)}\nevent: message\ndata: {data}\n\n"
+                if len(messages) == SSE_PAGE:
+                    continue
+                try:
+                    await asyncio.wait_for(written.wait(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            history.remove_listener(listener)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/presence")
+async def get_presence():
+    """Участники комнаты по последним heartbeat: имя, состояние, IP"""
+    return broadcaster.peers.peers()
+
+
+@app.get("/search")
+def search_history(q: str, room: Optional[str] = None, limit: int = 50):
+    """Полнотекстовый поиск по истории (все слова запроса, сначала новые)
+
+    Как и в /history, локальный номер сообщения заменен курсором: с него
+    можно читать /history, чтобы показать сообщения после найденного.
+    """
+    return [_with_cursor(message) for message in history.search(q, room=room, limit=min(max(limit, 1), 500))]
+
+
+@app.get("/sync/digest")
+def get_sync_digest(prefix: Optional[int] = None):
+    """Суммы дерева истории для синхронизации с другими узлами"""
+    if prefix is not None and not 0 <= prefix <= 0xFF:
+        raise HTTPException(status_code=400, detail="Префикс вне диапазона 0..255")
+    return history.digest(prefix)
+
+
+@app.get("/sync/ids")
+def get_sync_ids(bucket: int):
+    """Идентификаторы сообщений одного листа дерева истории"""
+    if not 0 <= bucket <= 0xFFFF:
+        raise HTTPException(status_code=400, detail="Лист вне диапазона 0..65535")
+    return history.bucket_ids(bucket)
+
+
+@app.post("/sync/messages")
+def get_sync_messages(ids: List[str] = Body(..., embed=True)):
+    """Сообщения истории по идентификаторам"""
+    return history.get_many(ids[:1000])
 
-broadcaster = MessageBroadcaster()
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await broadcaster.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, batch: bool = False, deflate: bool = False):
+    """Чат через WebSocket; batch и deflate включают пакеты и сжатие кадров для клиента
+
+    Обычные клиенты получают сжатие через permessage-deflate, если сервер его
+    согласовал. Клиенту с deflate=true его предлагать незачем: кадры хаба уже
+    сжаты (или сервер запускается с --no-ws-deflate).
+    """
+    client = await hub.connect(websocket, batch, deflate)
     try:
         while True:
             data = await websocket.receive_json()
-            # Широковещательная передача полученного сообщения
-            await broadcaster.broadcast(data, websocket)
+            if isinstance(data, dict):
+                # Широковещательная передача полученного сообщения
+                hub.send(data, client)
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         print(f"Ошибка WebSocket соединения: {e}")
     finally:
-        broadcaster.disconnect(websocket)
+        hub.disconnect(client)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""Присутствие участников: в сети, отошел, печатает
+
+Каждый узел периодически отправляет в группу комнаты короткий heartbeat
+(wire.TYPE_PRESENCE). Состояние передается только при изменении: обычный
+heartbeat содержит номер версии состояния и период, имя пользователя
+добавляется лишь после изменения и в каждом full_every-м сообщении для
+узлов, подключившихся позже. Получатель забывает узел, если heartbeat не
+приходил ttl_factor объявленных периодов.
+
+Период растет с числом узлов, поэтому суммарный поток heartbeat в сети
+остается примерно постоянным (target_rate сообщений в секунду).
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional
+
+OFFLINE = 0
+ONLINE = 1
+AWAY = 2
+TYPING = 3
+
+STATE_NAMES = {OFFLINE: "offline", ONLINE: "online", AWAY: "away", TYPING: "typing"}
+
+
+def heartbeat_interval(peers: int, target_rate: float = 2.0, minimum: float = 5.0,
+                       maximum: float = 60.0) -> float:
+    """Период heartbeat, при котором все peers + 1 узлов вместе шлют около target_rate в секунду"""
+    return min(maximum, max(minimum, (peers + 1) / target_rate))
+
+
+class Heartbeat(NamedTuple):
+    state: int
+    version: int
+    interval: float
+    username: Optional[str]  # None — имя не изменилось
+
+
+class Presence:
+    """Собственное состояние узла и расписание отправки heartbeat"""
+
+    TYPING_TIMEOUT = 5.0  # Через сколько секунд без набора "печатает" сменяется на "в сети"
+
+    def __init__(self, full_every: int = 5):
+        self.username: Optional[str] = None
+        self.state = ONLINE
+        self.version = 0
+        self.full_every = full_every
+        self._changed = True
+        self._typing_at = 0.0
+        self._next = 0.0
+        self._count = 0
+
+    def set(self, state: int, username: Optional[str] = None, now: Optional[float] = None):
+        """Смена состояния; heartbeat уйдет при ближайшей проверке"""
+        now = time.monotonic() if now is None else now
+        if state == TYPING:
+            self._typing_at = now
+        if (state, username or self.username) == (self.state, self.username):
+            return
+        self.state = state
+        self.username = username or self.username
+        self.version = (self.version + 1) & 0xFFFFFFFF
+        self._changed = True
+
+    def due(self, now: float, peers: int) -> Optional[Heartbeat]:
+        """Heartbeat для отправки сейчас (при изменении или по расписанию) или None"""
+        if self.username is None:
+            return None
+        if self.state == TYPING and now - self._typing_at > self.TYPING_TIMEOUT:
+            self.set(ONLINE, now=now)
+        if not self._changed and now < self._next:
+            return None
+        interval = heartbeat_interval(peers)
+        full = self._changed or self._count % self.full_every == 0
+        self._changed = False
+        self._count += 1
+        # Разброс периода не дает узлам синхронизироваться
+        self._next = now + interval * random.uniform(0.9, 1.1)
+        return Heartbeat(self.state, self.version, interval, self.username if full else None)
+
+
+class PeerPresence(NamedTuple):
+    username: Optional[str]
+    state: int
+    version: int
+    ip: str
+    expires: float
+
+
+class PresenceTracker:
+    """Состояние других узлов с истечением по TTL"""
+
+    def __init__(self, ttl_factor: float = 3.0, max_peers: int = 1024):
+        self.ttl_factor = ttl_factor
+        self.max_peers = max_peers
+        self.changes = 0  # Растет при каждом видимом изменении (для обновления интерфейса)
+        self._peers: "OrderedDict[bytes, PeerPresence]" = OrderedDict()
+        self._lock = threading.Lock()  # Обновляет поток приема, читает интерфейс
+
+    def __len__(self) -> int:
+        return len(self._peers)
+
+    def update(self, sender: bytes, heartbeat: Heartbeat, ip: str, now: Optional[float] = None):
+        """Учет полученного heartbeat"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            known = self._peers.pop(sender, None)
+            if heartbeat.state == OFFLINE:
+                self.changes += known is not None
+                return
+            username = heartbeat.username or (known.username if known else None)
+            peer = PeerPresence(username, heartbeat.state, heartbeat.version, ip,
+                                now + heartbeat.interval * self.ttl_factor)
+            if known is None or (known.username, known.state) != (peer.username, peer.state):
+                self.changes += 1
+            self._peers[sender] = peer
+            while len(self._peers) > self.max_peers:
+                self._peers.popitem(last=False)
+                self.changes += 1
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Удаление узлов, от которых давно не было heartbeat; возвращает их число"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = [sender for sender, peer in self._peers.items() if peer.expires <= now]
+            for sender in expired:
+                del self._peers[sender]
+            self.changes += len(expired)
+        return len(expired)
+
+    def peers(self, now: Optional[float] = None) -> List[Dict]:
+        """Известные узлы с именем: [{"username", "state", "ip"}]"""
+        self.expire(now)
+        with self._lock:
+            return [{"username": peer.username, "state": STATE_NAMES[peer.state], "ip": peer.ip}
+                    for peer in self._peers.values() if peer.username is not None]
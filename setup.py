@@ -5,8 +5,8 @@ setup(
     version="0.1.0",
     packages=find_packages(),
     install_requires=[
-        "fastapi>=0.68.0",
-        "uvicorn>=0.15.0",
+        "fastapi>=0.93.0",
+        "uvicorn>=0.17.0",
         "python-multipart>=0.0.5",
         "zeroconf>=0.38.0",
         "aiofiles>=0.8.0",
@@ -0,0 +1,184 @@
+"""Скачивание файла сразу с нескольких узлов по хэшу содержимого (swarm)
+
+Узлы, у которых есть файл с нужным SHA-256, находятся опросом обнаруженных
+устройств (/file/blobs/<хэш>/chunks); от первого ответившего берется список
+хэшей частей. У каждого узла несколько потоков, которые берут следующую
+часть из общей очереди, поэтому быстрый узел сам получает больше частей.
+Каждая часть пишется по своему смещению и проверяется по своему хэшу;
+часть с неверным хэшем или оборванная возвращается в очередь, а узел после
+MAX_FAILURES ошибок исключается. В конце загрузки медленный узел не берет
+оставшиеся части, если быстрые узлы закончат их раньше. Хэш всего файла
+считается по мере готовности начала файла и проверяется в конце.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import requests
+
+from transfer import DEFAULT_CHUNK_SIZE, read_range
+
+REQUESTS_PER_PEER = 2  # Одновременных запросов к одному узлу
+MAX_FAILURES = 3  # Ошибок, после которых узел исключается
+SLOW_FACTOR = 2.0  # Во сколько раз узел должен быть медленнее лучшего, чтобы уступать ему части
+
+
+class Peer:
+    """Узел-источник и его измеренная скорость"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.speed = 0.0  # Байт в секунду, скользящее среднее
+        self.received = 0
+        self.failures = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.failures < MAX_FAILURES
+
+    def record(self, size: int, elapsed: float):
+        speed = size / max(elapsed, 1e-6)
+        self.speed = speed if not self.speed else 0.7 * self.speed + 0.3 * speed
+        self.received += size
+
+
+def find_peers(digest: str, base_urls: Iterable[str], chunk_size: int = DEFAULT_CHUNK_SIZE,
+               timeout: float = 5.0) -> Tuple[List[Peer], Optional[dict]]:
+    """Узлы, у которых есть файл, и список хэшей его частей
+
+    Узлы, чей список частей расходится с первым полученным, не используются.
+    """
+    def ask(base_url):
+        try:
+            response = requests.get(f"{base_url}/file/blobs/{digest}/chunks",
+                                    params={"chunk_size": chunk_size}, timeout=timeout)
+            return response.json() if response.status_code == 200 else None
+        except (requests.RequestException, ValueError):
+            return None
+
+    base_urls = list(dict.fromkeys(base_urls))
+    if not base_urls:
+        return [], None
+    with ThreadPoolExecutor(min(len(base_urls), 32)) as pool:
+        answers = list(pool.map(ask, base_urls))
+    manifest = next((answer for answer in answers if answer is not None), None)
+    peers = [Peer(base_url) for base_url, answer in zip(base_urls, answers)
+             if answer is not None and answer == manifest]
+    return peers, manifest
+
+
+class SwarmDownload:
+    """Загрузка одного файла с нескольких узлов в заранее выделенный файл"""
+
+    def __init__(self, digest: str, manifest: dict, peers: List[Peer], destination: str,
+                 on_progress: Optional[Callable[[int], None]] = None, timeout: float = 30.0):
+        self.digest = digest
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.chunks = manifest["chunks"]
+        self.peers = peers
+        self.destination = destination
+        self.part_path = destination + ".part"
+        self.on_progress = on_progress
+        self.timeout = timeout
+        self._pending = deque(range(len(self.chunks)))
+        self._in_flight = 0
+        self._done = [False] * len(self.chunks)
+        self._cond = threading.Condition()
+        # SHA-256 готового начала файла: [хэш, номер первой не учтенной части]
+        self._whole = [hashlib.sha256(), 0]
+        self._hash_lock = threading.Lock()
+
+    def run(self) -> int:
+        """Скачать файл; возвращает размер. ValueError — хэш файла не совпал"""
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.size)
+        workers = [peer for peer in self.peers for _ in range(REQUESTS_PER_PEER)]
+        with ThreadPoolExecutor(max(1, len(workers))) as pool:
+            list(pool.map(self._worker, workers))
+        if self._pending or not all(self._done):
+            raise RuntimeError("Ни один узел не смог отдать оставшиеся части файла")
+        self._advance_hash()
+        if self._whole[0].hexdigest() != self.digest:
+            os.remove(self.part_path)
+            raise ValueError("Хэш скачанного файла не совпадает")
+        os.replace(self.part_path, self.destination)
+        return self.size
+
+    def _worker(self, peer: Peer):
+        while (index := self._next_chunk(peer)) is not None:
+            ok = self._fetch(peer, index)
+            with self._cond:
+                self._in_flight -= 1
+                if ok:
+                    self._done[index] = True
+                else:
+                    peer.failures += 1
+                    self._pending.appendleft(index)
+                self._cond.notify_all()
+            if ok:
+                self._advance_hash()
+
+    def _next_chunk(self, peer: Peer) -> Optional[int]:
+        with self._cond:
+            while peer.alive:
+                if self._pending and not self._yields(peer):
+                    self._in_flight += 1
+                    return self._pending.popleft()
+                if not self._pending and not self._in_flight:
+                    return None
+                # Ждем возврата части после ошибки или уступаем хвост быстрым узлам
+                self._cond.wait(timeout=1.0)
+            return None
+
+    def _yields(self, peer: Peer) -> bool:
+        """Оставить оставшиеся части быстрым узлам: они закончат их раньше"""
+        if not peer.speed:
+            return False
+        fast_slots = sum(REQUESTS_PER_PEER for other in self.peers
+                         if other.alive and other.speed >= peer.speed * SLOW_FACTOR)
+        return len(self._pending) <= fast_slots
+
+    def _fetch(self, peer: Peer, index: int) -> bool:
+        """Получить часть, записать по смещению и проверить хэш"""
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, self.size)
+        digest = hashlib.sha256()
+        started = time.monotonic()
+        try:
+            with requests.get(f"{peer.base_url}/file/blobs/{self.digest}",
+                              headers={"Range": f"bytes={start}-{end - 1}"},
+                              stream=True, timeout=self.timeout) as response:
+                if response.status_code != 206:
+                    return False
+                with open(self.part_path, "r+b") as f:
+                    f.seek(start)
+                    position = start
+                    for data in response.iter_content(1024 * 1024):
+                        data = data[:end - position]
+                        f.write(data)
+                        digest.update(data)
+                        position += len(data)
+        except (requests.RequestException, OSError):
+            return False
+        if position != end or digest.hexdigest() != self.chunks[index]:
+            return False
+        peer.record(end - start, time.monotonic() - started)
+        if self.on_progress:
+            self.on_progress(end - start)
+        return True
+
+    def _advance_hash(self):
+        """Продвинуть хэш всего файла по готовым частям с начала (чтение идет из кэша ОС)"""
+        with self._hash_lock:
+            whole, index = self._whole
+            while index < len(self.chunks) and self._done[index]:
+                start = index * self.chunk_size
+                for data in read_range(self.part_path, start, min(start + self.chunk_size, self.size)):
+                    whole.update(data)
+                index += 1
+            self._whole[1] = index
@@ -0,0 +1,64 @@
+"""Синхронизация истории с другими узлами (anti-entropy)
+
+Узел спускается по дереву сумм соседа (history.HistoryStore.digest) только
+в расходящиеся ветви и запрашивает лишь отсутствующие у него сообщения.
+Обмен идет через HTTP-приложение сообщений (/message/sync/...).
+"""
+from typing import Iterable, List
+
+import requests
+
+from history import HistoryStore
+
+FETCH_BATCH = 500  # Сколько сообщений запрашивать за один запрос
+
+
+def _nodes(response: requests.Response) -> dict:
+    response.raise_for_status()
+    return {int(node): tuple(value) for node, value in response.json().items()}
+
+
+def missing_ids(store: HistoryStore, base_url: str, timeout: float = 5.0) -> List[str]:
+    """Идентификаторы сообщений, которые есть у соседа и нет у нас"""
+    url = f"{base_url}/message/sync"
+    remote = _nodes(requests.get(f"{url}/digest", timeout=timeout))
+    local = store.digest()
+    missing = []
+    for prefix, node in remote.items():
+        if local.get(prefix) == node:
+            continue
+        remote_leaves = _nodes(requests.get(f"{url}/digest", params={"prefix": prefix}, timeout=timeout))
+        local_leaves = store.digest(prefix)
+        for bucket, leaf in remote_leaves.items():
+            if local_leaves.get(bucket) == leaf:
+                continue
+            response = requests.get(f"{url}/ids", params={"bucket": bucket}, timeout=timeout)
+            response.raise_for_status()
+            known = set(store.bucket_ids(bucket))
+            missing.extend(msg_id for msg_id in response.json() if msg_id not in known)
+    return missing
+
+
+def sync_from_peer(store: HistoryStore, base_url: str, timeout: float = 5.0) -> List[dict]:
+    """Загрузка недостающих сообщений с одного узла; возвращает новые сообщения"""
+    ids = missing_ids(store, base_url, timeout)
+    messages = []
+    for start in range(0, len(ids), FETCH_BATCH):
+        response = requests.post(f"{base_url}/message/sync/messages",
+                                 json={"ids": ids[start:start + FETCH_BATCH]}, timeout=timeout)
+        response.raise_for_status()
+        messages.extend(response.json())
+    store.insert(messages)
+    return messages
+
+
+def sync_with_peers(store: HistoryStore, devices: Iterable[dict], timeout: float = 5.0) -> List[dict]:
+    """Синхронизация со всеми обнаруженными устройствами; недоступные узлы пропускаются"""
+    received = {}
+    for device in devices:
+        try:
+            for message in sync_from_peer(store, f"http://{device['ip']}:{device['port']}", timeout):
+                received[message["id"]] = message
+        except Exception as e:
+            print(f"Не удалось синхронизировать историю с {device.get('name', device['ip'])}: {e}")
+    return sorted(received.values(), key=lambda message: message["ts"])
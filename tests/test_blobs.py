@@ -0,0 +1,86 @@
+import hashlib
+import pytest
+import sys
+import os
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobs import BlobStore
+
+
+def store_bytes(store, data):
+    with store.writer() as writer:
+        writer.write(data)
+        return writer.commit()
+
+
+class TestBlobStore:
+    """Тесты для хранилища файлов по содержимому"""
+
+    def test_duplicate_stored_once(self, tmp_path):
+        """Тест однократного хранения одинакового содержимого"""
+        store = BlobStore(str(tmp_path))
+        digest, added = store_bytes(store, b"installer")
+        assert digest == hashlib.sha256(b"installer").hexdigest() and added
+        assert store_bytes(store, b"installer") == (digest, False)
+
+        blobs = [name for _, _, names in os.walk(store.folder) for name in names
+                 if name != "index.db" and not name.endswith(".chunks")]
+        assert blobs == [digest]
+
+    def test_name_collision_not_overwritten(self, tmp_path):
+        """Тест выдачи нового имени вместо перезаписи чужого файла"""
+        store = BlobStore(str(tmp_path))
+        first, _ = store_bytes(store, b"v1")
+        second, _ = store_bytes(store, b"v2")
+
+        assert store.name("report.pdf", first, 2) == "report.pdf"
+        assert store.name("report.pdf", first, 2) == "report.pdf"
+        assert store.name("report.pdf", second, 2) == "report (2).pdf"
+        assert store.resolve("report.pdf") == (store.path(first), first)
+        assert store.resolve("report (2).pdf") == (store.path(second), second)
+
+    def test_legacy_file_resolved(self, tmp_path):
+        """Тест поиска файла, загруженного до появления индекса"""
+        (tmp_path / "old.txt").write_bytes(b"old")
+        store = BlobStore(str(tmp_path))
+        assert store.resolve("old.txt") == (str(tmp_path / "old.txt"), None)
+        assert store.name("old.txt", store.add_file(str(tmp_path / "old.txt"))[0], 3) == "old (2).txt"
+        assert store.resolve("missing.txt") is None
+
+    def test_failed_write_leaves_nothing(self, tmp_path):
+        """Тест удаления временного файла при оборванной записи"""
+        store = BlobStore(str(tmp_path))
+        with pytest.raises(RuntimeError):
+            with store.writer() as writer:
+                writer.write(b"partial")
+                raise RuntimeError("обрыв")
+        assert os.listdir(store.folder) == ["index.db"]
+
+    def test_chunk_hashes_at_ingest(self, tmp_path):
+        """Тест хэшей частей, посчитанных при записи блоками, не совпадающими с частями"""
+        store = BlobStore(str(tmp_path), chunk_size=1000)
+        data = os.urandom(3000)
+        with store.writer() as writer:
+            for start in range(0, len(data), 700):
+                writer.write(data[start:start + 700])
+            digest, _ = writer.commit()
+        expected = [hashlib.sha256(data[i:i + 1000]).hexdigest() for i in range(0, 3000, 1000)]
+        assert writer.chunks == expected
+        os.remove(store.path(digest))  # Список частей читается без файла
+        assert store.chunk_hashes(digest, 1000) == expected
+
+    def test_chunk_hashes(self, tmp_path):
+        """Тест хэшей частей и их сохранения рядом с файлом"""
+        store = BlobStore(str(tmp_path))
+        data = os.urandom(2500)
+        digest, _ = store_bytes(store, data)
+        expected = [hashlib.sha256(data[i:i + 1000]).hexdigest() for i in range(0, 2500, 1000)]
+        assert store.chunk_hashes(digest, 1000) == expected
+        assert os.path.exists(store.path(digest) + ".1000.chunks")
+        assert store.chunk_hashes(digest, 1000) == expected
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,302 @@
+import functools
+import json
+import pytest
+import sys
+import os
+import requests
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import commands
+import file_tsf
+import swarm
+from blobs import BlobStore
+from commands import CommandHandler
+from transfer import FileCache, split_ranges
+
+SOURCE = "10.0.0.1:8000"
+PEER = "10.0.0.2:8000"
+CHUNK = 64 * 1024
+DATA = os.urandom(300 * 1024)
+
+
+class Response:
+    """Ответ в виде requests.Response (то, что использует клиент)"""
+
+    def __init__(self, status_code: int, content: bytes = b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+    def iter_content(self, size: int):
+        for start in range(0, len(self.content), size):
+            yield self.content[start:start + size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Network:
+    """Замена requests: SOURCE и PEER обслуживает приложение файлов, остальные узлы недоступны
+
+    hooks(method, host, path, headers, params) могут подменить ответ или выбросить исключение.
+    """
+
+    RequestException = requests.RequestException
+    ConnectionError = requests.ConnectionError
+    HTTPError = requests.HTTPError
+
+    def __init__(self, devices: list):
+        app = FastAPI()
+        app.mount("/file", file_tsf.app)
+        self.client = TestClient(app)
+        self.devices = devices
+        self.hooks = []
+        self.log = []  # (метод, узел, путь, заголовки, параметры)
+
+    def request(self, method, url, params=None, headers=None, json=None, data=None, stream=False, timeout=None):
+        host, path = url.split("//", 1)[1].split("/", 1)
+        path, headers = "/" + path, dict(headers or {})
+        for hook in self.hooks:
+            response = hook(method, host, path, headers, params or {})
+            if response is not None:
+                return response
+        if path == "/discovery/devices":
+            return Response(200, self._json(self.devices))
+        if host not in (SOURCE, PEER):
+            raise requests.ConnectionError(url)
+        self.log.append((method, host, path, headers, params))
+        if data is not None and not isinstance(data, bytes):
+            data = b"".join(data)
+        response = self.client.request(method, path, params=params, headers=headers, json=json, content=data)
+        return Response(response.status_code, response.content, response.headers)
+
+    @staticmethod
+    def _json(value) -> bytes:
+        return json.dumps(value).encode()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Хранилище приложения файлов во временном каталоге; скачанные файлы пишутся в tmp_path"""
+    store = BlobStore(str(tmp_path / "uploads"), chunk_size=CHUNK)
+    monkeypatch.setattr(file_tsf, "blobs", store)
+    monkeypatch.setattr(file_tsf, "cache", FileCache())
+    monkeypatch.setattr(file_tsf, "SESSION_FOLDER", str(tmp_path / "sessions"))
+    monkeypatch.chdir(tmp_path)
+    return store
+
+
+@pytest.fixture
+def network(store, monkeypatch):
+    stub = Network([{"name": "peer", "ip": PEER.split(":")[0], "port": 8000}])
+    monkeypatch.setattr(commands, "requests", stub)
+    monkeypatch.setattr(swarm, "requests", stub)
+    return stub
+
+
+def share(store: BlobStore, name: str, data: bytes) -> str:
+    """Положить файл в хранилище под именем; возвращает его хэш"""
+    with store.writer() as writer:
+        writer.write(data)
+        digest, _ = writer.commit()
+    store.name(name, digest, len(data))
+    return digest
+
+
+def ranges(network: Network) -> list:
+    """Запрошенные части файла, кроме первого байта (проба размера и ETag)"""
+    return sorted(headers["Range"] for method, _, _, headers, _ in network.log
+                  if method == "GET" and headers.get("Range") not in (None, "bytes=0-0"))
+
+
+class TestUploadResumable:
+    """Тесты загрузки по частям с докачкой из клиента"""
+
+    def test_resume_after_partial_upload(self, store, network, tmp_path):
+        """Тест продолжения прерванной загрузки: повторно отправляется только недошедшая часть"""
+        path = tmp_path / "big.bin"
+        path.write_bytes(DATA)
+        url = f"http://{SOURCE}/file/upload"
+
+        def part_lost(method, host, path, headers, params):
+            if method == "PUT" and params.get("offset") == 2 * CHUNK:
+                raise requests.ConnectionError("обрыв")
+
+        network.hooks.append(part_lost)
+        with pytest.raises(requests.ConnectionError):
+            CommandHandler("127.0.0.1", 8000).upload_resumable(str(path), url)
+        (session,) = os.listdir(file_tsf.SESSION_FOLDER)
+        assert network.client.get(f"/file/upload/sessions/{session}").json()["missing"] == [[2 * CHUNK, 3 * CHUNK]]
+
+        network.hooks.clear()
+        network.log.clear()
+        assert CommandHandler("127.0.0.1", 8000).upload_resumable(str(path), url)
+        assert [params["offset"] for method, _, _, _, params in network.log if method == "PUT"] == [2 * CHUNK]
+
+        found = store.resolve("big.bin")
+        with open(found[0], "rb") as f:
+            assert f.read() == DATA
+        assert os.path.exists(store.path(found[1]) + f".{CHUNK}.chunks")
+        assert os.listdir(file_tsf.SESSION_FOLDER) == []
+
+    def test_existing_content_not_sent(self, store, network, tmp_path):
+        """Тест загрузки содержимого, которое уже есть на сервере: данные не отправляются"""
+        share(store, "original.bin", DATA)
+        path = tmp_path / "copy.bin"
+        path.write_bytes(DATA)
+
+        assert CommandHandler("127.0.0.1", 8000).upload_resumable(str(path), f"http://{SOURCE}/file/upload")
+        assert not [method for method, *_ in network.log if method == "PUT"]
+        assert store.resolve("copy.bin")[1] == store.resolve("original.bin")[1]
+
+
+class TestSegmentedDownload:
+    """Тесты скачивания несколькими диапазонами из клиента"""
+
+    @pytest.fixture(autouse=True)
+    def small_segments(self, monkeypatch):
+        monkeypatch.setattr(commands, "MIN_SEGMENT", CHUNK)
+
+    def url(self, name: str) -> str:
+        return f"http://{SOURCE}/file/download/{name}"
+
+    def test_segments_assembled(self, store, network):
+        """Тест сборки файла из параллельно скачанных частей"""
+        share(store, "data.bin", DATA)
+        assert CommandHandler("127.0.0.1", 8000).download_segmented(self.url("data.bin"), "out.bin") == len(DATA)
+        with open("out.bin", "rb") as f:
+            assert f.read() == DATA
+        assert not os.path.exists("out.bin.part")
+        assert ranges(network) == sorted(
+            f"bytes={start}-{end - 1}" for start, end in split_ranges([(0, len(DATA))], CHUNK))
+
+    def test_overlong_part_clamped(self, store, network, monkeypatch):
+        """Тест части, в ответ на которую сервер прислал больше байт: лишнее не пишется"""
+        share(store, "data.bin", DATA)
+        monkeypatch.setattr(commands, "DOWNLOAD_BLOCK", 24 * 1024)  # Граница части внутри блока
+
+        def too_much(method, host, path, headers, params):
+            byte_range = headers.get("Range")
+            if byte_range and byte_range != "bytes=0-0":
+                start, end = (int(value) for value in byte_range[len("bytes="):].split("-"))
+                return Response(206, DATA[start:end + 1] + b"X" * CHUNK,
+                                {"Content-Range": f"bytes {start}-{end}/{len(DATA)}"})
+
+        network.hooks.append(too_much)
+        CommandHandler("127.0.0.1", 8000).download_segmented(self.url("data.bin"), "out.bin")
+        with open("out.bin", "rb") as f:
+            assert f.read() == DATA
+
+    def test_wrong_part_rejected(self, store, network):
+        """Тест части, которая начинается не с запрошенного байта: файл не собирается"""
+        share(store, "data.bin", DATA)
+
+        def from_start(method, host, path, headers, params):
+            if headers.get("Range") not in (None, "bytes=0-0"):
+                return Response(206, DATA, {"Content-Range": f"bytes 0-{len(DATA) - 1}/{len(DATA)}"})
+
+        network.hooks.append(from_start)
+        with pytest.raises(RuntimeError):
+            CommandHandler("127.0.0.1", 8000).download_segmented(self.url("data.bin"), "out.bin")
+        assert not os.path.exists("out.bin")
+
+    def test_file_changed_during_download(self, store, network):
+        """Тест If-Range: файл на сервере изменился после пробы — скачивание прерывается без подмены"""
+        legacy = os.path.join(store.root, "doc.bin")  # Файл до индекса: ETag из времени изменения
+        with open(legacy, "wb") as f:
+            f.write(DATA)
+        changed = []
+
+        def change_file(method, host, path, headers, params):
+            if headers.get("Range") not in (None, "bytes=0-0") and not changed:
+                changed.append(headers["If-Range"])
+                with open(legacy, "wb") as f:
+                    f.write(DATA[::-1])
+                os.utime(legacy, ns=(1, 1))
+
+        network.hooks.append(change_file)
+        with open("out.bin", "wb") as f:
+            f.write(b"old")
+        with pytest.raises(RuntimeError):
+            CommandHandler("127.0.0.1", 8000).download_segmented(self.url("doc.bin"), "out.bin")
+        assert changed and changed[0].startswith('"')
+        with open("out.bin", "rb") as f:
+            assert f.read() == b"old"
+
+    def test_unchanged_copy_skipped(self, store, network):
+        """Тест 304: совпадающая локальная копия не скачивается"""
+        share(store, "data.bin", DATA)
+        with open("out.bin", "wb") as f:
+            f.write(DATA)
+        assert CommandHandler("127.0.0.1", 8000).download_segmented(self.url("data.bin"), "out.bin") is None
+        assert ranges(network) == []
+
+
+class TestSwarmDownload:
+    """Тесты скачивания с нескольких узлов из клиента"""
+
+    def test_discovery_error_falls_back_to_source(self, store, network):
+        """Тест скачивания с источника, если список устройств получить не удалось"""
+        share(store, "data.bin", DATA)
+
+        def discovery_down(method, host, path, headers, params):
+            if path == "/discovery/devices":
+                raise requests.ConnectionError("discovery недоступен")
+
+        network.hooks.append(discovery_down)
+        CommandHandler("127.0.0.1", 8000).download_file("data.bin", SOURCE)
+        with open("data.bin", "rb") as f:
+            assert f.read() == DATA
+        assert not [path for _, _, path, _, _ in network.log if path.startswith("/file/blobs/")]
+
+    def test_probe_error_falls_back_to_source(self, store, network):
+        """Тест скачивания с источника, если проба ETag не удалась"""
+        share(store, "data.bin", DATA)
+        probes = []
+
+        def first_probe_fails(method, host, path, headers, params):
+            if path == "/file/download/data.bin" and not probes:
+                probes.append(headers)
+                raise requests.ConnectionError("обрыв")
+
+        network.hooks.append(first_probe_fails)
+        CommandHandler("127.0.0.1", 8000).download_file("data.bin", SOURCE)
+        with open("data.bin", "rb") as f:
+            assert f.read() == DATA
+
+    def test_download_from_peers(self, store, network, monkeypatch):
+        """Тест сборки файла по частям с узлов, у которых он есть"""
+        digest = share(store, "data.bin", DATA)
+        monkeypatch.setattr(commands, "find_peers", functools.partial(swarm.find_peers, chunk_size=CHUNK))
+
+        CommandHandler("127.0.0.1", 8000).download_file("data.bin", SOURCE)
+        with open("data.bin", "rb") as f:
+            assert f.read() == DATA
+        parts = [(host, headers["Range"]) for method, host, path, headers, _ in network.log
+                 if path == f"/file/blobs/{digest}" and "Range" in headers]
+        assert sorted(byte_range for _, byte_range in parts) == sorted(
+            f"bytes={start}-{end - 1}" for start, end in split_ranges([(0, len(DATA))], CHUNK))
+        assert {host for host, _ in parts} <= {SOURCE, PEER}
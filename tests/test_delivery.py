@@ -0,0 +1,204 @@
+import pytest
+import sys
+import os
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from delivery import DedupCache, GapTracker, RateLimiter, Reassembler, ReorderBuffer, SendWindow
+
+
+class TestDedupCache:
+    """Тесты для подавления повторов"""
+
+    def test_duplicate_detected(self):
+        """Тест обнаружения повторно полученного сообщения"""
+        cache = DedupCache()
+        assert not cache.check(b"id1", now=0)
+        cache.add(b"id1", now=0)
+        assert cache.check(b"id1", now=1)
+        assert cache.duplicates == 1
+
+    def test_capacity_bounded(self):
+        """Тест фиксированного объема памяти"""
+        cache = DedupCache(capacity=3)
+        for i in range(10):
+            cache.add(i, now=0)
+        assert len(cache) == 3
+        assert not cache.check(0, now=0)
+        assert cache.check(9, now=0)
+
+    def test_window_expiry(self):
+        """Тест забывания старых идентификаторов"""
+        cache = DedupCache(window=10)
+        cache.add("a", now=0)
+        assert not cache.check("a", now=11)
+        cache.add("b", now=20)
+        assert len(cache) == 1
+
+
+class TestReassembler:
+    """Тесты для сборки фрагментированных сообщений"""
+
+    def test_out_of_order_assembly(self):
+        """Тест сборки фрагментов, пришедших не по порядку"""
+        reassembler = Reassembler()
+        assert reassembler.add("m", 1, 3, 6, b"cd", now=0) is None
+        assert reassembler.add("m", 0, 3, 6, b"ab", now=0) is None
+        assert reassembler.add("m", 0, 3, 6, b"ab", now=0) is None  # повтор
+        assert reassembler.add("m", 2, 3, 6, b"ef", now=0) == b"abcdef"
+        assert len(reassembler) == 0
+        assert reassembler.buffered_bytes == 0
+
+    def test_timeout_drops_incomplete(self):
+        """Тест удаления незавершенных сообщений по таймауту"""
+        reassembler = Reassembler(timeout=1.0)
+        reassembler.add("old", 0, 2, 4, b"ab", now=0)
+        reassembler.add("new", 0, 2, 4, b"ab", now=5)
+        assert len(reassembler) == 1
+        assert reassembler.stats["expired"] == 1
+        assert reassembler.add("old", 1, 2, 4, b"cd", now=5) is None
+
+    def test_memory_cap_evicts_oldest(self):
+        """Тест ограничения памяти под фрагменты"""
+        reassembler = Reassembler(max_bytes=200)
+        for i in range(10):
+            reassembler.add(i, 0, 2, 8, b"abcd", now=0)
+        assert reassembler.buffered_bytes <= 200
+        assert reassembler.stats["evicted"] > 0
+
+    def test_oversized_message_rejected(self):
+        """Тест отказа от слишком больших сообщений"""
+        reassembler = Reassembler(max_message_size=100)
+        assert reassembler.add("m", 0, 2, 1000, b"x", now=0) is None
+        assert reassembler.stats["rejected"] == 1
+        assert len(reassembler) == 0
+
+
+class TestGapTracker:
+    """Тесты для обнаружения пропусков и NACK"""
+
+    def test_gap_detected_and_repaired(self):
+        """Тест запроса и восстановления пропущенного сообщения"""
+        tracker = GapTracker(nack_delay=0.05)
+        assert tracker.receive("s", 1, now=0)
+        assert tracker.receive("s", 4, now=0)
+        assert tracker.due_nacks(now=0) == {}
+        assert tracker.due_nacks(now=0.1) == {"s": [2, 3]}
+
+        assert tracker.receive("s", 2, now=0.2)
+        assert tracker.receive("s", 3, now=0.2)
+        assert tracker.stats["repaired"] == 2
+        assert tracker.missing_count() == 0
+
+    def test_duplicates_dropped(self):
+        """Тест отбрасывания повторно переданных сообщений"""
+        tracker = GapTracker()
+        assert tracker.receive("s", 1, now=0)
+        assert not tracker.receive("s", 1, now=0)
+        assert tracker.stats["duplicates"] == 1
+
+    def test_lost_after_max_attempts(self):
+        """Тест признания сообщения потерянным"""
+        tracker = GapTracker(nack_delay=0, nack_interval=1, max_attempts=2)
+        tracker.receive("s", 1, now=0)
+        tracker.announce("s", 2, now=0)
+        assert tracker.due_nacks(now=0) == {"s": [2]}
+        assert tracker.due_nacks(now=1) == {"s": [2]}
+        assert tracker.due_nacks(now=2) == {}
+        assert tracker.stats["lost"] == 1
+
+    def test_suppress_delays_nack(self):
+        """Тест подавления NACK, уже отправленного другим узлом"""
+        tracker = GapTracker(nack_delay=0, nack_interval=1)
+        tracker.receive("s", 1, now=0)
+        tracker.receive("s", 3, now=0)
+        tracker.suppress("s", [2], now=0)
+        assert tracker.due_nacks(now=0.5) == {}
+        assert tracker.due_nacks(now=1) == {"s": [2]}
+
+
+class TestSendWindow:
+    """Тесты для окна повторной передачи"""
+
+    def test_bounded_window(self):
+        """Тест ограничения размера окна"""
+        window = SendWindow(size=2, min_interval=0)
+        for seq in range(1, 4):
+            window.add(seq, [b"d%d" % seq], now=0)
+        assert len(window) == 2
+        assert window.retransmit(1, now=1) is None
+        assert window.retransmit(3, now=1) == [b"d3"]
+
+    def test_retransmit_rate_limited(self):
+        """Тест защиты от повторов на множество одинаковых NACK"""
+        window = SendWindow(min_interval=0.05)
+        window.add(1, [b"x"], now=0)
+        assert window.retransmit(1, now=0.1) == [b"x"]
+        assert window.retransmit(1, now=0.12) is None
+
+
+class TestRateLimiter:
+    """Тесты для ограничения частоты по отправителям"""
+
+    def test_burst_then_throttle(self):
+        """Тест отбрасывания датаграмм сверх допустимого всплеска"""
+        limiter = RateLimiter(rate=10, burst=5)
+        assert all(limiter.allow("noisy", now=0) for _ in range(5))
+        assert not limiter.allow("noisy", now=0)
+        assert limiter.throttled() == {"noisy": 1}
+
+    def test_refill_over_time(self):
+        """Тест пополнения токенов со временем"""
+        limiter = RateLimiter(rate=10, burst=1)
+        assert limiter.allow("s", now=0)
+        assert not limiter.allow("s", now=0.05)
+        assert limiter.allow("s", now=0.2)
+
+    def test_senders_isolated(self):
+        """Тест независимости лимитов разных отправителей"""
+        limiter = RateLimiter(rate=1, burst=1)
+        limiter.allow("noisy", now=0)
+        assert not limiter.allow("noisy", now=0)
+        assert limiter.allow("quiet", now=0)
+
+
+class TestReorderBuffer:
+    """Тесты для причинного упорядочивания сообщений"""
+
+    def test_reply_released_after_question(self):
+        """Тест выпуска ответа после вопроса, пришедшего позже"""
+        buffer = ReorderBuffer(hold=0.1)
+        buffer.push(5, "ответ", now=0)
+        buffer.push(4, "вопрос", now=0.05)
+        assert buffer.pop_ready(now=0.09) == []
+        assert buffer.pop_ready(now=0.2) == ["вопрос", "ответ"]
+        assert buffer.stats["reordered"] == 1
+
+    def test_hold_time_bounded(self):
+        """Тест ограниченной задержки сообщений"""
+        buffer = ReorderBuffer(hold=0.1)
+        buffer.push(1, "a", now=0)
+        assert buffer.next_deadline() == 0.1
+        assert buffer.pop_ready(now=0.1) == ["a"]
+        assert len(buffer) == 0
+
+    def test_late_message_released_immediately(self):
+        """Тест немедленного выпуска сильно опоздавшего сообщения"""
+        buffer = ReorderBuffer(hold=0.1)
+        buffer.push(10, "new", now=0)
+        assert buffer.pop_ready(now=1) == ["new"]
+        buffer.push(3, "old", now=1)
+        assert buffer.pop_ready(now=1) == ["old"]
+        assert buffer.stats["late"] == 1
+
+    def test_size_bounded(self):
+        """Тест выпуска сообщений при переполнении буфера"""
+        buffer = ReorderBuffer(hold=10, max_size=2)
+        for clock in range(3):
+            buffer.push(clock, clock, now=0)
+        assert buffer.pop_ready(now=0) == [0]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
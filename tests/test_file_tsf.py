@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import pytest
+import sys
+import os
+from fastapi.testclient import TestClient
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_tsf
+from blobs import BlobStore
+from transfer import FileCache
+
+SMALL = os.urandom(1000)  # Отдается из FileCache
+LARGE = os.urandom(300 * 1024)  # Больше FileCache.max_file_size: отдается из файла
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Приложение файлов с хранилищем во временном каталоге и файлами small.bin и large.bin"""
+    store = BlobStore(str(tmp_path / "uploads"))
+    monkeypatch.setattr(file_tsf, "blobs", store)
+    monkeypatch.setattr(file_tsf, "cache", FileCache())
+    for name, data in (("small.bin", SMALL), ("large.bin", LARGE)):
+        source = tmp_path / name
+        source.write_bytes(data)
+        digest, size = store.add_file(str(source))
+        store.name(name, digest, size)
+    return TestClient(file_tsf.app)
+
+
+@pytest.mark.parametrize("name, data", [("small.bin", SMALL), ("large.bin", LARGE)], ids=["cached", "streamed"])
+class TestRangeDownload:
+    """Тесты скачивания диапазонов через /file/download"""
+
+    def test_full_file(self, client, name, data):
+        """Тест скачивания целиком с поддержкой диапазонов"""
+        response = client.get(f"/download/{name}")
+        assert response.status_code == 200
+        assert response.content == data
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.headers["content-length"] == str(len(data))
+        assert name in response.headers["content-disposition"]
+
+    def test_partial_content(self, client, name, data):
+        """Тест 206 с правильным Content-Range"""
+        response = client.get(f"/download/{name}", headers={"Range": "bytes=100-499"})
+        assert response.status_code == 206
+        assert response.content == data[100:500]
+        assert response.headers["content-range"] == f"bytes 100-499/{len(data)}"
+        assert response.headers["content-length"] == "400"
+
+    def test_suffix_range(self, client, name, data):
+        """Тест последних байтов файла (bytes=-N)"""
+        response = client.get(f"/download/{name}", headers={"Range": "bytes=-10"})
+        assert response.status_code == 206
+        assert response.content == data[-10:]
+        assert response.headers["content-range"] == f"bytes {len(data) - 10}-{len(data) - 1}/{len(data)}"
+
+    def test_range_not_satisfiable(self, client, name, data):
+        """Тест 416 с Content-Range: bytes */размер"""
+        response = client.get(f"/download/{name}", headers={"Range": f"bytes={len(data)}-"})
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(data)}"
+
+    def test_if_range_mismatch(self, client, name, data):
+        """Тест If-Range с другим ETag: файл изменился, отдается целиком (200)"""
+        response = client.get(f"/download/{name}", headers={"Range": "bytes=0-9", "If-Range": '"0000"'})
+        assert response.status_code == 200
+        assert response.content == data
+        assert "content-range" not in response.headers
+
+
+@pytest.mark.parametrize("name, data", [("small.bin", SMALL), ("large.bin", LARGE)], ids=["cached", "streamed"])
+class TestConditionalDownload:
+    """Тесты ETag по хэшу содержимого и ответов 304"""
+
+    def test_etag_is_content_hash(self, client, name, data):
+        """Тест сильного ETag из SHA-256 содержимого"""
+        response = client.get(f"/download/{name}")
+        assert response.headers["etag"] == f'"{hashlib.sha256(data).hexdigest()}"'
+        assert "last-modified" in response.headers
+
+    def test_if_none_match(self, client, name, data):
+        """Тест 304 без тела для клиента с актуальной копией"""
+        etag = client.get(f"/download/{name}").headers["etag"]
+        response = client.get(f"/download/{name}", headers={"If-None-Match": f'"other", W/{etag}'})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+    def test_if_none_match_changed(self, client, name, data):
+        """Тест полного ответа, если копия клиента устарела"""
+        response = client.get(f"/download/{name}", headers={"If-None-Match": '"0000"'})
+        assert response.status_code == 200
+        assert response.content == data
+
+    def test_if_range_match(self, client, name, data):
+        """Тест диапазона при совпадающем If-Range"""
+        etag = client.get(f"/download/{name}").headers["etag"]
+        response = client.get(f"/download/{name}", headers={"Range": "bytes=0-9", "If-Range": etag})
+        assert response.status_code == 206
+        assert response.content == data[:10]
+
+    def test_blob_by_digest(self, client, name, data):
+        """Тест скачивания по хэшу с тем же ETag и 304"""
+        digest = hashlib.sha256(data).hexdigest()
+        response = client.get(f"/blobs/{digest}", headers={"Range": "bytes=5-14"})
+        assert (response.status_code, response.content) == (206, data[5:15])
+        assert client.get(f"/blobs/{digest}", headers={"If-None-Match": f'"{digest}"'}).status_code == 304
+
+
+class TestBlockingIO:
+    """Тесты обращений к диску при скачивании"""
+
+    @pytest.fixture
+    def calls(self, client, monkeypatch):
+        """Имена вызванных обращений к хранилищу и кэшу; каждое проверяется вне цикла событий"""
+        calls = []
+
+        def off_loop(name, function):
+            def wrapper(*args):
+                with pytest.raises(RuntimeError):
+                    asyncio.get_running_loop()
+                calls.append(name)
+                return function(*args)
+            return wrapper
+
+        for target, name in ((file_tsf.blobs, "resolve"), (file_tsf.blobs, "has"), (file_tsf.cache, "get")):
+            monkeypatch.setattr(target, name, off_loop(name, getattr(target, name)))
+        return calls
+
+    @pytest.mark.parametrize("name", ["small.bin", "large.bin"], ids=["cached", "streamed"])
+    def test_download_in_threadpool(self, client, calls, name):
+        """Тест /download: поиск файла и чтение кэша не блокируют цикл событий"""
+        assert client.get(f"/download/{name}").status_code == 200
+        assert calls == ["resolve", "get"]
+
+    def test_blob_in_threadpool(self, client, calls):
+        """Тест /blobs: проверка наличия и чтение кэша не блокируют цикл событий"""
+        etag = client.get("/download/small.bin").headers["etag"]
+        calls.clear()
+        assert client.get(f"/blobs/{etag.strip(chr(34))}").content == SMALL
+        assert calls == ["has", "get"]
+
+    def test_head_not_allowed(self, client):
+        """Тест HEAD: маршруты скачивания принимают только GET"""
+        assert client.head("/download/small.bin").status_code == 405
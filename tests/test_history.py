@@ -0,0 +1,151 @@
+import pytest
+import sys
+import os
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history import HistoryStore, tokenize
+
+
+class TestHistoryStore:
+    """Тесты для постоянной истории сообщений"""
+
+    def make_store(self, tmp_path):
+        return HistoryStore(str(tmp_path / "history.db"), flush_interval=0.01)
+
+    def test_survives_restart(self, tmp_path):
+        """Тест сохранения истории после перезапуска"""
+        store = self.make_store(tmp_path)
+        store.append({"username": "Алиса", "message": "привет", "room": "general", "id": "a1", "clock": 3})
+        store.close()
+
+        messages = self.make_store(tmp_path).query(room="general")
+        assert len(messages) == 1
+        assert messages[0]["username"] == "Алиса"
+        assert messages[0]["message"] == "привет"
+        assert messages[0]["id"] == "a1"
+        assert messages[0]["clock"] == 3
+
+    def test_opened_on_first_use(self, tmp_path):
+        """Тест отложенного открытия: создание и закрытие хранилища не создают файл"""
+        path = tmp_path / "history.db"
+        store = HistoryStore(str(path))
+        store.close()
+        assert not path.exists()
+
+        store = HistoryStore(str(tmp_path / "other.db"))
+        store.path = str(path)  # Путь можно сменить до первого обращения
+        assert store.query() == []
+        assert path.exists()
+        assert not (tmp_path / "other.db").exists()
+
+    def test_duplicate_id_ignored(self, tmp_path):
+        """Тест однократного сохранения сообщения, полученного дважды"""
+        store = self.make_store(tmp_path)
+        for _ in range(3):
+            store.append({"username": "bob", "message": "x", "room": "general", "id": "same"})
+        store.close()
+        assert len(store.query()) == 1
+
+    def test_filters(self, tmp_path):
+        """Тест выборки по комнате, отправителю и времени"""
+        store = self.make_store(tmp_path)
+        for i in range(10):
+            store.append({"username": "u%d" % (i % 2), "message": str(i),
+                          "room": "dev" if i < 5 else "general", "ts": 1000.0 + i})
+        store.close()
+
+        assert [m["message"] for m in store.query(room="dev")] == ["0", "1", "2", "3", "4"]
+        assert [m["message"] for m in store.query(sender="u1", room="general")] == ["5", "7", "9"]
+        assert [m["message"] for m in store.query(since=1003, until=1006)] == ["3", "4", "5"]
+        assert [m["message"] for m in store.query(limit=2)] == ["8", "9"]
+
+    def test_append_does_not_block(self, tmp_path):
+        """Тест отбрасывания записей при переполненной очереди вместо блокировки"""
+        store = HistoryStore(str(tmp_path / "history.db"), queue_size=1)
+        store._writer = object()  # Поток записи не запущен, очередь не разбирается
+        store.append({"username": "u", "message": "1"})
+        store.append({"username": "u", "message": "2"})
+        assert store.dropped == 1
+
+    def test_digest_localizes_difference(self, tmp_path):
+        """Тест расхождения сумм только в ветвях с недостающими сообщениями (обход — в test_sync)"""
+        full = HistoryStore(str(tmp_path / "full.db"))
+        partial = HistoryStore(str(tmp_path / "partial.db"))
+        messages = [{"username": "u", "message": str(i), "id": "id%d" % i} for i in range(200)]
+        full.insert(messages)
+        partial.insert(messages[:197])
+
+        local = partial.digest()
+        differing = [prefix for prefix, node in full.digest().items() if local.get(prefix) != node]
+        assert 0 < len(differing) <= 3
+
+        missing = ["id197", "id198", "id199"]
+        assert partial.insert(full.get_many(missing)) == 3
+        assert partial.digest() == full.digest()
+
+    def test_digest_ignores_duplicates(self, tmp_path):
+        """Тест неизменности сумм при повторной вставке"""
+        store = self.make_store(tmp_path)
+        store.insert([{"username": "u", "message": "x", "id": "a"}])
+        before = store.digest()
+        assert store.insert([{"username": "u", "message": "x", "id": "a"}]) == 0
+        assert store.digest() == before
+
+    def test_tokenize(self):
+        """Тест разбиения кириллицы, латиницы и ссылок на слова"""
+        assert tokenize("Ёлка и LAN-чат: https://Example.com/a") == ["елка", "lan", "чат", "https", "example", "com"]
+
+    def test_search(self, tmp_path):
+        """Тест поиска по всем словам запроса"""
+        store = self.make_store(tmp_path)
+        store.insert([
+            {"username": "a", "message": "ссылка на сборку https://ci.local/build/42", "room": "dev"},
+            {"username": "b", "message": "Привет всем", "room": "general"},
+            {"username": "c", "message": "новая сборка готова", "room": "general"},
+            {"username": "d", "message": "держи файл", "room": "dev",
+             "file_info": {"name": "Report.pdf", "size": 1}},
+        ])
+
+        assert [m["username"] for m in store.search("ci.local build")] == ["a"]
+        assert [m["username"] for m in store.search("ПРИВЕТ")] == ["b"]
+        assert [m["username"] for m in store.search("report")] == ["d"]
+        assert store.search("сборка", room="dev") == []
+        assert store.search("привет сборка") == []
+        assert store.search("") == []
+
+    def test_search_newest_first(self, tmp_path):
+        """Тест порядка и ограничения числа результатов"""
+        store = self.make_store(tmp_path)
+        store.insert([{"username": "u", "message": "лог %d" % i} for i in range(10)])
+        assert [m["message"] for m in store.search("лог", limit=3)] == ["лог 9", "лог 8", "лог 7"]
+
+    def test_after_pages_without_gaps(self, tmp_path):
+        """Тест постраничного чтения от номера без пропусков и повторов"""
+        store = self.make_store(tmp_path)
+        store.insert([{"username": "u", "message": str(i), "room": "dev" if i % 2 else "general"}
+                      for i in range(7)])
+        seen, seq = [], 0
+        while True:
+            page = store.after(seq, limit=3)
+            if not page:
+                break
+            seen.extend(m["message"] for m in page)
+            seq = page[-1]["seq"]
+        assert seen == [str(i) for i in range(7)]
+        assert seq == store.last_seq()
+        assert [m["message"] for m in store.after(0, room="dev")] == ["1", "3", "5"]
+
+    def test_listener_notified_on_write(self, tmp_path):
+        """Тест уведомления о записи новых сообщений"""
+        store = self.make_store(tmp_path)
+        calls = []
+        store.add_listener(lambda: calls.append(1))
+        store.insert([{"username": "u", "message": "x", "id": "a"}])
+        store.insert([{"username": "u", "message": "x", "id": "a"}])
+        assert calls == [1]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,527 @@
+import asyncio
+import json
+import socket
+import sys
+import os
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+import threading
+import time
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msg_server
+import wire
+from history import HistoryStore
+from msg_server import MessageBroadcaster, kernel_drops
+from presence import ONLINE, OFFLINE
+
+PEER = ("192.168.1.20", MessageBroadcaster.BROADCAST_PORT)
+
+
+def datagram(text: str, seq: int, sender: bytes = b"peer0001", room: str = wire.DEFAULT_ROOM) -> bytes:
+    return wire.encode({"username": "bob", "message": text}, wire.room_id(room), sender, seq, clock=seq)
+
+
+async def receive(subscription, timeout: float = 1.0):
+    return await asyncio.wait_for(subscription.__anext__(), timeout)
+
+
+class FakeSocket:
+    """Сокет отправки, запоминающий датаграммы"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data: bytes, addr):
+        self.sent.append((data, addr))
+
+    def close(self):
+        pass
+
+
+def run(scenario):
+    """Сценарий с запущенным широковещателем; остановка в том же цикле событий"""
+    async def main():
+        broadcaster = MessageBroadcaster(multicast=False, reorder_hold=0)
+        await broadcaster.start_async()
+        try:
+            return await scenario(broadcaster)
+        finally:
+            broadcaster.stop()
+
+    return asyncio.run(main())
+
+
+class TestAsyncReceive:
+    """Тесты приема в цикле событий (start_async) и подписок"""
+
+    def test_subscribers_receive_datagrams(self):
+        """Тест доставки датаграммы из транспорта всем подписчикам"""
+        async def scenario(receiver):
+            assert receiver.loop is asyncio.get_running_loop()
+            first, second = receiver.subscribe(), receiver.subscribe()
+            receiver.transport.get_protocol().datagram_received(datagram("привет", 1), PEER)
+            return await receive(first), await receive(second)
+
+        (message, addr), (copy, _) = run(scenario)
+        assert message["message"] == "привет"
+        assert message["room"] == wire.DEFAULT_ROOM
+        assert addr == PEER
+        assert copy == message
+
+    def test_start_async_is_idempotent(self):
+        """Тест повторного запуска: транспорт создается один раз"""
+        async def scenario(receiver):
+            transport = receiver.transport
+            await receiver.start_async()
+            return transport is not None and transport is receiver.transport
+
+        assert run(scenario)
+
+    def test_duplicate_delivered_once(self):
+        """Тест подавления повтора одной датаграммы"""
+        async def scenario(receiver):
+            subscription = receiver.subscribe()
+            for data in (datagram("раз", 1), datagram("раз", 1), datagram("два", 2)):
+                receiver._enqueue_async(data, PEER)
+            return [(await receive(subscription))[0]["message"] for _ in range(2)]
+
+        assert run(scenario) == ["раз", "два"]
+
+    def test_json_duplicate_delivered_once(self):
+        """Тест подавления повтора JSON-датаграммы по ее id"""
+        async def scenario(receiver):
+            subscription = receiver.subscribe()
+            message = {"username": "old", "message": "раз", "id": "a1"}
+            for data in (wire.encode_json(message), wire.encode_json(message),
+                         wire.encode_json({**message, "message": "два", "id": "a2"})):
+                receiver._enqueue_async(data, PEER)
+            return [(await receive(subscription))[0]["message"] for _ in range(2)]
+
+        assert run(scenario) == ["раз", "два"]
+
+    def test_fragments_of_different_rooms_not_mixed(self):
+        """Тест сборки фрагментов с одинаковым номером из разных комнат (номера ведутся по комнатам)"""
+        async def scenario(receiver):
+            receiver.join("dev")
+            subscription = receiver.subscribe()
+            general = wire.fragment(datagram("о" * 2000, 1), mtu=500)
+            dev = wire.fragment(datagram("д" * 2000, 1, room="dev"), mtu=500)
+            for pair in zip(general, dev):
+                for data in pair:
+                    receiver._enqueue_async(data, PEER)
+            return [await receive(subscription) for _ in range(2)]
+
+        messages = {message["room"]: message["message"] for message, _ in run(scenario)}
+        assert messages == {wire.DEFAULT_ROOM: "о" * 2000, "dev": "д" * 2000}
+
+    def test_version1_peer(self):
+        """Тест приема от узла версии 1 и перехода на JSON, который он понимает"""
+        async def scenario(receiver):
+            subscription = receiver.subscribe()
+            payload = b"\x00\x03bobhi"
+            data = wire.HEADER_V1.pack(wire.MAGIC, 1, wire.TYPE_CHAT, 0, wire.room_id(wire.DEFAULT_ROOM),
+                                       b"peer0001", 1, len(payload)) + payload
+            receiver._enqueue_async(data, PEER)
+            return (await receive(subscription))[0], receiver.use_binary()
+
+        message, binary = run(scenario)
+        assert (message["username"], message["message"]) == ("bob", "hi")
+        assert not binary
+
+    def test_slow_subscriber_drops(self):
+        """Тест отбрасывания сообщений, не поместившихся в очередь подписчика"""
+        async def scenario(receiver):
+            subscription = receiver.subscribe(maxsize=1)
+            for seq in (1, 2, 3):
+                receiver._enqueue_async(datagram(str(seq), seq), PEER)
+            await asyncio.sleep(0.05)
+            return subscription, (await receive(subscription))[0]
+
+        subscription, message = run(scenario)
+        assert message["message"] == "1"
+        assert subscription.dropped == 2
+
+    def test_close_ends_iteration(self):
+        """Тест завершения async for после отписки"""
+        async def scenario(receiver):
+            subscription = receiver.subscribe()
+            receiver._enqueue_async(datagram("последнее", 1), PEER)
+            received = []
+
+            async def consume():
+                async for message, _ in subscription:
+                    received.append(message["message"])
+                    subscription.close()
+
+            await asyncio.wait_for(consume(), 1.0)
+            return received, subscription not in receiver._subscribers
+
+        received, unsubscribed = run(scenario)
+        assert received == ["последнее"]
+        assert unsubscribed
+
+
+class TestDispatchQueue:
+    """Тесты ограниченной очереди между приемом и разбором"""
+
+    def test_full_queue_drops_and_counts(self):
+        """Тест отбрасывания датаграмм сверх queue_size и счетчика queue_drops"""
+        async def scenario(receiver):
+            receiver.queue_size = 2
+            subscription = receiver.subscribe()
+            for seq in range(1, 6):
+                receiver._enqueue_async(datagram(str(seq), seq), PEER)  # Разбор еще не запускался
+            stats = receiver.stats()
+            delivered = [(await receive(subscription))[0]["message"] for _ in range(2)]
+            return stats, delivered, receiver.stats()["queue_depth"]
+
+        stats, delivered, depth = run(scenario)
+        assert (stats["queue_depth"], stats["queue_drops"]) == (2, 3)
+        assert delivered == ["1", "2"]
+        assert depth == 0
+
+    def test_backlog_drained_in_batches(self):
+        """Тест разбора очереди порциями по DISPATCH_BATCH за проход цикла событий"""
+        async def scenario(receiver):
+            count = MessageBroadcaster.DISPATCH_BATCH + 10
+            for seq in range(1, count + 1):
+                receiver._enqueue_async(datagram(str(seq), seq), PEER)
+            await asyncio.sleep(0)  # Один проход цикла событий
+            left = len(receiver._backlog)
+            await asyncio.sleep(0.05)
+            return left, len(receiver._backlog)
+
+        assert run(scenario) == (10, 0)
+
+    def test_rcvbuf(self):
+        """Тест размера приемного буфера сокета из параметра rcvbuf"""
+        broadcaster = MessageBroadcaster(multicast=False, rcvbuf=64 * 1024)
+        try:
+            rcvbuf = broadcaster.stats()["rcvbuf"]
+            assert rcvbuf == broadcaster.receive_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            assert rcvbuf >= 64 * 1024
+        finally:
+            broadcaster.stop()
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Счетчик берется из /proc/net/udp")
+    def test_kernel_drops(self):
+        """Тест счетчика датаграмм, отброшенных ядром при переполнении буфера сокета"""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            receiver.bind(("127.0.0.1", 0))
+            assert kernel_drops(receiver) == 0
+            for _ in range(200):
+                sender.sendto(b"x" * 1000, receiver.getsockname())
+            assert kernel_drops(receiver) > 0
+        finally:
+            receiver.close()
+            sender.close()
+
+
+class TestBroadcast:
+    """Тесты отправки сообщений"""
+
+    def test_oversized_message_not_sent(self):
+        """Тест отказа без выдачи номера: получатели не ждут несуществующий пропуск"""
+        broadcaster = MessageBroadcaster(multicast=False, wire_format="binary")
+        try:
+            assert not broadcaster.broadcast({"username": "u", "message": "x" * (wire.MAX_MESSAGE + 1)})
+            assert broadcaster._seqs == {}
+            assert broadcaster.clock == 0
+        finally:
+            broadcaster.stop()
+
+    def test_unjoined_room_uses_its_group(self):
+        """Тест отправки в комнату без входа: группа и имя этой комнаты, а не комнаты по умолчанию"""
+        broadcaster = MessageBroadcaster(multicast=False, wire_format="binary")
+        broadcaster.multicast = True
+        broadcaster.send_sock.close()
+        broadcaster.send_sock = FakeSocket()
+        try:
+            assert broadcaster.broadcast({"username": "u", "message": "hi", "room": "dev"})
+            (data, addr), = broadcaster.send_sock.sent
+            header, _ = wire.decode_header(data)
+            assert header.room == wire.room_id("dev")
+            assert addr == (wire.room_group("dev"), MessageBroadcaster.BROADCAST_PORT)
+        finally:
+            broadcaster.stop()
+
+    def test_unjoined_room_name_in_json(self):
+        """Тест имени комнаты в JSON для старых узлов при отправке в комнату без входа"""
+        broadcaster = MessageBroadcaster(multicast=False, wire_format="json")
+        broadcaster.send_sock.close()
+        broadcaster.send_sock = FakeSocket()
+        try:
+            assert broadcaster.broadcast({"username": "u", "message": "hi", "room": "dev"})
+            (data, _), = broadcaster.send_sock.sent
+            message, _ = wire.decode_json(data)
+            assert message["room"] == "dev"
+        finally:
+            broadcaster.stop()
+
+
+def sending_broadcaster(**kwargs) -> MessageBroadcaster:
+    """Широковещатель бинарного формата, отправка которого попадает в FakeSocket"""
+    broadcaster = MessageBroadcaster(multicast=False, wire_format="binary", **kwargs)
+    broadcaster.send_sock.close()
+    broadcaster.send_sock = FakeSocket()
+    return broadcaster
+
+
+def sent_messages(broadcaster: MessageBroadcaster) -> list:
+    """Отправленные датаграммы: текст для одиночного сообщения, список текстов для пакета"""
+    sent = []
+    for data, _ in broadcaster.send_sock.sent:
+        header, payload = wire.decode_header(data)
+        if wire.is_batch(data):
+            sent.append([wire.decode_payload(*wire.decode_header(item))["message"]
+                         for item in wire.unpack_batch(payload)])
+        elif header.type in (wire.TYPE_CHAT, wire.TYPE_JSON):
+            sent.append(wire.decode_payload(header, payload)["message"])
+    return sent
+
+
+class TestCoalescing:
+    """Тесты объединения мелких сообщений в пакеты"""
+
+    def test_window_sends_one_batch(self):
+        """Тест отправки нескольких сообщений окна одной датаграммой без потока-таймера на окно"""
+        broadcaster = sending_broadcaster(coalesce_delay=0.05)
+        broadcaster.start(lambda message, addr: None)
+        try:
+            threads = threading.active_count()
+            for text in ("a", "b", "c"):
+                assert broadcaster.broadcast({"username": "u", "message": text})
+            assert broadcaster.send_sock.sent == []
+            assert threading.active_count() == threads
+            deadline = time.monotonic() + 2
+            while not broadcaster.send_sock.sent and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert sent_messages(broadcaster) == [["a", "b", "c"]]
+            assert broadcaster.batches_sent == 1
+        finally:
+            broadcaster.stop()
+
+    def test_flush_on_size_limit(self):
+        """Тест немедленной отправки пакета, в который не помещается следующее сообщение"""
+        broadcaster = sending_broadcaster(coalesce_delay=10)
+        broadcaster.start(lambda message, addr: None)
+        try:
+            single = len(wire.encode({"username": "u", "message": "a"}, 0, broadcaster.sender_id, 1))
+            broadcaster.coalesce_bytes = wire.batch_size([b"x" * single] * 2)
+            for text in ("a", "b", "c"):
+                broadcaster.broadcast({"username": "u", "message": text})
+            assert sent_messages(broadcaster) == [["a", "b"]]
+        finally:
+            broadcaster.stop()
+        assert sent_messages(broadcaster) == [["a", "b"], "c"]
+
+    def test_flush_on_stop(self):
+        """Тест отправки накопленного пакета при остановке"""
+        broadcaster = sending_broadcaster(coalesce_delay=10)
+        broadcaster.start(lambda message, addr: None)
+        broadcaster.broadcast({"username": "u", "message": "a"})
+        broadcaster.broadcast({"username": "u", "message": "b"})
+        assert broadcaster.send_sock.sent == []
+        broadcaster.stop()
+        assert sent_messages(broadcaster) == [["a", "b"]]
+
+    def test_async_window(self):
+        """Тест пакета в асинхронном режиме (таймер цикла событий)"""
+        async def scenario(broadcaster):
+            broadcaster.send_sock.close()
+            broadcaster.send_sock = FakeSocket()
+            broadcaster.wire_format = "binary"
+            broadcaster.coalesce_delay = 0.02
+            broadcaster.broadcast({"username": "u", "message": "a"})
+            broadcaster.broadcast({"username": "u", "message": "b"})
+            await asyncio.sleep(0.1)
+            return sent_messages(broadcaster)
+
+        assert run(scenario) == [["a", "b"]]
+
+
+class TestLifespan:
+    """Тесты запуска и остановки приложения"""
+
+    def test_shutdown_writes_last_batch(self, tmp_path, monkeypatch):
+        """Тест записи последней пачки истории при остановке"""
+        class Service:
+            started = False
+
+            async def start_async(self):
+                self.started = True
+
+            def start(self):
+                self.started = True
+
+            def stop(self):
+                self.stopped = True
+
+        store = HistoryStore(str(tmp_path / "history.db"), flush_interval=1.0)
+        broadcaster, hub = Service(), Service()
+        monkeypatch.setattr(msg_server, "history", store)
+        monkeypatch.setattr(msg_server, "broadcaster", broadcaster)
+        monkeypatch.setattr(msg_server, "hub", hub)
+
+        async def scenario():
+            async with msg_server.lifespan(msg_server.app):
+                assert broadcaster.started and hub.started
+                store.append({"id": "m1", "username": "u", "message": "последнее"})
+
+        asyncio.run(scenario())
+        assert broadcaster.stopped
+        assert [message["message"] for message in store.query()] == ["последнее"]
+
+    def test_shutdown_sends_pending_batch_and_offline(self, tmp_path, monkeypatch):
+        """Тест отправки накопленного пакета и heartbeat OFFLINE при остановке приложения"""
+        class Hub:
+            def start(self):
+                pass
+
+        broadcaster = sending_broadcaster(coalesce_delay=10)
+        monkeypatch.setattr(msg_server, "history", HistoryStore(str(tmp_path / "history.db")))
+        monkeypatch.setattr(msg_server, "broadcaster", broadcaster)
+        monkeypatch.setattr(msg_server, "hub", Hub())
+
+        async def scenario():
+            async with msg_server.lifespan(msg_server.app):
+                broadcaster.set_presence(ONLINE, "u")
+                broadcaster.broadcast({"username": "u", "message": "a"})
+                broadcaster.broadcast({"username": "u", "message": "b"})
+                assert sent_messages(broadcaster) == []
+
+        asyncio.run(scenario())
+        assert sent_messages(broadcaster) == [["a", "b"]]
+        (data, _), = [item for item in broadcaster.send_sock.sent if not wire.is_batch(item[0])]
+        header, payload = wire.decode_header(data)
+        assert header.type == wire.TYPE_PRESENCE
+        assert wire.decode_presence(payload)[0] == OFFLINE
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """Приложение сообщений с историей во временном каталоге; возвращает (клиент, история)"""
+    store = HistoryStore(str(tmp_path / "history.db"))
+    monkeypatch.setattr(msg_server, "history", store)
+    return TestClient(msg_server.app), store
+
+
+class TestHistoryApi:
+    """Тесты HTTP-доступа к истории"""
+
+    def test_search(self, api):
+        """Тест /search: найденные сообщения с курсором вместо внутреннего номера"""
+        client, store = api
+        store.insert([
+            {"id": "a1", "username": "alice", "message": "встреча в пятницу", "room": "general", "ts": 1.0},
+            {"id": "a2", "username": "bob", "message": "отчет готов", "room": "general", "ts": 2.0},
+            {"id": "a3", "username": "bob", "message": "встреча перенесена", "room": "dev", "ts": 3.0},
+        ])
+
+        found = client.get("/search", params={"q": "Встреча"}).json()
+        assert [message["id"] for message in found] == ["a3", "a1"]
+        assert all("seq" not in message and message["cursor"] for message in found)
+        assert [message["id"] for message in client.get("/search", params={"q": "встреча", "room": "dev"}).json()] == ["a3"]
+
+        # С курсора найденного сообщения /history продолжает после него
+        after = client.get("/history", params={"cursor": found[1]["cursor"]}).json()["messages"]
+        assert [message["id"] for message in after] == ["a2", "a3"]
+
+    def test_history_pages(self, api):
+        """Тест постраничного чтения /history без пропусков и повторов"""
+        client, store = api
+        store.insert([{"id": "m%d" % i, "username": "u", "message": str(i), "ts": float(i)} for i in range(5)])
+
+        received, cursor = [], None
+        while True:
+            page = client.get("/history", params={"limit": 2, **({"cursor": cursor} if cursor else {})}).json()
+            if not page["messages"]:
+                break
+            assert len(page["messages"]) <= 2
+            assert all("seq" not in message for message in page["messages"])
+            received += [message["id"] for message in page["messages"]]
+            cursor = page["cursor"]
+        assert received == ["m%d" % i for i in range(5)]
+        assert page["cursor"] == cursor  # Догнав историю, клиент продолжает с того же курсора
+
+    def test_bad_cursor(self, api):
+        """Тест ответа 400 на нечитаемый курсор и курсор вне диапазона номеров SQLite"""
+        client, _ = api
+        for cursor in ("не-курсор", "AAAA", "__________8"):
+            assert client.get("/history", params={"cursor": cursor}).status_code == 400
+        assert client.get("/history/stream", params={"cursor": "__________8"}).status_code == 400
+
+    def test_sync_ranges(self, api):
+        """Тест ответа 400 на лист и префикс вне дерева сумм"""
+        client, _ = api
+        assert client.get("/sync/ids", params={"bucket": 2 ** 70}).status_code == 400
+        assert client.get("/sync/ids", params={"bucket": -1}).status_code == 400
+        assert client.get("/sync/digest", params={"prefix": 2 ** 70}).status_code == 400
+        assert client.get("/sync/ids", params={"bucket": 0xFFFF}).json() == []
+
+
+def stream_request(headers: dict = None) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/history/stream", "query_string": b"",
+                    "headers": [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]})
+
+
+async def next_event(events) -> str:
+    return (await asyncio.wait_for(events.__anext__(), 2.0)).strip()
+
+
+def event_data(event: str) -> dict:
+    return json.loads(event.split("data: ", 1)[1])
+
+
+class TestHistoryStream:
+    """Тесты живого хвоста истории /history/stream (SSE)"""
+
+    def test_catch_up_then_live(self, api):
+        """Тест догона с курсора и доставки новой записи без разрыва"""
+        _, store = api
+        store.insert([{"id": "m%d" % i, "username": "u", "message": str(i), "ts": float(i)} for i in range(3)])
+
+        async def scenario():
+            first = msg_server.encode_cursor(store.after(0, limit=1)[0]["seq"])
+            response = await msg_server.stream_history(stream_request(), cursor=first)
+            events = response.body_iterator
+            try:
+                caught_up = [await next_event(events) for _ in range(2)]
+                store.append({"id": "m3", "username": "u", "message": "3"})
+                live = await next_event(events)
+            finally:
+                await events.aclose()
+            return caught_up, live
+
+        caught_up, live = asyncio.run(scenario())
+        assert [event_data(event)["id"] for event in caught_up] == ["m1", "m2"]
+        assert live.startswith(f"id: {event_data(live)['cursor']}\nevent: message")
+        assert event_data(live)["message"] == "3"
+        assert not store._listeners
+
+    def test_last_event_id_and_tail(self, api, monkeypatch):
+        """Тест продолжения с Last-Event-ID, старта с конца истории и keepalive"""
+        _, store = api
+        store.insert([{"id": "m%d" % i, "username": "u", "message": str(i), "ts": float(i)} for i in range(3)])
+        monkeypatch.setattr(msg_server, "SSE_KEEPALIVE", 0.05)
+
+        async def scenario():
+            last = msg_server.encode_cursor(store.after(0, limit=2)[1]["seq"])
+            resumed = (await msg_server.stream_history(stream_request({"Last-Event-ID": last}))).body_iterator
+            tail = (await msg_server.stream_history(stream_request())).body_iterator
+            try:
+                return await next_event(resumed), await next_event(tail)
+            finally:
+                await resumed.aclose()
+                await tail.aclose()
+
+        resumed, tail = asyncio.run(scenario())
+        assert event_data(resumed)["id"] == "m2"
+        assert tail == ": keepalive"  # Без курсора старые сообщения не отправляются
@@ -0,0 +1,85 @@
+import pytest
+import sys
+import os
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from presence import AWAY, OFFLINE, ONLINE, TYPING, Heartbeat, Presence, PresenceTracker, heartbeat_interval
+
+
+class TestPresence:
+    """Тесты для собственного состояния и расписания heartbeat"""
+
+    def test_no_heartbeat_without_username(self):
+        """Тест молчания узла, не вошедшего в чат"""
+        assert Presence().due(0, 0) is None
+
+    def test_only_changes_carry_username(self):
+        """Тест передачи имени только при изменении и периодически"""
+        presence = Presence(full_every=3)
+        presence.set(ONLINE, "Алиса", now=0)
+        first = presence.due(0, 0)
+        assert first.username == "Алиса"
+        assert presence.due(1, 0) is None  # Период еще не прошел
+
+        keepalives = [presence.due(t, 0) for t in (10, 20)]
+        assert [h.username for h in keepalives] == [None, None]
+        assert presence.due(30, 0).username == "Алиса"
+
+        presence.set(AWAY, now=31)
+        changed = presence.due(31, 0)
+        assert changed.state == AWAY
+        assert changed.version > first.version
+        assert changed.username == "Алиса"
+
+    def test_typing_expires(self):
+        """Тест возврата из "печатает" в "в сети" без набора"""
+        presence = Presence()
+        presence.set(TYPING, "bob", now=0)
+        assert presence.due(0, 0).state == TYPING
+        assert presence.due(Presence.TYPING_TIMEOUT + 1, 0).state == ONLINE
+
+    def test_interval_adapts_to_peers(self):
+        """Тест постоянного суммарного потока heartbeat"""
+        assert heartbeat_interval(0) == 5.0
+        assert heartbeat_interval(49) == 25.0
+        assert heartbeat_interval(10000) == 60.0
+
+
+class TestPresenceTracker:
+    """Тесты для состояния соседей"""
+
+    def test_update_and_expire(self):
+        """Тест истечения по TTL"""
+        tracker = PresenceTracker(ttl_factor=3)
+        tracker.update(b"a" * 8, Heartbeat(ONLINE, 1, 5.0, "Алиса"), "10.0.0.1", now=0)
+        assert tracker.peers(now=10) == [{"username": "Алиса", "state": "online", "ip": "10.0.0.1"}]
+        assert tracker.peers(now=16) == []
+
+    def test_delta_keeps_username(self):
+        """Тест heartbeat без имени для известного узла"""
+        tracker = PresenceTracker()
+        tracker.update(b"a" * 8, Heartbeat(ONLINE, 1, 5.0, "Алиса"), "10.0.0.1", now=0)
+        tracker.update(b"a" * 8, Heartbeat(TYPING, 2, 5.0, None), "10.0.0.1", now=1)
+        assert tracker.peers(now=1)[0] == {"username": "Алиса", "state": "typing", "ip": "10.0.0.1"}
+
+    def test_unknown_name_hidden(self):
+        """Тест скрытия узла, пока не пришло его имя"""
+        tracker = PresenceTracker()
+        tracker.update(b"b" * 8, Heartbeat(ONLINE, 3, 5.0, None), "10.0.0.2", now=0)
+        assert len(tracker) == 1
+        assert tracker.peers(now=0) == []
+
+    def test_offline_removes(self):
+        """Тест немедленного удаления при выходе"""
+        tracker = PresenceTracker()
+        tracker.update(b"a" * 8, Heartbeat(ONLINE, 1, 5.0, "Алиса"), "10.0.0.1", now=0)
+        changes = tracker.changes
+        tracker.update(b"a" * 8, Heartbeat(OFFLINE, 2, 5.0, None), "10.0.0.1", now=1)
+        assert len(tracker) == 0
+        assert tracker.changes == changes + 1
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
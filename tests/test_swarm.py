@@ -0,0 +1,107 @@
+import hashlib
+import json
+import threading
+import time
+import pytest
+import sys
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from swarm import SwarmDownload, find_peers
+from transfer import parse_range
+
+CHUNK = 64 * 1024
+DATA = os.urandom(10 * CHUNK + 123)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def serve(data, delay=0.0):
+    """Узел, отдающий файл по хэшу (как /file/blobs/...); data=None — файла нет"""
+    class Handler(BaseHTTPRequestHandler):
+        requests = 0
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body=b"", headers=()):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if data is None:
+                return self.reply(404)
+            if "/chunks" in self.path:
+                chunks = [hashlib.sha256(DATA[i:i + CHUNK]).hexdigest() for i in range(0, len(DATA), CHUNK)]
+                body = {"sha256": DIGEST, "size": len(DATA), "chunk_size": CHUNK, "chunks": chunks}
+                return self.reply(200, json.dumps(body).encode())
+            Handler.requests += 1
+            time.sleep(delay)
+            start, end = parse_range(self.headers["Range"], len(data))
+            self.reply(206, data[start:end], [("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")])
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server, Handler
+
+
+@pytest.fixture
+def peers():
+    servers = [serve(DATA), serve(DATA), serve(bytes(len(DATA))), serve(None)]
+    yield [(f"http://127.0.0.1:{server.server_port}", handler) for server, handler in servers]
+    for server, _ in servers:
+        server.shutdown()
+
+
+class TestSwarm:
+    """Тесты для скачивания с нескольких узлов"""
+
+    def test_find_peers(self, peers):
+        """Тест поиска узлов, у которых есть файл"""
+        found, manifest = find_peers(DIGEST, [url for url, _ in peers], chunk_size=CHUNK)
+        assert [peer.base_url for peer in found] == [url for url, _ in peers[:3]]
+        assert manifest["size"] == len(DATA) and len(manifest["chunks"]) == 11
+
+    def test_download_from_all_peers(self, peers, tmp_path):
+        """Тест сборки файла с нескольких узлов и исключения узла с испорченными данными"""
+        found, manifest = find_peers(DIGEST, [url for url, _ in peers], chunk_size=CHUNK)
+        progress = []
+        destination = str(tmp_path / "dataset.bin")
+        assert SwarmDownload(DIGEST, manifest, found, destination, on_progress=progress.append).run() == len(DATA)
+
+        with open(destination, "rb") as f:
+            assert f.read() == DATA
+        assert sum(progress) == len(DATA)
+        good, _, corrupt = found
+        assert not corrupt.alive and corrupt.received == 0
+        assert peers[0][1].requests > 0 and peers[1][1].requests > 0
+        assert not os.path.exists(destination + ".part")
+
+    def test_faster_peer_gets_more_chunks(self, tmp_path):
+        """Тест перераспределения частей в пользу быстрого узла"""
+        (fast, fast_handler), (slow, slow_handler) = serve(DATA), serve(DATA, delay=0.2)
+        try:
+            urls = [f"http://127.0.0.1:{server.server_port}" for server in (fast, slow)]
+            found, manifest = find_peers(DIGEST, urls, chunk_size=CHUNK)
+            SwarmDownload(DIGEST, manifest, found, str(tmp_path / "x")).run()
+        finally:
+            fast.shutdown()
+            slow.shutdown()
+        assert fast_handler.requests > slow_handler.requests
+        assert found[0].speed > found[1].speed
+
+    def test_all_peers_corrupt(self, peers, tmp_path):
+        """Тест отказа, если ни один узел не отдает верные части"""
+        found, manifest = find_peers(DIGEST, [url for url, _ in peers], chunk_size=CHUNK)
+        with pytest.raises(RuntimeError):
+            SwarmDownload(DIGEST, manifest, found[2:], str(tmp_path / "x")).run()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
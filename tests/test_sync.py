@@ -0,0 +1,102 @@
+import pytest
+import sys
+import os
+import requests
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msg_server
+import sync
+from history import HistoryStore
+
+PEER = {"name": "peer", "ip": "192.168.1.20", "port": 8000}
+DOWN = {"name": "down", "ip": "192.168.1.21", "port": 8000}
+
+
+class PeerRequests:
+    """Замена requests: запросы к PEER идут в приложение сообщений, остальные узлы недоступны"""
+
+    def __init__(self):
+        app = FastAPI()
+        app.mount("/message", msg_server.app)
+        self.client = TestClient(app)
+        self.paths = []
+
+    def _check(self, url: str):
+        if f"//{PEER['ip']}:" not in url:
+            raise requests.ConnectionError(url)
+        self.paths.append(url.split("/message", 1)[1])
+
+    def get(self, url, params=None, timeout=None):
+        self._check(url)
+        return self.client.get(url, params=params)
+
+    def post(self, url, json=None, timeout=None):
+        self._check(url)
+        return self.client.post(url, json=json)
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """История соседа (отдается через /message/sync/...) и локальная история"""
+    remote = HistoryStore(str(tmp_path / "remote.db"))
+    local = HistoryStore(str(tmp_path / "local.db"))
+    monkeypatch.setattr(msg_server, "history", remote)
+    return remote, local
+
+
+@pytest.fixture
+def peer(monkeypatch):
+    stub = PeerRequests()
+    monkeypatch.setattr(sync, "requests", stub)
+    return stub
+
+
+def messages(count: int) -> list:
+    return [{"username": "u", "message": str(i), "id": "id%d" % i, "ts": 1000.0 + i} for i in range(count)]
+
+
+class TestSync:
+    """Тесты синхронизации истории с соседом через /message/sync/..."""
+
+    def test_missing_ids(self, stores, peer):
+        """Тест поиска недостающих сообщений спуском только в расходящиеся ветви"""
+        remote, local = stores
+        remote.insert(messages(200))
+        local.insert(messages(197))
+
+        assert sorted(sync.missing_ids(local, f"http://{PEER['ip']}:{PEER['port']}")) == ["id197", "id198", "id199"]
+        listed = [path for path in peer.paths if path.startswith("/sync/ids")]
+        assert 0 < len(listed) <= 3
+
+    def test_identical_histories(self, stores, peer):
+        """Тест одного запроса при совпадающих историях"""
+        remote, local = stores
+        remote.insert(messages(50))
+        local.insert(messages(50))
+
+        assert sync.missing_ids(local, f"http://{PEER['ip']}:{PEER['port']}") == []
+        assert peer.paths == ["/sync/digest"]
+
+    def test_sync_from_peer(self, stores, peer):
+        """Тест загрузки недостающих сообщений и совпадения деревьев после синхронизации"""
+        remote, local = stores
+        remote.insert(messages(30))
+        local.insert(messages(30)[10:])
+
+        received = sync.sync_from_peer(local, f"http://{PEER['ip']}:{PEER['port']}")
+        assert sorted(message["id"] for message in received) == ["id%d" % i for i in range(10)]
+        assert local.digest() == remote.digest()
+        assert sync.sync_from_peer(local, f"http://{PEER['ip']}:{PEER['port']}") == []
+
+    def test_sync_with_peers_skips_unreachable(self, stores, peer):
+        """Тест пропуска недоступного узла и порядка полученных сообщений по времени"""
+        remote, local = stores
+        remote.insert(list(reversed(messages(5))))
+
+        received = sync.sync_with_peers(local, [DOWN, PEER])
+        assert [message["id"] for message in received] == ["id%d" % i for i in range(5)]
+        assert len(local.query()) == 5
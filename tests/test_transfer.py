@@ -0,0 +1,254 @@
+import asyncio
+import email.parser
+import email.policy
+import hashlib
+import json
+import pytest
+import sys
+import os
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transfer
+from blobs import BlobStore
+from transfer import (ChecksumError, FileCache, MultipartFile, UploadSession, add_range, missing_ranges,
+                      not_modified, parse_range, read_range, split_ranges)
+
+
+async def _stream(data, step=7):
+    for i in range(0, len(data), step):
+        yield data[i:i + step]
+
+
+def write(session, offset, data, checksum=None):
+    return asyncio.run(session.write(offset, _stream(data), checksum))
+
+
+class TestRanges:
+    """Тесты для учета полученных диапазонов"""
+
+    def test_add_range_merges(self):
+        """Тест объединения пересекающихся и смежных диапазонов"""
+        ranges = add_range([], 10, 20)
+        ranges = add_range(ranges, 30, 40)
+        assert ranges == [(10, 20), (30, 40)]
+        assert add_range(ranges, 20, 30) == [(10, 40)]
+        assert add_range(ranges, 0, 5) == [(0, 5), (10, 20), (30, 40)]
+
+    def test_missing_ranges(self):
+        """Тест поиска недостающих диапазонов"""
+        assert missing_ranges([], 10) == [(0, 10)]
+        assert missing_ranges([(2, 4), (6, 10)], 10) == [(0, 2), (4, 6)]
+        assert missing_ranges([(0, 10)], 10) == []
+
+    def test_split_ranges(self):
+        """Тест разбиения на части"""
+        assert split_ranges([(0, 10), (20, 25)], 4) == [(0, 4), (4, 8), (8, 10), (20, 24), (24, 25)]
+
+    def test_parse_range(self):
+        """Тест разбора заголовка Range"""
+        assert parse_range("bytes=0-99", 1000) == (0, 100)
+        assert parse_range("bytes=900-", 1000) == (900, 1000)
+        assert parse_range("bytes=-100", 1000) == (900, 1000)
+        assert parse_range("bytes=990-2000", 1000) == (990, 1000)
+        assert parse_range(None, 1000) is None
+        assert parse_range("bytes=0-1,5-6", 1000) is None
+        assert parse_range("items=0-1", 1000) is None
+        with pytest.raises(ValueError):
+            parse_range("bytes=1000-", 1000)
+
+    def test_read_range(self, tmp_path):
+        """Тест чтения диапазона блоками"""
+        path = tmp_path / "f"
+        path.write_bytes(bytes(range(256)))
+        blocks = list(read_range(str(path), 10, 60, block=16))
+        assert [len(b) for b in blocks] == [16, 16, 16, 2]
+        assert b"".join(blocks) == bytes(range(10, 60))
+
+
+class TestUploadSession:
+    """Тесты для сессий загрузки по частям"""
+
+    def test_chunks_out_of_order(self, tmp_path, monkeypatch):
+        """Тест сборки файла из частей в произвольном порядке"""
+        data = os.urandom(1000)
+        session = UploadSession.create(str(tmp_path), "a.bin", len(data), chunk_size=256)
+        for start, end in reversed(split_ranges([(0, len(data))], 256)):
+            chunk = data[start:end]
+            assert write(session, start, chunk, hashlib.sha256(chunk).hexdigest()) == len(chunk)
+        assert UploadSession.load(str(tmp_path), session.id).complete()
+
+        store = BlobStore(str(tmp_path / "uploads"), chunk_size=256)
+        read = []
+        monkeypatch.setattr(transfer, "read_range", lambda path, *args: read.append(path) or read_range(path, *args))
+        monkeypatch.setattr(store, "chunk_hashes", None)  # Файл для хэшей частей не перечитывается
+        digest, added = session.commit(store)
+        assert digest == hashlib.sha256(data).hexdigest() and added
+        assert read == []
+        with open(store.path(digest), "rb") as f:
+            assert f.read() == data
+        assert UploadSession.load(str(tmp_path), session.id) is None
+        # Хэши частей для скачивания с нескольких узлов готовы сразу после загрузки
+        with open(store.path(digest) + ".256.chunks") as f:
+            assert json.load(f) == [hashlib.sha256(data[i:i + 256]).hexdigest() for i in range(0, 1000, 256)]
+
+    def test_parts_of_other_size(self, tmp_path):
+        """Тест загрузки частями другого размера: хэши частей хранилища считаются по запросу"""
+        data = os.urandom(1000)
+        session = UploadSession.create(str(tmp_path), "a.bin", len(data), chunk_size=300)
+        for start, end in split_ranges([(0, len(data))], 300):
+            write(session, start, data[start:end])
+        assert session.part_hashes(300) == [hashlib.sha256(data[i:i + 300]).hexdigest() for i in range(0, 1000, 300)]
+
+        store = BlobStore(str(tmp_path / "uploads"), chunk_size=256)
+        digest, _ = session.commit(store)
+        assert not os.path.exists(store.path(digest) + ".256.chunks")
+        assert store.chunk_hashes(digest, 256) == [hashlib.sha256(data[i:i + 256]).hexdigest()
+                                                   for i in range(0, 1000, 256)]
+
+    def test_digest_without_reading_back(self, tmp_path, monkeypatch):
+        """Тест хэша файла из частей вразнобой без чтения полученных данных с диска"""
+        data = os.urandom(1000)
+        session = UploadSession.create(str(tmp_path), "a.bin", len(data), chunk_size=100)
+        read = []
+        monkeypatch.setattr(transfer, "read_range", lambda path, *args: read.append(path) or read_range(path, *args))
+        for start, end in [(300, 400), (0, 100), (200, 300), (100, 200), *split_ranges([(400, 1000)], 100)]:
+            write(session, start, data[start:end])
+        assert session.digest() == hashlib.sha256(data).hexdigest()
+        assert session.data_path not in read
+
+    @pytest.mark.parametrize("restart", [False, True], ids=["memory-limit", "restart"])
+    def test_digest_reads_what_was_not_hashed(self, tmp_path, monkeypatch, restart):
+        """Тест хэша, если части не поместились в память или состояние потеряно при перезапуске"""
+        data = os.urandom(1000)
+        if not restart:
+            monkeypatch.setattr(transfer, "PENDING_BYTES", 150)
+        session = UploadSession.create(str(tmp_path), "a.bin", len(data), chunk_size=100)
+        for start, end in reversed(split_ranges([(0, len(data))], 100)):
+            write(session, start, data[start:end])
+        if restart:
+            UploadSession._hashes.clear()
+        assert UploadSession.load(str(tmp_path), session.id).digest() == hashlib.sha256(data).hexdigest()
+
+    def test_digest_in_order(self, tmp_path):
+        """Тест хэша файла, собранного по мере записи частей по порядку"""
+        data = os.urandom(1000)
+        session = UploadSession.create(str(tmp_path), "a.bin", len(data))
+        write(session, 0, data[:400])
+        assert session.digest() is None
+        write(session, 400, data[400:])
+        assert session.digest() == hashlib.sha256(data).hexdigest()
+
+    def test_resume_by_key(self, tmp_path):
+        """Тест продолжения незавершенной загрузки"""
+        session = UploadSession.create(str(tmp_path), "iso", 100, key="k")
+        write(session, 0, b"x" * 60)
+
+        resumed = UploadSession.create(str(tmp_path), "iso", 100, key="k")
+        assert resumed.id == session.id
+        assert resumed.status()["missing"] == [[60, 100]]
+        with pytest.raises(ValueError):
+            resumed.commit(BlobStore(str(tmp_path / "uploads")))
+
+    def test_bad_checksum_not_recorded(self, tmp_path):
+        """Тест отказа принять часть с неверной контрольной суммой"""
+        session = UploadSession.create(str(tmp_path), "f", 10)
+        with pytest.raises(ChecksumError):
+            write(session, 0, b"0123456789", "00" * 32)
+        assert UploadSession.load(str(tmp_path), session.id).status()["received"] == []
+
+    def test_corrupt_retransmission_keeps_data(self, tmp_path):
+        """Тест сохранения полученной части при повторе с неверной контрольной суммой"""
+        data = os.urandom(10)
+        session = UploadSession.create(str(tmp_path), "f", 10)
+        write(session, 0, data, hashlib.sha256(data).hexdigest())
+        with pytest.raises(ChecksumError):
+            write(session, 0, b"X" * 10, hashlib.sha256(data).hexdigest())
+
+        with open(session.data_path, "rb") as f:
+            assert f.read() == data
+        assert sorted(os.listdir(session.path)) == ["data", "meta.json"]  # Временный файл части удален
+        assert session.digest() == hashlib.sha256(data).hexdigest()
+
+    def test_chunk_beyond_size_rejected(self, tmp_path):
+        """Тест защиты от записи за пределы объявленного размера"""
+        session = UploadSession.create(str(tmp_path), "f", 10)
+        with pytest.raises(ValueError):
+            write(session, 5, b"0123456789")
+
+    def test_filename_sanitized(self, tmp_path):
+        """Тест отбрасывания каталогов из имени файла"""
+        session = UploadSession.create(str(tmp_path), "../../etc/passwd", 1)
+        assert session.meta["filename"] == "passwd"
+        assert UploadSession.load(str(tmp_path), "../" + session.id) is None
+
+
+class TestConditional:
+    """Тесты для условных запросов и кэша маленьких файлов"""
+
+    def test_not_modified(self):
+        """Тест сравнения ETag и даты изменения"""
+        etag = '"abc"'
+        assert not_modified('"abc"', None, etag, 1000)
+        assert not_modified('"x", W/"abc"', None, etag, 1000)
+        assert not_modified("*", None, etag, 1000)
+        assert not not_modified('"x"', "Thu, 01 Jan 2099 00:00:00 GMT", etag, 1000)
+        assert not_modified(None, "Thu, 01 Jan 1970 00:16:40 GMT", etag, 1000.5)
+        assert not not_modified(None, "Thu, 01 Jan 1970 00:16:39 GMT", etag, 1000)
+        assert not not_modified(None, "не дата", etag, 1000)
+        assert not not_modified(None, None, etag, 1000)
+
+    def test_file_cache_lru_budget(self, tmp_path):
+        """Тест вытеснения давно не использованных файлов по объему"""
+        cache = FileCache(max_bytes=250, max_file_size=100)
+        paths = []
+        for name in "abc":
+            path = tmp_path / name
+            path.write_bytes(name.encode() * 100)
+            paths.append(str(path))
+        assert cache.get(paths[0], os.stat(paths[0])) == b"a" * 100
+        cache.get(paths[1], os.stat(paths[1]))
+        cache.get(paths[0], os.stat(paths[0]))
+        cache.get(paths[2], os.stat(paths[2]))
+        assert cache.size == 200
+        assert list(cache._entries) == [paths[0], paths[2]]
+
+        big = tmp_path / "big"
+        big.write_bytes(b"x" * 101)
+        assert cache.get(str(big), os.stat(big)) is None
+
+    def test_file_cache_sees_changes(self, tmp_path):
+        """Тест перечитывания измененного файла"""
+        cache = FileCache()
+        path = tmp_path / "avatar"
+        path.write_bytes(b"old")
+        cache.get(str(path), os.stat(path))
+        path.write_bytes(b"new!")
+        assert cache.get(str(path), os.stat(path)) == b"new!"
+        assert cache.size == 4
+
+
+class TestMultipartFile:
+    """Тесты для потокового multipart-тела"""
+
+    def test_body_is_valid_multipart(self, tmp_path):
+        """Тест формата тела, длины и отчета о прогрессе"""
+        data = os.urandom(5000)
+        path = tmp_path / "отчет.bin"
+        path.write_bytes(data)
+        progress = []
+        body = MultipartFile(str(path), on_progress=progress.append, block=1024)
+        raw = b"".join(body)
+
+        assert len(raw) == len(body)
+        assert sum(progress) == len(data) and max(progress) == 1024
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + body.content_type.encode() + b"\r\n\r\n" + raw)
+        part, = message.iter_parts()
+        assert part.get_filename() == "отчет.bin"
+        assert part.get_content() == data
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import time
+import zlib
+import pytest
+import sys
+import os
+from fastapi.testclient import TestClient
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msg_server
+from history import HistoryStore
+from msg_server import Frame, Subscription, WebSocketHub
+
+PEER = ("192.168.1.20", 25896)
+
+
+class FakeBroadcaster:
+    """Широковещатель без сети: отправленное запоминается, входящее подается через deliver"""
+
+    def __init__(self):
+        self.sent = []
+        self._subscribers = set()
+
+    async def start_async(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def broadcast(self, message: dict) -> bool:
+        self.sent.append(message)
+        return True
+
+    def subscribe(self, maxsize: int = 256) -> Subscription:
+        subscription = Subscription(self, asyncio.get_running_loop(), maxsize)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def deliver(self, message: dict):
+        """Сообщение, будто пришедшее по UDP (из любого потока)"""
+        for subscription in list(self._subscribers):
+            subscription.put((message, PEER))
+
+    def stats(self) -> dict:
+        return {}
+
+
+class FakeWebSocket:
+    """WebSocket без сети; stalled=True — отправка висит до resume() (медленный клиент)"""
+
+    client = None
+
+    def __init__(self, stalled: bool = False):
+        self.sent = []
+        self.closed = None
+        self._open = asyncio.Event()
+        if not stalled:
+            self._open.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        await self._open.wait()
+        self.sent.append(text)
+
+    async def send_bytes(self, data: bytes):
+        await self._open.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.closed = code
+
+    def resume(self):
+        self._open.set()
+
+
+def wait_for(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Условие не выполнилось вовремя"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def network(tmp_path, monkeypatch):
+    """Приложение сообщений с хабом поверх FakeBroadcaster; возвращает (клиент, широковещатель, хаб)"""
+    broadcaster = FakeBroadcaster()
+    hub = WebSocketHub(broadcaster)
+    monkeypatch.setattr(msg_server, "broadcaster", broadcaster)
+    monkeypatch.setattr(msg_server, "hub", hub)
+    monkeypatch.setattr(msg_server, "history", HistoryStore(str(tmp_path / "history.db")))
+    with TestClient(msg_server.app) as client:
+        wait_for(lambda: broadcaster._subscribers)  # Мост хаба подписался
+        yield client, broadcaster, hub
+
+
+class TestWebSocketHub:
+    """Тесты рассылки WebSocket-клиентам через /ws"""
+
+    def test_fan_out_without_echo(self, network):
+        """Тест доставки всем клиентам, кроме отправителя"""
+        client, _, hub = network
+        with client.websocket_connect("/ws") as alice, client.websocket_connect("/ws") as bob, \
+                client.websocket_connect("/ws") as carol:
+            wait_for(lambda: len(hub.clients) == 3)
+            alice.send_json({"username": "alice", "message": "привет"})
+            assert bob.receive_json() == {"username": "alice", "message": "привет"}
+            assert carol.receive_json() == {"username": "alice", "message": "привет"}
+
+            # Первым alice получает чужое сообщение, а не эхо своего
+            bob.send_json({"username": "bob", "message": "ответ"})
+            assert alice.receive_json() == {"username": "bob", "message": "ответ"}
+
+    def test_bridge_to_broadcaster(self, network):
+        """Тест отправки сообщения клиента в сеть по UDP"""
+        client, broadcaster, hub = network
+        with client.websocket_connect("/ws") as alice, client.websocket_connect("/ws") as bob:
+            wait_for(lambda: len(hub.clients) == 2)
+            alice.send_json({"username": "alice", "message": "в сеть"})
+            bob.receive_json()
+        assert broadcaster.sent == [{"username": "alice", "message": "в сеть"}]
+
+    def test_bridge_from_broadcaster(self, network):
+        """Тест доставки сообщения из UDP всем клиентам"""
+        client, broadcaster, hub = network
+        with client.websocket_connect("/ws") as alice, client.websocket_connect("/ws") as bob:
+            wait_for(lambda: len(hub.clients) == 2)
+            broadcaster.deliver({"username": "lan", "message": "из сети"})
+            assert alice.receive_json() == {"username": "lan", "message": "из сети"}
+            assert bob.receive_json() == {"username": "lan", "message": "из сети"}
+
+    def test_disconnect_cleanup(self, network):
+        """Тест удаления клиента и остановки его задачи после отключения"""
+        client, _, hub = network
+        with client.websocket_connect("/ws"):
+            wait_for(lambda: len(hub.clients) == 1)
+            connected, = hub.clients
+        wait_for(lambda: not hub.clients)
+        wait_for(lambda: connected.task.done())
+        assert client.get("/stats").json()["websocket"]["clients"] == 0
+
+    def test_send_error_closes_socket(self):
+        """Тест закрытия сокета клиента, отправка которому завершилась ошибкой"""
+        class BrokenWebSocket(FakeWebSocket):
+            async def send_text(self, text: str):
+                raise ConnectionResetError("соединение разорвано")
+
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster())
+            websocket = BrokenWebSocket()
+            client = await hub.connect(websocket)
+            hub.publish({"username": "u", "message": "не дойдет"})
+            await asyncio.sleep(0.01)
+            return hub, websocket, client
+
+        hub, websocket, client = asyncio.run(scenario())
+        assert websocket.closed == 1011
+        assert client not in hub.clients
+        assert client.task.done()
+
+
+class TestFrames:
+    """Тесты сериализации кадров: один Frame на сообщение, пакеты и сжатие"""
+
+    def test_frame_shared_across_clients(self):
+        """Тест постановки одного и того же Frame в очереди всех клиентов"""
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster())
+            first = await hub.connect(FakeWebSocket(stalled=True))
+            second = await hub.connect(FakeWebSocket(stalled=True))
+            hub.publish({"username": "u", "message": "один раз"})
+            return first.queue[0][1], second.queue[0][1]
+
+        first, second = asyncio.run(scenario())
+        assert isinstance(first, Frame)
+        assert first is second
+
+    def test_lagging_client_gets_array(self):
+        """Тест отправки накопленных сообщений одним кадром-массивом из готовых текстов"""
+        messages = [{"username": "u", "message": str(i)} for i in range(3)]
+
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster())
+            websocket = FakeWebSocket()
+            client = await hub.connect(websocket, batch=True)
+            for message in messages:
+                hub.publish(message)  # Задача отправки еще не запускалась: клиент отстал на 3 сообщения
+            frames = [frame for _, frame in client.queue]
+            await asyncio.sleep(0.05)
+            hub.disconnect(client)
+            return websocket.sent, frames, client
+
+        sent, frames, client = asyncio.run(scenario())
+        assert sent == ["[" + ",".join(frame.text for frame in frames) + "]"]
+        assert json.loads(sent[0]) == messages
+        assert (client.sent, client.writes) == (3, 1)
+
+    def test_deflate_only_when_smaller(self):
+        """Тест двоичного кадра только для сообщений, которые сжатие уменьшает"""
+        short = {"username": "u", "message": "ok"}
+        long = {"username": "u", "message": "повтор " * 200}
+
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster())
+            websocket = FakeWebSocket()
+            client = await hub.connect(websocket, deflate=True)
+            for message in (short, long):
+                hub.publish(message)
+                await asyncio.sleep(0.01)
+            hub.disconnect(client)
+            return websocket.sent
+
+        plain, packed = asyncio.run(scenario())
+        assert isinstance(plain, str) and json.loads(plain) == short
+        assert isinstance(packed, bytes) and len(packed) < len(json.dumps(long, ensure_ascii=False).encode())
+        assert json.loads(zlib.decompress(packed).decode("utf-8")) == long
+
+
+async def stalled_client(hub: WebSocketHub, backlog: int):
+    """Клиент, застрявший на отправке сообщения "0", и еще backlog сообщений после него"""
+    websocket = FakeWebSocket(stalled=True)
+    client = await hub.connect(websocket)
+    hub.publish({"message": "0"})
+    await asyncio.sleep(0.01)  # Задача отправки забрала "0" и ждет медленный сокет
+    for i in range(1, backlog + 1):
+        hub.publish({"message": str(i)})
+    return websocket, client
+
+
+async def drain(websocket: FakeWebSocket) -> list:
+    """Возобновить отправку и получить тексты доставленных сообщений"""
+    websocket.resume()
+    await asyncio.sleep(0.05)
+    return [json.loads(text)["message"] for text in websocket.sent]
+
+
+def websocket_stats(monkeypatch, hub: WebSocketHub) -> dict:
+    """Раздел websocket ответа /message/stats для хаба"""
+    monkeypatch.setattr(msg_server, "broadcaster", hub.broadcaster)
+    monkeypatch.setattr(msg_server, "hub", hub)
+    return TestClient(msg_server.app).get("/stats").json()["websocket"]
+
+
+class TestSlowClients:
+    """Тесты политик медленного клиента"""
+
+    def test_drop_oldest(self):
+        """Тест отбрасывания самых старых сообщений переполненной очереди"""
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster(), queue_size=2, policy="drop-oldest")
+            websocket, client = await stalled_client(hub, 3)
+            dropped = client.dropped
+            return dropped, await drain(websocket)
+
+        assert asyncio.run(scenario()) == (1, ["0", "2", "3"])
+
+    def test_drop_newest(self):
+        """Тест отбрасывания новых сообщений, не поместившихся в очередь"""
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster(), queue_size=2, policy="drop-newest")
+            websocket, client = await stalled_client(hub, 3)
+            dropped = client.dropped
+            return dropped, await drain(websocket)
+
+        assert asyncio.run(scenario()) == (1, ["0", "1", "2"])
+
+    def test_disconnect_on_full_queue(self, monkeypatch):
+        """Тест отключения клиента с кодом 1008 при переполнении очереди"""
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster(), queue_size=2, policy="disconnect")
+            websocket, client = await stalled_client(hub, 2)
+            assert client in hub.clients
+            hub.publish({"message": "3"})
+            await asyncio.sleep(0.01)
+            return hub, websocket, client
+
+        hub, websocket, client = asyncio.run(scenario())
+        assert websocket.closed == 1008
+        assert client not in hub.clients
+        assert client.task.done()
+        stats = websocket_stats(monkeypatch, hub)
+        assert (stats["clients"], stats["evicted"], stats["policy"]) == (0, 1, "disconnect")
+
+    def test_disconnect_on_max_lag(self):
+        """Тест отключения клиента, у которого самое старое сообщение ждет дольше max_lag"""
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster(), queue_size=100, policy="disconnect", max_lag=0.05)
+            websocket, client = await stalled_client(hub, 1)
+            hub.publish({"message": "2"})  # Очередь еще не отстала
+            connected = client in hub.clients
+            await asyncio.sleep(0.1)
+            hub.publish({"message": "3"})
+            await asyncio.sleep(0.01)
+            return connected, hub, websocket
+
+        connected, hub, websocket = asyncio.run(scenario())
+        assert connected
+        assert websocket.closed == 1008
+        assert hub.evicted == 1 and not hub.clients
+
+    def test_counters_in_stats(self, monkeypatch):
+        """Тест счетчиков очередей и отброшенных сообщений в /message/stats"""
+        async def scenario():
+            hub = WebSocketHub(FakeBroadcaster(), queue_size=2, policy="drop-oldest")
+            await stalled_client(hub, 5)
+            await hub.connect(FakeWebSocket())
+            return hub
+
+        stats = websocket_stats(monkeypatch, asyncio.run(scenario()))
+        assert (stats["clients"], stats["queued"], stats["dropped"], stats["evicted"]) == (2, 2, 3, 0)
+        assert stats["policy"] == "drop-oldest"
+        assert sorted((client["depth"], client["dropped"]) for client in stats["per_client"]) == [(0, 0), (2, 3)]
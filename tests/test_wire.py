@@ -0,0 +1,192 @@
+import json
+import pytest
+import sys
+import os
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire
+
+
+class TestWireFormat:
+    """Тесты для бинарного формата датаграмм"""
+
+    def setup_method(self):
+        self.room = wire.room_id(wire.DEFAULT_ROOM)
+        self.sender = wire.new_sender_id()
+
+    def test_chat_roundtrip(self):
+        """Тест кодирования чат-сообщения без JSON"""
+        message = {"username": "Алиса", "message": "Привет, LAN!"}
+        data = wire.encode(message, self.room, self.sender, 7)
+
+        assert wire.is_binary(data)
+        header, payload = wire.decode_header(data)
+        assert header.type == wire.TYPE_CHAT
+        assert header.room == self.room
+        assert header.sender == self.sender
+        assert header.seq == 7
+        assert header.version == wire.VERSION
+        assert wire.decode_payload(header, payload) == message
+
+    def test_clock_in_header(self):
+        """Тест передачи логических часов во всех фрагментах"""
+        data = wire.encode({"username": "u", "message": "x" * 3000}, self.room, self.sender, 1, clock=42)
+        for fragment in wire.fragment(data):
+            header, _ = wire.decode_header(fragment)
+            assert header.clock == 42
+
+    def test_json_roundtrip(self):
+        """Тест кодирования произвольного словаря"""
+        message = {"username": "bob", "message": "файл",
+                   "file_info": {"name": "a.iso", "size": 10}}
+        header, payload = wire.decode_header(wire.encode(message, self.room, self.sender, 1))
+        assert header.type == wire.TYPE_JSON
+        assert wire.decode_payload(header, payload) == message
+
+    def test_binary_smaller_than_json(self):
+        """Тест компактности бинарного формата"""
+        message = {"username": "user", "message": "ok"}
+        assert len(wire.encode(message, self.room, self.sender, 1)) < len(wire.encode_json(message))
+
+    def test_truncated_payload(self):
+        """Тест обнаружения обрезанной датаграммы"""
+        data = wire.encode({"username": "u", "message": "x" * 100}, self.room, self.sender, 1)
+        with pytest.raises(ValueError):
+            wire.decode_header(data[:-1])
+
+    def test_fragment_roundtrip(self):
+        """Тест разбиения большого сообщения на фрагменты"""
+        message = {"username": "u", "message": "лог " * 2000}
+        fragments = wire.fragment(wire.encode(message, self.room, self.sender, 3), mtu=1000)
+
+        assert len(fragments) > 1
+        assert all(len(f) <= 1000 for f in fragments)
+        chunks = {}
+        for data in fragments:
+            header, payload = wire.decode_header(data)
+            assert header.flags & wire.FLAG_FRAGMENT
+            index, count, total, chunk = wire.decode_fragment(payload)
+            chunks[index] = chunk
+        assert len(chunks) == count
+        full = b''.join(chunks[i] for i in range(count))
+        assert len(full) == total
+        assert wire.decode_payload(header, full) == message
+
+    def test_oversized_message_rejected(self):
+        """Тест отказа отправлять сообщение, которое получатель не соберет"""
+        limit = wire.MAX_MESSAGE - len("u") - wire._USERNAME_LEN.size
+        wire.encode({"username": "u", "message": "x" * limit}, self.room, self.sender, 1)
+        with pytest.raises(ValueError):
+            wire.encode({"username": "u", "message": "x" * (limit + 1)}, self.room, self.sender, 1)
+
+    def test_small_message_not_fragmented(self):
+        """Тест отсутствия фрагментации для коротких сообщений"""
+        data = wire.encode({"username": "u", "message": "hi"}, self.room, self.sender, 1)
+        assert wire.fragment(data) == [data]
+
+    def test_room_group(self):
+        """Тест отображения комнаты на multicast-группу"""
+        group = wire.room_group("dev")
+        assert group.startswith(wire.MULTICAST_PREFIX + ".")
+        assert group == wire.room_group("dev")
+        assert all(0 <= int(part) <= 255 for part in group.split("."))
+
+    def test_message_id_includes_room(self):
+        """Тест различия идентификаторов сообщений разных комнат"""
+        message = {"username": "u", "message": "hi"}
+        h1, _ = wire.decode_header(wire.encode(message, wire.room_id("a"), self.sender, 1))
+        h2, _ = wire.decode_header(wire.encode(message, wire.room_id("b"), self.sender, 1))
+        assert wire.message_id(h1) != wire.message_id(h2)
+
+    def test_batch_roundtrip(self):
+        """Тест упаковки нескольких датаграмм в одну"""
+        datagrams = [wire.encode({"username": "u", "message": str(i)}, self.room, self.sender, i)
+                     for i in range(1, 6)]
+        batch = wire.pack_batch(self.room, self.sender, datagrams)
+
+        assert wire.is_batch(batch)
+        assert not wire.is_batch(datagrams[0])
+        assert len(batch) == wire.batch_size(datagrams)
+        _, payload = wire.decode_header(batch)
+        assert wire.unpack_batch(payload) == datagrams
+
+    def test_compression_roundtrip(self):
+        """Тест сжатия типичного файлового сообщения общим словарем"""
+        message = {"username": "bob", "message": "отправил файл: setup.exe",
+                   "file_info": {"name": "setup.exe", "size": 123456, "type": "application/x-msdownload"}}
+        plain = wire.encode(message, self.room, self.sender, 1)
+        packed = wire.encode(message, self.room, self.sender, 1, compressed=True)
+
+        assert len(packed) < len(plain)
+        header, payload = wire.decode_header(packed)
+        assert header.flags & wire.FLAG_COMPRESSED
+        assert header.flags & wire.FLAG_CAP_ZDICT
+        assert wire.decode_payload(header, payload) == message
+
+    def test_compression_skipped_when_useless(self):
+        """Тест отказа от сжатия, если оно не уменьшает нагрузку"""
+        message = {"username": "z", "message": "Q"}
+        header, payload = wire.decode_header(wire.encode(message, self.room, self.sender, 1, compressed=True))
+        assert not header.flags & wire.FLAG_COMPRESSED
+        assert wire.decode_payload(header, payload) == message
+
+    def test_decompress_limit(self):
+        """Тест предела распаковки с учетом байтов, которые отдает flush()"""
+        assert len(wire.decompress(wire.compress(b"a" * wire.MAX_DECOMPRESSED))) == wire.MAX_DECOMPRESSED
+        with pytest.raises(ValueError):
+            wire.decompress(wire.compress(b"a" * (wire.MAX_DECOMPRESSED + 10)))
+
+    def test_short_chat_payload_rejected(self):
+        """Тест отказа разбирать нагрузку короче длины имени или с обрезанным именем"""
+        for payload in (b"", b"\x00", b"\x00\x05bob"):
+            data = wire.HEADER.pack(wire.MAGIC, wire.VERSION, wire.TYPE_CHAT, 0, self.room, self.sender,
+                                    1, 0, len(payload)) + payload
+            header, body = wire.decode_header(data)
+            with pytest.raises(ValueError):
+                wire.decode_payload(header, body)
+
+    def test_presence_roundtrip(self):
+        """Тест heartbeat присутствия с именем и без"""
+        data = wire.encode_presence(self.room, self.sender, 3, 17, 12.5, "Алиса")
+        header, payload = wire.decode_header(data)
+        assert header.type == wire.TYPE_PRESENCE
+        assert header.seq == 17
+        assert wire.decode_presence(payload) == (3, 12.5, "Алиса")
+
+        keepalive = wire.encode_presence(self.room, self.sender, 1, 18, 5.0)
+        assert len(keepalive) == wire.HEADER.size + 3
+        _, payload = wire.decode_header(keepalive)
+        assert wire.decode_presence(payload) == (1, 5.0, None)
+
+    def test_version1_header(self):
+        """Тест разбора датаграммы узла версии 1 (заголовок без clock)"""
+        payload = json.dumps({"username": "old", "message": "hi"}).encode()
+        data = wire.HEADER_V1.pack(wire.MAGIC, 1, wire.TYPE_JSON, 0, self.room, self.sender, 5,
+                                   len(payload)) + payload
+        header, body = wire.decode_header(data)
+        assert (header.version, header.seq, header.clock) == (1, 5, 0)
+        assert wire.decode_payload(header, body) == {"username": "old", "message": "hi"}
+
+    def test_unknown_version_rejected(self):
+        """Тест отказа разбирать заголовок неизвестной версии"""
+        data = bytearray(wire.encode({"username": "u", "message": "hi"}, self.room, self.sender, 1))
+        data[2] = wire.VERSION + 1
+        with pytest.raises(ValueError):
+            wire.decode_header(bytes(data))
+
+    def test_legacy_json(self):
+        """Тест совместимости со старыми узлами"""
+        assert not wire.is_binary(b'{"username": "old", "message": "hi"}')
+        message, capable = wire.decode_json(b'{"username": "old", "message": "hi"}')
+        assert message == {"username": "old", "message": "hi"}
+        assert not capable
+
+        message, capable = wire.decode_json(wire.encode_json({"username": "new", "message": "hi"}))
+        assert message == {"username": "new", "message": "hi"}
+        assert capable
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
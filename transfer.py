@@ -0,0 +1,467 @@
+"""Передача файлов по частям: сессии докачиваемой загрузки и учет диапазонов
+
+Клиент создает сессию (имя, размер), отправляет части по смещению с
+контрольной суммой SHA-256 каждой части и в любой момент может узнать,
+какие диапазоны уже получены. Части можно отправлять параллельно и в
+любом порядке. Состояние сессии хранится на диске рядом с данными,
+поэтому прерванная загрузка продолжается и после перезапуска сервера.
+Готовый файл переносится в хранилище по содержимому (blobs.BlobStore).
+
+Скачивание поддерживает заголовки Range/If-Range, поэтому клиент может
+запрашивать несколько диапазонов параллельно (parse_range, read_range),
+и условные запросы (not_modified); маленькие файлы отдаются из памяти
+(FileCache).
+
+Диапазоны полуоткрытые: (start, end) означает байты start..end-1.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from blobs import CHUNK_SIZE, BlobStore
+
+DEFAULT_CHUNK_SIZE = CHUNK_SIZE  # Хэши частей такого размера хранилище считает при записи
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+SESSION_TTL = 24 * 3600  # Незавершенные сессии старше суток удаляются
+SPOOL_BLOCK = 1024 * 1024  # Сколько байт части накопить перед записью на диск в пуле потоков
+PENDING_BYTES = 64 * 1024 * 1024  # Сколько байт забежавших вперед частей сессии держать в памяти для хэша файла
+
+Range = Tuple[int, int]
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 файла, прочитанного блоками"""
+    digest = hashlib.sha256()
+    for data in read_range(path, 0, os.path.getsize(path)):
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def add_range(ranges: List[Range], start: int, end: int) -> List[Range]:
+    """Добавить диапазон к отсортированному списку, объединив пересекающиеся и смежные"""
+    merged = []
+    for low, high in ranges:
+        if high < start or low > end:
+            merged.append((low, high))
+        else:
+            start, end = min(start, low), max(end, high)
+    merged.append((start, end))
+    return sorted(merged)
+
+
+def missing_ranges(ranges: List[Range], size: int) -> List[Range]:
+    """Диапазоны [0, size), которых нет в ranges"""
+    missing, position = [], 0
+    for low, high in ranges:
+        if low > position:
+            missing.append((position, low))
+        position = max(position, high)
+    if position < size:
+        missing.append((position, size))
+    return missing
+
+
+def split_ranges(ranges: List[Range], chunk_size: int) -> List[Range]:
+    """Разбиение диапазонов на части не больше chunk_size"""
+    chunks = []
+    for low, high in ranges:
+        chunks.extend((start, min(start + chunk_size, high)) for start in range(low, high, chunk_size))
+    return chunks
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Range]:
+    """Диапазон из заголовка Range ("bytes=a-b", "bytes=a-", "bytes=-n")
+
+    None — заголовка нет или он не поддерживается (несколько диапазонов,
+    другие единицы), тогда отдается весь файл. ValueError — диапазон не
+    пересекается с файлом (ответ 416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[len("bytes="):].strip().partition("-")
+    if not sep or not (first or last) or not (first or "0").isdigit() or not (last or "0").isdigit():
+        return None
+    if not first:  # Последние n байт
+        start, end = max(0, size - int(last)), size
+    else:
+        start, end = int(first), min(size, int(last) + 1) if last else size
+    if start >= end:
+        raise ValueError("Диапазон вне файла")
+    return start, end
+
+
+def read_range(path: str, start: int, end: int, block: int = 1024 * 1024) -> Iterator[bytes]:
+    """Чтение байтов start..end-1 блоками (постоянная память)"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        while start < end:
+            data = f.read(min(block, end - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+
+def _opaque(tag: str) -> str:
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], etag: str, mtime: float) -> bool:
+    """Есть ли у клиента актуальная копия (ответ 304)
+
+    If-None-Match сравнивается слабо и, если передан, важнее If-Modified-Since.
+    """
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(_opaque(tag) == _opaque(etag) for tag in tags)
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+class FileCache:
+    """Содержимое маленьких часто скачиваемых файлов в памяти (LRU по объему)
+
+    Запись действительна, пока у файла те же время изменения и размер.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, max_file_size: int = 256 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[Tuple[int, int], bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[bytes]:
+        """Содержимое файла; читает и запоминает его, если файл достаточно мал"""
+        if stat.st_size > self.max_file_size:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(path)
+                return entry[1]
+        with open(path, "rb") as f:
+            data = f.read(self.max_file_size + 1)
+        if len(data) != stat.st_size:  # Файл изменился во время чтения
+            return None
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[path] = (version, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+
+class MultipartFile:
+    """Тело multipart/form-data с одним файлом, читаемое с диска по блокам
+
+    Длина известна заранее (len), поэтому requests отправляет его с
+    Content-Length, не собирая тело в памяти. on_progress(n) вызывается
+    после каждого отправленного блока файла.
+    """
+
+    def __init__(self, path: str, field: str = "file", filename: Optional[str] = None,
+                 on_progress: Optional[Callable[[int], None]] = None, block: int = 1024 * 1024):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.boundary = uuid.uuid4().hex
+        self.on_progress = on_progress
+        self.block = block
+        filename = (filename or os.path.basename(path)).replace('"', "%22")
+        self._head = (f"--{self.boundary}\r\n"
+                      f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                      f"Content-Type: application/octet-stream\r\n\r\n").encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self.size + len(self._tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self._head
+        for data in read_range(self.path, 0, self.size, self.block):
+            yield data
+            if self.on_progress:
+                self.on_progress(len(data))
+        yield self._tail
+
+
+class ChecksumError(ValueError):
+    """Контрольная сумма части не совпала с переданной"""
+
+
+class FileHash:
+    """SHA-256 непрерывного начала файла, который собирается из частей в любом порядке
+
+    Часть, пришедшая по порядку, хэшируется во время записи. Забежавшие вперед
+    части ждут своей очереди в памяти (всего не больше PENDING_BYTES), поэтому
+    полученные данные с диска не перечитываются.
+    """
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.position = 0
+        self.pending: Dict[int, bytes] = {}
+        self.pending_bytes = 0
+
+    def hold(self, offset: int, data: bytes):
+        """Отложить проверенную часть до того, как начало файла дойдет до нее"""
+        if offset >= self.position and offset not in self.pending and \
+                self.pending_bytes + len(data) <= PENDING_BYTES:
+            self.pending[offset] = data
+            self.pending_bytes += len(data)
+
+    def advance(self):
+        """Продвинуть хэш по отложенным частям, которые продолжают начало файла"""
+        while self.position in self.pending:
+            data = self.pending.pop(self.position)
+            self.pending_bytes -= len(data)
+            self.sha.update(data)
+            self.position += len(data)
+
+
+class UploadSession:
+    """Сессия докачиваемой загрузки: data (файл полного размера) и meta.json"""
+
+    _locks: Dict[str, threading.Lock] = {}
+    _hashes: Dict[str, FileHash] = {}  # Хэш файла каждой сессии (в памяти процесса)
+
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self.meta = meta
+        self._lock = self._locks.setdefault(path, threading.Lock())
+
+    @property
+    def id(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(self.path, "data")
+
+    @classmethod
+    def create(cls, root: str, filename: str, size: int, chunk_size: int = DEFAULT_CHUNK_SIZE,
+               key: Optional[str] = None) -> "UploadSession":
+        """Новая сессия; с key возвращается незавершенная сессия того же файла (докачка)"""
+        cls.cleanup(root)
+        filename = os.path.basename(filename)
+        if not filename or size < 0:
+            raise ValueError("Некорректное имя или размер файла")
+        if key is not None:
+            for session in cls.sessions(root):
+                if (session.meta.get("key"), session.meta["filename"], session.meta["size"]) == (key, filename, size):
+                    return session
+        path = os.path.join(root, uuid.uuid4().hex)
+        os.makedirs(path)
+        with open(os.path.join(path, "data"), "wb") as f:
+            f.truncate(size)  # Разреженный файл: место выделяется по мере записи частей
+        session = cls(path, {
+            "filename": filename,
+            "size": size,
+            "chunk_size": max(1, min(chunk_size, MAX_CHUNK_SIZE)),
+            "key": key,
+            "received": [],
+            "created": time.time(),
+        })
+        session._save()
+        return session
+
+    @classmethod
+    def load(cls, root: str, session_id: str) -> Optional["UploadSession"]:
+        """Сессия по идентификатору или None"""
+        if len(session_id) != 32 or any(c not in "0123456789abcdef" for c in session_id):
+            return None
+        path = os.path.join(root, session_id)
+        try:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        meta["received"] = [tuple(r) for r in meta["received"]]
+        return cls(path, meta)
+
+    @classmethod
+    def sessions(cls, root: str) -> List["UploadSession"]:
+        if not os.path.isdir(root):
+            return []
+        sessions = (cls.load(root, name) for name in os.listdir(root))
+        return [session for session in sessions if session is not None]
+
+    @classmethod
+    def cleanup(cls, root: str, max_age: float = SESSION_TTL):
+        """Удаление брошенных сессий"""
+        now = time.time()
+        for session in cls.sessions(root):
+            if now - session.meta["created"] > max_age:
+                session.discard()
+
+    def _save(self):
+        # Атомарная замена: при сбое остается прежнее согласованное состояние
+        tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    async def write(self, offset: int, chunks: AsyncIterator[bytes], checksum: Optional[str] = None) -> int:
+        """Запись части по смещению с проверкой SHA-256; возвращает длину части
+
+        Часть сначала пишется во временный файл и переносится в data только после
+        совпадения контрольной суммы, поэтому испорченный повтор не затирает уже
+        полученные байты. Запись и хэширование идут в пуле потоков, не в цикле событий.
+        """
+        size = self.meta["size"]
+        if offset < 0 or offset > size:
+            raise ValueError("Смещение вне файла")
+        loop = asyncio.get_running_loop()
+        digest = hashlib.sha256()
+        state = self._hashes.setdefault(self.path, FileHash())
+        whole = state.sha.copy() if state.position == offset else None
+        hashes = [digest] if whole is None else [digest, whole]
+        # Забежавшая вперед часть остается в памяти, чтобы хэш файла потом не читал ее с диска
+        kept: Optional[List[bytes]] = [] if whole is None and state.pending_bytes < PENDING_BYTES else None
+        spool = os.path.join(self.path, "part-" + uuid.uuid4().hex)
+        position = offset
+        try:
+            with open(spool, "wb") as f:
+                block: List[bytes] = []
+                buffered = 0
+                async for chunk in chunks:
+                    if position + len(chunk) > size or position + len(chunk) - offset > MAX_CHUNK_SIZE:
+                        raise ValueError("Часть выходит за пределы файла")
+                    block.append(chunk)
+                    if kept is not None:
+                        kept.append(chunk)
+                    buffered += len(chunk)
+                    position += len(chunk)
+                    if buffered >= SPOOL_BLOCK:
+                        await loop.run_in_executor(None, self._spool, f, b"".join(block), hashes)
+                        block, buffered = [], 0
+                if block:
+                    await loop.run_in_executor(None, self._spool, f, b"".join(block), hashes)
+            if checksum is not None and digest.hexdigest() != checksum.lower():
+                raise ChecksumError("Контрольная сумма части не совпадает")
+            if position > offset:
+                await loop.run_in_executor(None, self._place, spool, offset, position, digest.hexdigest(),
+                                           whole, kept, state)
+        finally:
+            if os.path.exists(spool):
+                os.remove(spool)
+        return position - offset
+
+    @staticmethod
+    def _spool(f, data: bytes, hashes: list):
+        f.write(data)
+        for digest in hashes:
+            digest.update(data)
+
+    def _place(self, spool: str, offset: int, end: int, checksum: str, whole, kept: Optional[List[bytes]],
+               state: FileHash):
+        """Перенос проверенной части в data и отметка диапазона и его хэша полученными"""
+        with open(self.data_path, "r+b") as f:
+            f.seek(offset)
+            for data in read_range(spool, 0, end - offset):
+                f.write(data)
+        with self._lock:
+            # Другие части могли записаться параллельно: перечитываем состояние
+            current = self.load(os.path.dirname(self.path), self.id)
+            meta = current.meta if current else self.meta
+            self.meta["received"] = add_range(meta["received"], offset, end)
+            self.meta["parts"] = {**meta.get("parts", {}), f"{offset}-{end}": checksum}
+            self._save()
+            if whole is not None and state.position == offset:
+                state.sha, state.position = whole, end
+            elif kept is not None:
+                state.hold(offset, b"".join(kept))
+            state.advance()
+
+    def digest(self) -> Optional[str]:
+        """SHA-256 всего файла или None, пока получены не все части
+
+        С диска читается только то, что хэш не успел учесть: части, не поместившиеся
+        в PENDING_BYTES, или весь файл, если сервер перезапускался во время загрузки.
+        """
+        if not self.complete():
+            return None
+        with self._lock:
+            state = self._hashes.setdefault(self.path, FileHash())
+            state.advance()
+            if state.position < self.meta["size"]:
+                for data in read_range(self.data_path, state.position, self.meta["size"]):
+                    state.sha.update(data)
+                state.position = self.meta["size"]
+                state.pending.clear()
+                state.pending_bytes = 0
+        return state.sha.hexdigest()
+
+    def status(self) -> dict:
+        received = self.meta["received"]
+        return {
+            "session": self.id,
+            "filename": self.meta["filename"],
+            "size": self.meta["size"],
+            "chunk_size": self.meta["chunk_size"],
+            "received": [list(r) for r in received],
+            "missing": [list(r) for r in missing_ranges(received, self.meta["size"])],
+        }
+
+    def complete(self) -> bool:
+        return not missing_ranges(self.meta["received"], self.meta["size"])
+
+    def part_hashes(self, chunk_size: int) -> Optional[List[str]]:
+        """SHA-256 частей файла по chunk_size байт из проверенных при загрузке частей
+
+        None, если части приходили другого размера: тогда хэши посчитает
+        хранилище при первом запросе.
+        """
+        parts = self.meta.get("parts", {})
+        size = self.meta["size"]
+        hashes = []
+        for start in range(0, size, chunk_size):
+            checksum = parts.get(f"{start}-{min(start + chunk_size, size)}")
+            if checksum is None:
+                return None
+            hashes.append(checksum)
+        return hashes
+
+    def commit(self, store: BlobStore) -> Tuple[str, bool]:
+        """Перенос собранного файла в хранилище и удаление сессии; возвращает (хэш, новый ли)
+
+        Может дочитывать файл для хэша: из асинхронного кода вызывать в пуле потоков.
+        """
+        digest = self.digest()
+        if digest is None:
+            raise ValueError("Получены не все части файла")
+        added = store.add(self.data_path, digest)
+        # Части по размеру части хранилища уже проверены: их хэши нужны другим узлам (swarm)
+        hashes = self.part_hashes(store.chunk_size)
+        if hashes is not None:
+            store.save_chunk_hashes(digest, store.chunk_size, hashes)
+        self.discard()
+        return digest, added
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._locks.pop(self.path, None)
+        self._hashes.pop(self.path, None)
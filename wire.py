@@ -0,0 +1,347 @@
+"""Бинарный формат датаграмм для широковещательного чата
+
+Датаграмма состоит из фиксированного заголовка и полезной нагрузки:
+
+    magic(2) version(1) type(1) flags(1) room(4) sender(8) seq(4) clock(4) length(4) payload(length)
+
+Заголовок позволяет отбросить чужую комнату или собственное эхо, не разбирая
+полезную нагрузку. Старые узлы отправляют обычный JSON, поэтому приемник
+различает форматы по magic-байтам.
+
+Сообщение, не помещающееся в одну датаграмму, делится на фрагменты с флагом
+FLAG_FRAGMENT; перед куском полезной нагрузки идет index(2) count(2) total(4).
+Все фрагменты одного сообщения имеют одинаковые sender и seq.
+
+Тройка sender, room и seq служит уникальным идентификатором сообщения
+(message_id): она одинакова у всех фрагментов и у повторно переданных копий.
+
+Каждой комнате соответствует своя multicast-группа (room_group), поэтому
+узел получает только трафик комнат, в которые вошел.
+
+Номер seq растет на единицу с каждым сообщением отправителя в комнате.
+Поле clock — логические часы Лэмпорта: сообщение, написанное в ответ на
+другое, всегда имеет большее значение clock, чем исходное. Служебные
+датаграммы TYPE_NACK (запрос повторной передачи пропущенных номеров) и
+TYPE_SYNC (объявление последнего отправленного номера) не нумеруются.
+
+TYPE_BATCH упаковывает несколько небольших датаграмм (каждую со своим
+заголовком и номером) в одну; приемник разбирает их по порядку.
+
+TYPE_PRESENCE — heartbeat присутствия (см. presence.py); поле seq в нем
+содержит версию состояния, а не номер сообщения.
+
+Узлы версии 1 отправляют заголовок без clock; их датаграммы разбираются
+с clock=0, а сами они понимают только JSON.
+
+Полезная нагрузка может быть сжата deflate с общим словарем DICTIONARY
+(флаг FLAG_COMPRESSED). Каждая датаграмма несет флаг FLAG_CAP_ZDICT, по
+которому отправитель узнает, что все участники комнаты умеют распаковывать.
+"""
+import json
+import struct
+import uuid
+import zlib
+from typing import List, NamedTuple, Optional, Tuple
+
+MAGIC = b'LC'
+VERSION = 2
+DEFAULT_ROOM = 'general'
+MULTICAST_PREFIX = '239.255'  # Административно ограниченная область (RFC 2365)
+# Поля, которые получатель добавляет к сообщению; при пересылке они не передаются
+META_KEYS = ('clock', 'id', 'ts', 'seq')
+
+# Типы полезной нагрузки
+TYPE_CHAT = 1  # {"username": ..., "message": ...} без JSON
+TYPE_JSON = 2  # Произвольный словарь в компактном JSON
+TYPE_NACK = 3  # target(8) и список пропущенных seq(4)
+TYPE_SYNC = 4  # seq в заголовке — последний отправленный номер
+TYPE_BATCH = 5  # Несколько целых датаграмм: length(2) + датаграмма, ...
+TYPE_PRESENCE = 6  # Heartbeat присутствия: seq = версия состояния, state(1) interval(2) [username]
+
+# Флаги заголовка
+FLAG_FRAGMENT = 0x01
+FLAG_COMPRESSED = 0x02  # Нагрузка сжата deflate со словарем DICTIONARY
+FLAG_CAP_ZDICT = 0x04  # Отправитель умеет распаковывать FLAG_COMPRESSED
+
+# Возможности этой версии, объявляемые в каждой датаграмме
+CAPABILITIES = FLAG_CAP_ZDICT
+
+# 1500 (Ethernet MTU) - 20 (IPv4) - 8 (UDP)
+MAX_DATAGRAM = 1472
+
+# Сколько номеров помещается в один NACK с запасом до MTU
+MAX_NACK_SEQS = 256
+
+# Предел распакованного размера (защита от «zip-бомб»)
+MAX_DECOMPRESSED = 1024 * 1024
+
+# Предел нагрузки одного сообщения: больше получатель не соберет из фрагментов и не распакует
+MAX_MESSAGE = MAX_DECOMPRESSED
+
+# Общий словарь для сжатия: типичные фрагменты сообщений чата. Самые частые
+# строки стоят в конце — deflate дешевле кодирует близкие ссылки.
+DICTIONARY = ''.join([
+    'https://www.youtube.com/watch?v=', 'https://github.com/', 'http://192.168.', '.local/',
+    'application/octet-stream', 'application/pdf', 'application/zip', 'application/x-msdownload',
+    'image/png', 'image/jpeg', 'video/mp4', 'text/plain', '.exe', '.zip', '.iso', '.pdf', '.png', '.jpg',
+    'Неизвестный тип', 'Спасибо', 'спасибо', 'пожалуйста', 'сейчас', 'сегодня', 'завтра', 'что ', 'это ',
+    'как ', 'так ', 'нет', 'да ', 'привет', 'Привет', 'хорошо', 'thanks', 'please', 'the ', 'and ', 'you ',
+    'ok', 'lol', 'привет всем', 'hello ', 'Hello', 'вошел в чат-комнату', 'покинул чат-комнату',
+    '"presence":', '"typing"', '"online"', '"away"', '"ts":', '"id":', '"room":"general"',
+    '{"username":"system","message":"', ' покинул чат"}', ' вошел в чат"}',
+    'отправил файл: ', '","file_info":{"name":"', '","size":', ',"type":"', '"}}',
+    '{"username":"', '","message":"', '"}',
+]).encode('utf-8')
+_COMPRESSOR = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=DICTIONARY)
+_DECOMPRESSOR = zlib.decompressobj(-15, zdict=DICTIONARY)
+
+# Ключ, которым новые узлы помечают JSON-датаграммы (старые узлы его игнорируют)
+CAPABILITY_KEY = '_wire'
+
+HEADER = struct.Struct('!2sBBBI8sIII')
+HEADER_V1 = struct.Struct('!2sBBBI8sII')  # Версия 1: без clock
+FRAGMENT = struct.Struct('!HHI')
+_USERNAME_LEN = struct.Struct('!H')
+_SEQ = struct.Struct('!I')
+_ROOM_SEQ = struct.Struct('!II')
+_BATCH_ITEM = struct.Struct('!H')
+_PRESENCE = struct.Struct('!BH')
+_CHAT_KEYS = {'username', 'message'}
+
+
+class Header(NamedTuple):
+    version: int
+    type: int
+    flags: int
+    room: int
+    sender: bytes
+    seq: int
+    clock: int
+    length: int
+
+
+def room_id(name: str) -> int:
+    """Числовой идентификатор комнаты для заголовка"""
+    return zlib.crc32(name.encode('utf-8'))
+
+
+def room_group(name: str) -> str:
+    """Адрес multicast-группы комнаты"""
+    group = room_id(name) & 0xFFFF
+    return f"{MULTICAST_PREFIX}.{group >> 8}.{group & 0xFF}"
+
+
+def new_sender_id() -> bytes:
+    """Случайный идентификатор отправителя (8 байт)"""
+    return uuid.uuid4().bytes[:8]
+
+
+def message_id(header: Header) -> bytes:
+    """Уникальный идентификатор сообщения (16 байт)"""
+    return header.sender + _ROOM_SEQ.pack(header.room, header.seq)
+
+
+def is_binary(data: bytes) -> bool:
+    """Является ли датаграмма бинарной (а не JSON от старого узла)"""
+    return data[:2] == MAGIC
+
+
+def compress(payload: bytes) -> bytes:
+    """Сжатие нагрузки с общим словарем"""
+    compressor = _COMPRESSOR.copy()
+    return compressor.compress(payload) + compressor.flush()
+
+
+def decompress(payload: bytes) -> bytes:
+    """Распаковка нагрузки с ограничением размера"""
+    decompressor = _DECOMPRESSOR.copy()
+    data = decompressor.decompress(payload, MAX_DECOMPRESSED)
+    if not decompressor.unconsumed_tail:
+        # flush() может вернуть еще несколько байт сверх предела
+        data += decompressor.flush()
+    if decompressor.unconsumed_tail or len(data) > MAX_DECOMPRESSED:
+        raise ValueError("Распакованная нагрузка слишком велика")
+    return data
+
+
+def encode(message: dict, room: int, sender: bytes, seq: int, flags: int = 0,
+           compressed: bool = False, clock: int = 0) -> bytes:
+    """Кодирование сообщения в бинарную датаграмму
+
+    compressed=True сжимает нагрузку, если это уменьшает ее размер.
+    Нагрузка больше MAX_MESSAGE отклоняется (ValueError).
+    """
+    if message.keys() == _CHAT_KEYS and isinstance(message['username'], str) \
+            and isinstance(message['message'], str):
+        username = message['username'].encode('utf-8')
+        payload = _USERNAME_LEN.pack(len(username)) + username + message['message'].encode('utf-8')
+        msg_type = TYPE_CHAT
+    else:
+        payload = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        msg_type = TYPE_JSON
+    if len(payload) > MAX_MESSAGE:
+        raise ValueError(f"Сообщение больше {MAX_MESSAGE} байт")
+    if compressed:
+        packed = compress(payload)
+        if len(packed) < len(payload):
+            payload = packed
+            flags |= FLAG_COMPRESSED
+    return HEADER.pack(MAGIC, VERSION, msg_type, flags | CAPABILITIES, room, sender, seq, clock,
+                       len(payload)) + payload
+
+
+def decode_header(data: bytes) -> Tuple[Header, bytes]:
+    """Разбор заголовка; возвращает заголовок и полезную нагрузку без ее декодирования"""
+    if len(data) < 3:
+        raise ValueError("Слишком короткая датаграмма")
+    if data[:2] != MAGIC:
+        raise ValueError("Неверная сигнатура датаграммы")
+    version = data[2]
+    if version not in (1, VERSION):
+        raise ValueError(f"Неподдерживаемая версия формата: {version}")
+    layout = HEADER if version == VERSION else HEADER_V1
+    if len(data) < layout.size:
+        raise ValueError("Слишком короткая датаграмма")
+    fields = layout.unpack_from(data)
+    msg_type, flags, room, sender, seq = fields[2:7]
+    clock = fields[7] if version == VERSION else 0
+    length = fields[-1]
+    payload = data[layout.size:layout.size + length]
+    if len(payload) != length:
+        raise ValueError("Полезная нагрузка обрезана")
+    return Header(version, msg_type, flags, room, sender, seq, clock, length), payload
+
+
+def fragment(data: bytes, mtu: int = MAX_DATAGRAM) -> List[bytes]:
+    """Разбиение закодированной датаграммы на фрагменты не длиннее mtu"""
+    if len(data) <= mtu:
+        return [data]
+    header, payload = decode_header(data)
+    chunk_size = mtu - HEADER.size - FRAGMENT.size
+    if chunk_size <= 0:
+        raise ValueError(f"Слишком маленький MTU: {mtu}")
+    count = -(-len(payload) // chunk_size)
+    if count > 0xFFFF:
+        raise ValueError("Сообщение слишком велико для фрагментации")
+    fragments = []
+    for index in range(count):
+        chunk = payload[index * chunk_size:(index + 1) * chunk_size]
+        fragments.append(
+            HEADER.pack(MAGIC, header.version, header.type, header.flags | FLAG_FRAGMENT, header.room,
+                        header.sender, header.seq, header.clock, FRAGMENT.size + len(chunk))
+            + FRAGMENT.pack(index, count, len(payload)) + chunk)
+    return fragments
+
+
+def decode_fragment(payload: bytes) -> Tuple[int, int, int, bytes]:
+    """Разбор фрагмента: номер, количество, полный размер и кусок нагрузки"""
+    if len(payload) < FRAGMENT.size:
+        raise ValueError("Слишком короткий фрагмент")
+    index, count, total = FRAGMENT.unpack_from(payload)
+    if index >= count:
+        raise ValueError("Неверный номер фрагмента")
+    return index, count, total, payload[FRAGMENT.size:]
+
+
+def encode_nack(room: int, sender: bytes, target: bytes, seqs: List[int]) -> bytes:
+    """Запрос повторной передачи сообщений target с номерами seqs"""
+    seqs = seqs[:MAX_NACK_SEQS]
+    payload = target + struct.pack(f'!{len(seqs)}I', *seqs)
+    return HEADER.pack(MAGIC, VERSION, TYPE_NACK, CAPABILITIES, room, sender, 0, 0, len(payload)) + payload
+
+
+def decode_nack(payload: bytes) -> Tuple[bytes, List[int]]:
+    """Разбор NACK: отправитель, у которого запрашивают повтор, и номера сообщений"""
+    target, body = payload[:8], payload[8:]
+    if len(target) != 8 or len(body) % _SEQ.size:
+        raise ValueError("Неверный формат NACK")
+    return target, list(struct.unpack(f'!{len(body) // _SEQ.size}I', body))
+
+
+def encode_sync(room: int, sender: bytes, seq: int) -> bytes:
+    """Объявление последнего отправленного номера (обнаружение потерь в конце серии)"""
+    return HEADER.pack(MAGIC, VERSION, TYPE_SYNC, CAPABILITIES, room, sender, seq, 0, 0)
+
+
+def encode_presence(room: int, sender: bytes, state: int, version: int, interval: float,
+                    username: Optional[str] = None) -> bytes:
+    """Heartbeat присутствия; username передается только при изменении и периодически"""
+    payload = _PRESENCE.pack(state, min(int(interval * 10), 0xFFFF))
+    if username is not None:
+        payload += username.encode('utf-8')
+    return HEADER.pack(MAGIC, VERSION, TYPE_PRESENCE, CAPABILITIES, room, sender, version, 0,
+                       len(payload)) + payload
+
+
+def decode_presence(payload: bytes) -> Tuple[int, float, Optional[str]]:
+    """Разбор heartbeat: состояние, период в секундах и имя (None, если не передано)"""
+    if len(payload) < _PRESENCE.size:
+        raise ValueError("Неверный формат heartbeat")
+    state, interval = _PRESENCE.unpack_from(payload)
+    username = payload[_PRESENCE.size:].decode('utf-8') or None
+    return state, interval / 10, username
+
+
+def is_batch(data: bytes) -> bool:
+    """Является ли датаграмма пакетом из нескольких датаграмм"""
+    return len(data) > 3 and data[:2] == MAGIC and data[3] == TYPE_BATCH
+
+
+def batch_size(datagrams: List[bytes]) -> int:
+    """Размер пакета, в который будут упакованы датаграммы"""
+    return HEADER.size + sum(_BATCH_ITEM.size + len(d) for d in datagrams)
+
+
+def pack_batch(room: int, sender: bytes, datagrams: List[bytes]) -> bytes:
+    """Упаковка нескольких датаграмм в одну"""
+    payload = b''.join(_BATCH_ITEM.pack(len(d)) + d for d in datagrams)
+    return HEADER.pack(MAGIC, VERSION, TYPE_BATCH, CAPABILITIES, room, sender, 0, 0, len(payload)) + payload
+
+
+def unpack_batch(payload: bytes) -> List[bytes]:
+    """Разбор пакета на исходные датаграммы в порядке отправки"""
+    datagrams = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = _BATCH_ITEM.unpack_from(payload, offset)
+        offset += _BATCH_ITEM.size
+        datagram = payload[offset:offset + length]
+        if len(datagram) != length:
+            raise ValueError("Пакет обрезан")
+        datagrams.append(datagram)
+        offset += length
+    return datagrams
+
+
+def decode_payload(header: Header, payload: bytes) -> dict:
+    """Декодирование полезной нагрузки в словарь сообщения"""
+    if header.flags & FLAG_COMPRESSED:
+        payload = decompress(payload)
+    if header.type == TYPE_CHAT:
+        start = _USERNAME_LEN.size
+        if len(payload) < start:
+            raise ValueError("Слишком короткая нагрузка сообщения")
+        (username_len,) = _USERNAME_LEN.unpack_from(payload)
+        if start + username_len > len(payload):
+            raise ValueError("Имя пользователя обрезано")
+        return {
+            'username': payload[start:start + username_len].decode('utf-8'),
+            'message': payload[start + username_len:].decode('utf-8'),
+        }
+    if header.type == TYPE_JSON:
+        return json.loads(payload.decode('utf-8'))
+    raise ValueError(f"Неизвестный тип сообщения: {header.type}")
+
+
+def encode_json(message: dict) -> bytes:
+    """Кодирование в JSON для совместимости со старыми узлами"""
+    return json.dumps({**message, CAPABILITY_KEY: VERSION}).encode('utf-8')
+
+
+def decode_json(data: bytes) -> Tuple[dict, bool]:
+    """Декодирование JSON-датаграммы; второй элемент — поддерживает ли отправитель бинарный формат"""
+    message = json.loads(data.decode('utf-8'))
+    if not isinstance(message, dict):
+        raise ValueError("Ожидался JSON-объект")
+    capable = message.pop(CAPABILITY_KEY, None) is not None
+    return message, capable